@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+import argparse
+import timeit
+import numpy as np
+from translate import utils
+
+help_msg = """\
+Micro-benchmark of the candidate selection of beam-search: full `np.argsort` of the (beam x vocab) scores
+against `utils.partial_argsort`, which only sorts the 2 x beam best candidates. Also checks that both
+give the same candidates, in the same order.
+"""
+
+parser = argparse.ArgumentParser(description=help_msg)
+parser.add_argument('--vocab-sizes', type=int, nargs='+', default=[10000, 30000, 80000])
+parser.add_argument('--beam-sizes', type=int, nargs='+', default=[1, 4, 8, 16])
+parser.add_argument('--repeat', type=int, default=20)
+
+
+def random_scores(beam_size, vocab_size):
+    # scores of a beam-search step: score of the hypothesis minus log probability of the next word
+    proba = np.random.dirichlet(np.full(vocab_size, 0.1), size=beam_size).astype(np.float32)
+    scores = np.random.rand(beam_size, 1) * 10 - np.log(np.maximum(proba, 1e-10))
+    # a few ties, as there are many probabilities equal to 1e-10
+    return scores.ravel()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    print('{:>8} {:>6} {:>12} {:>12} {:>8}'.format('vocab', 'beam', 'argsort', 'partial', 'speedup'))
+    for vocab_size in args.vocab_sizes:
+        for beam_size in args.beam_sizes:
+            scores = random_scores(beam_size, vocab_size)
+            k = 2 * beam_size
+
+            expected = np.argsort(scores, kind='stable')[:k]
+            assert np.array_equal(utils.partial_argsort(scores, k), expected)
+
+            argsort_time = timeit.timeit(lambda: np.argsort(scores), number=args.repeat) / args.repeat
+            partial_time = timeit.timeit(lambda: utils.partial_argsort(scores, k), number=args.repeat) / args.repeat
+
+            print('{:>8} {:>6} {:>9.3f} ms {:>9.3f} ms {:>7.1f}x'.format(
+                vocab_size, beam_size, 1000 * argsort_time, 1000 * partial_time, argsort_time / partial_time))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import argparse
+import threading
+import timeit
+import tracemalloc
+import numpy as np
+from translate import utils
+from translate.seq2seq_model import Seq2SeqModel
+
+help_msg = """\
+Micro-benchmark of `Seq2SeqModel.get_batch` against the previous list-based implementation,
+on random text and speech batches of varying sizes (like in `tokens` mode). Also checks that both
+implementations give the same arrays, and reports the peak memory used while creating the batches
+(for the new implementation, this includes the preallocated buffers, which are kept between batches).
+"""
+
+parser = argparse.ArgumentParser(description=help_msg)
+parser.add_argument('--batch-size', type=int, default=80)
+parser.add_argument('--max-len', type=int, default=50, help='maximum length of the text sequences')
+parser.add_argument('--max-frames', type=int, default=1000, help='maximum length of the speech sequences')
+parser.add_argument('--dim', type=int, default=41, help='dimension of the speech features')
+parser.add_argument('--batches', type=int, default=10, help='number of batches (of random sizes)')
+parser.add_argument('--buffer-count', type=int, default=3, help='number of buffers per array (prefetch depth + 2)')
+parser.add_argument('--repeat', type=int, default=10)
+
+
+class BatchModel(Seq2SeqModel):
+    def __init__(self, encoders, max_input_len, max_output_len, buffer_count=1):   # no graph for `get_batch`
+        self.encoders = encoders
+        self.encoder_count = len(encoders)
+        self.encoder_names = [encoder.name for encoder in encoders]
+        self.binary_input = [encoder.name for encoder in encoders if encoder.binary]
+        self.max_input_len = max_input_len
+        self.max_output_len = max_output_len
+        self.batch_buffers = threading.local()
+        self.batch_buffer_count = buffer_count
+
+
+def legacy_get_batch(self, data, decoding=False):
+    inputs = [[] for _ in range(self.encoder_count)]
+    input_length = [[] for _ in range(self.encoder_count)]
+    targets = []
+
+    max_input_len = [max(len(data_[i]) for data_ in data) for i in range(self.encoder_count)]
+    if self.max_input_len is not None:
+        max_input_len = [min(len_, self.max_input_len) for len_ in max_input_len]
+
+    max_output_len = min(max(len(data_[-1]) for data_ in data), self.max_output_len)
+
+    for *src_sentences, trg_sentence in data:
+        for i, (encoder, src_sentence) in enumerate(zip(self.encoders, src_sentences)):
+            if encoder.binary:
+                pad = np.zeros([encoder.embedding_size], dtype=np.float32)
+            else:
+                pad = utils.EOS_ID
+
+            src_sentence = list(src_sentence[:max_input_len[i]])
+            encoder_pad = [pad] * (1 + max_input_len[i] - len(src_sentence))
+
+            inputs[i].append(src_sentence + encoder_pad)
+            input_length[i].append(len(src_sentence) + 1)
+
+        trg_sentence = list(trg_sentence[:max_output_len])
+        if decoding:
+            targets.append([utils.BOS_ID] * self.max_output_len + [utils.EOS_ID])
+        else:
+            decoder_pad_size = max_output_len - len(trg_sentence) + 1
+            trg_sentence = [utils.BOS_ID] + trg_sentence + [utils.EOS_ID] * decoder_pad_size
+            targets.append(trg_sentence)
+
+    input_length = [np.array(input_length_, dtype=np.int32) for input_length_ in input_length]
+    inputs = [
+        np.array(inputs_, dtype=(np.float32 if ext in self.binary_input else np.int32))
+        for ext, inputs_ in zip(self.encoder_names, inputs)
+    ]
+    targets = np.array(targets).T
+
+    return inputs, targets, input_length
+
+
+def check(model, data, decoding=False):
+    inputs, targets, input_length = model.get_batch(data, decoding=decoding)
+    inputs_, targets_, input_length_ = legacy_get_batch(model, data, decoding=decoding)
+
+    assert all(np.array_equal(x, y) and x.dtype == y.dtype for x, y in zip(inputs, inputs_))
+    assert all(np.array_equal(x, y) for x, y in zip(input_length, input_length_))
+    assert np.array_equal(targets, targets_)
+
+
+def run(get_batch, model, batches):
+    for data in batches:
+        get_batch(model, data)
+
+
+def peak_memory(get_batch, model, batches):
+    tracemalloc.start()
+    run(get_batch, model, batches)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark(name, model, batches, repeat):
+    for data in batches:
+        check(model, data)
+        check(model, data, decoding=True)
+
+    legacy_time = timeit.timeit(lambda: run(legacy_get_batch, model, batches), number=repeat) / repeat
+    new_time = timeit.timeit(lambda: run(Seq2SeqModel.get_batch, model, batches), number=repeat) / repeat
+
+    model.batch_buffers = threading.local()   # the peak includes the allocation of the buffers
+    legacy_peak = peak_memory(legacy_get_batch, model, batches)
+    new_peak = peak_memory(Seq2SeqModel.get_batch, model, batches)
+
+    print('{:<8} legacy {:8.3f} ms {:8.1f} MB   new {:8.3f} ms {:8.1f} MB   speedup x{:.1f}'.format(
+        name, 1000 * legacy_time / len(batches), legacy_peak / 2 ** 20, 1000 * new_time / len(batches),
+        new_peak / 2 ** 20, legacy_time / new_time))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    def random_sentence(max_len):
+        return np.random.randint(3, 30000, size=np.random.randint(1, max_len + 1)).tolist()
+
+    def random_features(max_frames):
+        return np.random.rand(np.random.randint(1, max_frames + 1), args.dim).astype(np.float32)
+
+    text_encoder = utils.AttrDict(name='fr', binary=False)
+    speech_encoder = utils.AttrDict(name='feats', binary=True, embedding_size=args.dim)
+
+    def random_batches(random_input):
+        batch_sizes = np.random.randint(1, args.batch_size + 1, size=args.batches)
+        return [[[random_input(), random_sentence(args.max_len)] for _ in range(batch_size)]
+                for batch_size in batch_sizes]
+
+    model = BatchModel([text_encoder], max_input_len=args.max_len, max_output_len=args.max_len,
+                       buffer_count=args.buffer_count)
+    batches = random_batches(lambda: random_sentence(args.max_len))
+    benchmark('text', model, batches, args.repeat)
+
+    model = BatchModel([speech_encoder], max_input_len=args.max_frames, max_output_len=args.max_len,
+                       buffer_count=args.buffer_count)
+    batches = random_batches(lambda: random_features(args.max_frames))
+    benchmark('speech', model, batches, max(1, args.repeat // 10))
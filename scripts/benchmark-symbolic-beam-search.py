@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import argparse
+import time
+import yaml
+import numpy as np
+import tensorflow as tf
+from translate import utils
+from translate.seq2seq_model import Seq2SeqModel
+
+help_msg = """\
+Benchmark of the in-graph beam-search (`Seq2SeqModel.symbolic_beam_search_decoding`) against the Python
+beam-search (`Seq2SeqModel.batch_beam_search_decoding`). Both searches decode the same random batches with
+the same (randomly initialized) model, and the script reports their speed and how often they agree
+(same best hypothesis, and same n-best lists).
+
+The Python search averages the log probabilities with an all-zero language model row, so its scores are
+half of the in-graph scores: the script also reports the range of the ratio between the scores
+of the best hypotheses, which should be 2.
+"""
+
+parser = argparse.ArgumentParser(description=help_msg)
+parser.add_argument('--config', default='config/default.yaml', help='model parameters are read from this file')
+parser.add_argument('--vocab-size', type=int, default=1000)
+parser.add_argument('--cell-size', type=int, default=256)
+parser.add_argument('--embedding-size', type=int, default=128)
+parser.add_argument('--attn-size', type=int, default=256)
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--beam-size', type=int, default=4)
+parser.add_argument('--max-len', type=int, default=30, help='maximum length of the inputs and outputs')
+parser.add_argument('--batches', type=int, default=10)
+parser.add_argument('--no-early-stopping', action='store_false', dest='early_stopping')
+parser.add_argument('--seed', type=int, default=1234)
+
+model_parameters = [
+    'cell_size', 'layers', 'vocab_size', 'embedding_size', 'attention_filters', 'attention_filter_length',
+    'use_lstm', 'time_pooling', 'attention_window_size', 'dynamic', 'binary', 'character_level', 'bidir',
+    'load_embeddings', 'pooling_avg', 'swap_memory', 'parallel_iterations', 'input_layers',
+    'residual_connections', 'attn_size'
+]
+
+
+def compare(n_best, n_best_):
+    same_best = same_n_best = 0
+    ratios = []
+
+    for (hypotheses, scores), (hypotheses_, scores_) in zip(n_best, n_best_):
+        hypotheses = [list(map(int, hypothesis)) for hypothesis in hypotheses]
+        hypotheses_ = [list(map(int, hypothesis)) for hypothesis in hypotheses_]
+        same_best += hypotheses[0] == hypotheses_[0]
+        same_n_best += hypotheses[:len(hypotheses_)] == hypotheses_
+        ratios.append(scores_[0] / scores[0])
+
+    return same_best, same_n_best, ratios
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+    tf.set_random_seed(args.seed)
+
+    with open(args.config) as f:
+        config = utils.AttrDict(yaml.safe_load(f))
+
+    config.update(vocab_size=args.vocab_size, cell_size=args.cell_size, embedding_size=args.embedding_size,
+                  attn_size=args.attn_size, max_input_len=args.max_len, max_output_len=args.max_len,
+                  beam_size=args.beam_size)
+
+    encoders = [utils.AttrDict(encoder) for encoder in config.encoders]
+    decoder = utils.AttrDict(config.decoder)
+    for encoder_or_decoder in encoders + [decoder]:
+        for parameter in model_parameters:
+            encoder_or_decoder.setdefault(parameter, config.get(parameter))
+
+    global_step = tf.Variable(0, trainable=False, name='global_step')
+    model = Seq2SeqModel(encoders, decoder, learning_rate=tf.constant(0.0), global_step=global_step,
+                         max_gradient_norm=config.max_gradient_norm, max_output_len=args.max_len,
+                         max_input_len=args.max_len, decode_only=True, beam_size=args.beam_size,
+                         symbolic_beam_search=True, len_normalization=config.len_normalization,
+                         softmax_temperature=config.softmax_temperature)
+
+    def random_sentence():
+        return np.random.randint(4, args.vocab_size, size=np.random.randint(1, args.max_len + 1)).tolist()
+
+    batches = [[[random_sentence() for _ in encoders] for _ in range(args.batch_size)]
+               for _ in range(args.batches)]
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+
+        # warm-up (graph optimizations, memory allocation)
+        model.batch_beam_search_decoding(sess, batches[0], args.beam_size, early_stopping=args.early_stopping)
+        model.symbolic_beam_search_decoding(sess, batches[0], early_stopping=args.early_stopping)
+
+        python_time = symbolic_time = 0.0
+        same_best = same_n_best = 0
+        ratios = []
+
+        for batch in batches:
+            start = time.time()
+            n_best = model.batch_beam_search_decoding(sess, batch, args.beam_size,
+                                                      early_stopping=args.early_stopping)
+            python_time += time.time() - start
+
+            start = time.time()
+            n_best_ = model.symbolic_beam_search_decoding(sess, batch, early_stopping=args.early_stopping)
+            symbolic_time += time.time() - start
+
+            same_best_, same_n_best_, ratios_ = compare(n_best, n_best_)
+            same_best += same_best_
+            same_n_best += same_n_best_
+            ratios += ratios_
+
+    lines = args.batches * args.batch_size
+    print('python   {:8.1f} lines/s'.format(lines / python_time))
+    print('symbolic {:8.1f} lines/s   speedup x{:.1f}'.format(lines / symbolic_time, python_time / symbolic_time))
+    print('same best hypothesis {}/{}, same n-best list {}/{}, score ratio {:.4f}-{:.4f}'.format(
+        same_best, lines, same_n_best, lines, min(ratios), max(ratios)))
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+import argparse
+from translate.utils import initialize_vocabulary, read_ngrams, write_ngram_model
+
+help_msg = """\
+Convert a language model in the ARPA format into a compact binary model, which is
+loaded instantly (memory-mapped) when used as `lm_file` (see `translate.utils.NgramModel`).
+The binary model only contains the words of the given vocabulary, and can only be used
+with this vocabulary.
+
+Usage example:
+    scripts/convert-arpa-lm.py data/lm.arpa data/vocab.fr data/lm.bin
+"""
+
+parser = argparse.ArgumentParser(description=help_msg, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('input', help='language model in the ARPA format')
+parser.add_argument('vocab', help='target vocabulary of the model')
+parser.add_argument('output', help='output binary language model')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    vocab, _ = initialize_vocabulary(args.vocab)
+    ngrams = read_ngrams(args.input, vocab)
+    write_ngram_model(args.output, ngrams, vocab)
+    print('converted {} n-grams'.format(sum(len(table) for table in ngrams)))
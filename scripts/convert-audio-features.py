@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+import argparse
+import struct
+from translate.utils import iter_binary_features, write_feature_store
+
+help_msg = """\
+Convert a binary file created by `extract-audio-features.py` into a feature store,
+which can be memory-mapped and randomly accessed (see `translate.utils.FeatureStore`).
+
+Usage example:
+    scripts/convert-audio-features.py data/train.feats data/train.feats.store
+"""
+
+parser = argparse.ArgumentParser(description=help_msg, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('input', help='binary file in the format of `extract-audio-features.py`')
+parser.add_argument('output', help='output feature store')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    with open(args.input, 'rb') as f:
+        _, dim = struct.unpack('ii', f.read(8))
+
+    lines = write_feature_store(args.output, iter_binary_features(args.input), dim=dim)
+    print('converted {} entries'.format(lines))
@@ -33,6 +33,8 @@ parser.add_argument('--decode', help='translate this corpus (one filename for ea
 parser.add_argument('--align', help='translate and show alignments by the attention mechanism', nargs=2)
 parser.add_argument('--eval', help='compute BLEU score on this corpus (source files and target file)', nargs='+')
 parser.add_argument('--train', help='train an NMT model', action='store_true')
+parser.add_argument('--serve', help='start a HTTP decoding server (see translate.server)', action='store_true')
+parser.add_argument('--export', help='export a frozen inference graph of the model to this file')
 
 # TensorFlow configuration
 parser.add_argument('--gpu-id', type=int, help='index of the GPU where to run the computation')
@@ -40,6 +42,7 @@ parser.add_argument('--no-gpu', action='store_true', help='run on CPU')
 
 # Decoding options (to avoid having to edit the config file)
 parser.add_argument('--beam-size', type=int)
+parser.add_argument('--symbolic-beam-search', action='store_const', const=True)
 parser.add_argument('--ensemble', action='store_const', const=True)
 parser.add_argument('--lm-file')
 parser.add_argument('--checkpoints', nargs='+')
@@ -50,6 +53,9 @@ parser.add_argument('--max-steps', type=int)
 parser.add_argument('--remove-unk', action='store_const', const=True)
 parser.add_argument('--wav-files', nargs='*')
 parser.add_argument('--use-edits', action='store_const', const=True)
+parser.add_argument('--server-host')
+parser.add_argument('--server-port', type=int)
+parser.add_argument('--frozen-graph', help='decode with a graph created by --export (no checkpoint is loaded)')
 
 """
 Benchmarks:
@@ -68,10 +74,8 @@ Scores on English->French WMT14 (ntst14)
 
 TODO:
 - pervasive dropout (dropout in the recurrent connections)
-- symbolic beam-search
 - possibility to build an encoder with 1 bi-directional layer, and several uni-directional layers
 - pre-load data on GPU for small datasets
-- load training data as a stream for large datasets
 - possibility to run model on several GPUs
 - copy vocab and config to model dir
 """
@@ -102,8 +106,12 @@ def main(args=None):
     # enforce parameter constraints
     assert config.steps_per_eval % config.steps_per_checkpoint == 0, (
         'steps-per-eval should be a multiple of steps-per-checkpoint')
-    assert args.decode is not None or args.eval or args.train or args.align, (
-        'you need to specify at least one action (decode, eval, align, or train)')
+    assert args.decode is not None or args.eval or args.train or args.align or args.serve or args.export, (
+        'you need to specify at least one action (decode, eval, align, train, serve, or export)')
+    assert not config.frozen_graph or not (args.train or args.align or args.export or config.ensemble), (
+        'frozen graphs can only be used for decoding and evaluation')
+    assert not config.frozen_graph or len(config.get('tasks') or [None]) == 1, (
+        'frozen graphs only support a single task')
 
     if args.purge:
         utils.log('deleting previous model')
@@ -192,7 +200,8 @@ def main(args=None):
             initializer = None
 
         tf.get_variable_scope().set_initializer(initializer)
-        decode_only = args.decode is not None or args.eval or args.align  # exempt from creating gradient ops
+        # exempt from creating gradient ops
+        decode_only = args.decode is not None or args.eval or args.align or args.serve or args.export
         model = MultiTaskModel(name='main', checkpoint_dir=checkpoint_dir, decode_only=decode_only, **config)
 
     utils.log('model parameters ({})'.format(len(tf.global_variables())))
@@ -213,12 +222,16 @@ def main(args=None):
     with tf.Session(config=tf_config) as sess:
         best_checkpoint = os.path.join(checkpoint_dir, 'best')
 
-        if config.ensemble and (args.eval or args.decode is not None):
-            # create one session for each model in the ensemble
-            sess = [tf.Session() for _ in config.checkpoints]
+        if config.frozen_graph:
+            # parameters are constants of the graph: nothing to initialize or restore
+            model.checkpoint_files.append(config.frozen_graph)
+        elif config.ensemble and (args.eval or args.decode is not None or args.serve):
+            # create one session for each model in the ensemble (these sessions are run concurrently)
+            sess = [tf.Session(config=tf_config) for _ in config.checkpoints]
             for sess_, checkpoint in zip(sess, config.checkpoints):
                 model.initialize(sess_, [checkpoint], reset=True)
-        elif (not config.checkpoints and (args.eval or args.decode is not None or args.align) and
+        elif (not config.checkpoints and (args.eval or args.decode is not None or args.align or args.serve or
+                                          args.export) and
              (os.path.isfile(best_checkpoint + '.index') or os.path.isfile(best_checkpoint + '.index'))):
             # in decoding and evaluation mode, unless specified otherwise (by `checkpoints`),
             # try to load the best checkpoint)
@@ -227,6 +240,9 @@ def main(args=None):
             # loads last checkpoint, unless `reset` is true
             model.initialize(sess, **config)
 
+        if args.decode is not None or args.eval or args.serve:
+            model.use_translation_cache(**config)
+
         # Inspect variables:
         # tf.get_variable_scope().reuse_variables()
         # import pdb; pdb.set_trace()
@@ -236,6 +252,10 @@ def main(args=None):
             model.evaluate(sess, on_dev=False, **config)
         elif args.align:
             model.align(sess, **config)
+        elif args.serve:
+            model.serve(sess, **config)
+        elif args.export:
+            model.export(sess, args.export)
         elif args.train:
             eval_output = os.path.join(config.model_dir, 'eval')
             try:
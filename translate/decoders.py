@@ -112,22 +112,53 @@ def multi_encoder(encoder_inputs, encoders, encoder_input_length, dropout=None,
     return encoder_outputs, encoder_state
 
 
-def compute_energy(hidden, state, attn_size, **kwargs):
+def compute_attention_keys(hidden, encoder):
+    """
+    Projection of the attention states used by `compute_energy` (`hidden x U_a`) or by
+    `compute_energy_with_filter` (`hidden x W`). It only depends on the source sequence, so it is computed
+    once before decoding, instead of at each time step (and for each hypothesis in beam-search).
+
+    :param hidden: tensor of shape (batch_size, input_length, 1, input_size)
+    :return: tensor of shape (batch_size, input_length, attn_size)
+    """
     input_size = hidden.get_shape()[3].value
     batch_size = tf.shape(hidden)[0]
     time_steps = tf.shape(hidden)[1]
 
+    if encoder.attention_filters > 0:
+        attn_size = input_size
+        k = get_variable_unsafe('W', [attn_size, attn_size])
+    else:
+        attn_size = encoder.attn_size
+        # initializer = tf.random_normal_initializer(stddev=0.001)   # same as Bahdanau et al.
+        k = get_variable_unsafe('U_a', [input_size, attn_size], initializer=None)
+
+    # dot product between tensors requires reshaping
+    hidden = tf.reshape(hidden, tf.stack([tf.multiply(batch_size, time_steps), input_size]))
+    f = tf.matmul(hidden, k)
+    return tf.reshape(f, tf.stack([batch_size, time_steps, attn_size]))
+
+
+def multi_attention_keys(hidden_states, encoders):
+    """
+    Same as `compute_attention_keys` for a list of encoders (with the variable scopes used by `multi_attention`)
+    """
+    keys = []
+    for hidden, encoder in zip(hidden_states, encoders):
+        with tf.variable_scope('attention_{}'.format(encoder.name)):
+            keys.append(compute_attention_keys(hidden, encoder))
+    return keys
+
+
+def compute_energy(hidden, state, attn_size, keys=None, encoder=None, **kwargs):
     # initializer = tf.random_normal_initializer(stddev=0.001)   # same as Bahdanau et al.
     initializer = None
     y = linear_unsafe(state, attn_size, True, scope='W_a', initializer=initializer)
     y = tf.reshape(y, [-1, 1, attn_size])
 
-    k = get_variable_unsafe('U_a', [input_size, attn_size], initializer=initializer)
-
-    # dot product between tensors requires reshaping
-    hidden = tf.reshape(hidden, tf.stack([tf.multiply(batch_size, time_steps), input_size]))
-    f = tf.matmul(hidden, k)
-    f = tf.reshape(f, tf.stack([batch_size, time_steps, attn_size]))
+    if keys is None:
+        keys = compute_attention_keys(hidden, encoder)
+    f = keys
 
     v = get_variable_unsafe('v_a', [attn_size])
     s = f + y
@@ -136,7 +167,7 @@ def compute_energy(hidden, state, attn_size, **kwargs):
 
 
 def compute_energy_with_filter(hidden, state, prev_weights, attention_filters, attention_filter_length,
-                               **kwargs):
+                               keys=None, encoder=None, **kwargs):
     time_steps = tf.shape(hidden)[1]
     attn_size = hidden.get_shape()[3].value
     batch_size = tf.shape(hidden)[0]
@@ -154,25 +185,24 @@ def compute_energy_with_filter(hidden, state, prev_weights, attention_filters, a
     y = linear_unsafe(state, attn_size, True)
     y = tf.reshape(y, [-1, 1, 1, attn_size])
 
-    k = get_variable_unsafe('W', [attn_size, attn_size])
-
-    # dot product between tensors requires reshaping
-    hidden = tf.reshape(hidden, tf.stack([tf.multiply(batch_size, time_steps), attn_size]))
-    f = tf.matmul(hidden, k)
-    f = tf.reshape(f, tf.stack([batch_size, time_steps, 1, attn_size]))
+    if keys is None:
+        keys = compute_attention_keys(hidden, encoder)
+    f = tf.expand_dims(keys, 2)
 
     v = get_variable_unsafe('V', [attn_size])
     s = f + y + z
     return tf.reduce_sum(v * tf.tanh(s), [2, 3])
 
 
-def global_attention(state, prev_weights, hidden_states, encoder, encoder_input_length, scope=None, **kwargs):
+def global_attention(state, prev_weights, hidden_states, encoder, encoder_input_length, scope=None, keys=None,
+                     **kwargs):
     with tf.variable_scope(scope or 'attention'):
         # TODO: choose energy function inside config
         compute_energy_ = compute_energy_with_filter if encoder.attention_filters > 0 else compute_energy
         e = compute_energy_(
             hidden_states, state, prev_weights=prev_weights, attention_filters=encoder.attention_filters,
-            attention_filter_length=encoder.attention_filter_length, attn_size=encoder.attn_size
+            attention_filter_length=encoder.attention_filter_length, attn_size=encoder.attn_size,
+            keys=keys, encoder=encoder
         )
         e = e - tf.reduce_max(e, reduction_indices=(1,), keep_dims=True)
 
@@ -188,7 +218,7 @@ def global_attention(state, prev_weights, hidden_states, encoder, encoder_input_
         return weighted_average, weights
 
 
-def local_attention(state, prev_weights, hidden_states, encoder, scope=None, **kwargs):
+def local_attention(state, prev_weights, hidden_states, encoder, scope=None, keys=None, **kwargs):
     """
     Local attention of Luong et al. (http://arxiv.org/abs/1508.04025)
     """
@@ -220,7 +250,8 @@ def local_attention(state, prev_weights, hidden_states, encoder, scope=None, **k
         compute_energy_ = compute_energy_with_filter if encoder.attention_filters > 0 else compute_energy
         e = compute_energy_(
             hidden_states, state, prev_weights=prev_weights, attention_filters=encoder.attention_filters,
-            attention_filter_length=encoder.attention_filter_length
+            attention_filter_length=encoder.attention_filter_length, attn_size=encoder.attn_size,
+            keys=keys, encoder=encoder
         )
 
         # we have to use this mask thing, because the slice operation
@@ -249,23 +280,78 @@ def attention(state, prev_weights, hidden_states, encoder, **kwargs):
     return attention_(state, prev_weights, hidden_states, encoder, **kwargs)
 
 
-def multi_attention(state, prev_weights, hidden_states, encoders, encoder_input_length, **kwargs):
+def multi_attention(state, prev_weights, hidden_states, encoders, encoder_input_length, attention_keys=None,
+                    **kwargs):
     """
     Same as `attention` except that prev_weights, hidden_states and encoders
     are lists whose length is the number of encoders.
+
+    :param attention_keys: list of projected attention states (see `multi_attention_keys`), or None
     """
+    attention_keys = attention_keys or [None] * len(encoders)
     attns, weights = list(zip(*[
         attention(state, weights, hidden, encoder, encoder_input_length=input_length,
-                  scope='attention_{}'.format(encoder.name), **kwargs)
-        for weights, hidden, encoder, input_length in zip(prev_weights, hidden_states, encoders, encoder_input_length)
+                  scope='attention_{}'.format(encoder.name), keys=keys, **kwargs)
+        for weights, hidden, encoder, input_length, keys in zip(prev_weights, hidden_states, encoders,
+                                                                encoder_input_length, attention_keys)
     ]))
 
     return tf.concat(attns, 1), list(weights)
 
 
+def decoder_embedding(decoder):
+    """
+    Embedding variable of the decoder (shared by `attention_decoder` and `beam_search_decoder`)
+    """
+    if decoder.get('embedding') is not None:
+        initializer = decoder.embedding
+        embedding_shape = None
+    else:
+        initializer = None
+        embedding_shape = [decoder.vocab_size, decoder.embedding_size]
+
+    with tf.device('/cpu:0'):
+        return get_variable_unsafe('embedding_{}'.format(decoder.name), shape=embedding_shape,
+                                   initializer=initializer)
+
+
+def decoder_cell(decoder, dropout=None):
+    """
+    Recurrent cell of the decoder (shared by `attention_decoder` and `beam_search_decoder`)
+    """
+    if decoder.use_lstm:
+        cell = BasicLSTMCell(decoder.cell_size, state_is_tuple=False)
+    else:
+        cell = GRUCell(decoder.cell_size, initializer=orthogonal_initializer())
+
+    if dropout is not None:
+        cell = DropoutWrapper(cell, input_keep_prob=dropout)
+
+    if decoder.layers > 1:
+        cell = MultiRNNCell([cell] * decoder.layers, residual_connections=decoder.residual_connections)
+
+    return cell
+
+
+def decoder_projection(state, input_, context_vector, decoder):
+    """
+    Output layer of the decoder (maxout layer followed by two linear projections)
+
+    :return: logits of shape (batch_size, vocab_size), and output of the maxout layer
+      of shape (batch_size, embedding_size)
+    """
+    batch_size = tf.shape(state)[0]
+    # FIXME use `output` or `state` here?
+    output_ = linear_unsafe([state, input_, context_vector], decoder.cell_size, False, scope='maxout')
+    output_ = tf.reduce_max(tf.reshape(output_, tf.stack([batch_size, decoder.cell_size // 2, 2])), axis=2)
+    output_ = linear_unsafe(output_, decoder.embedding_size, False, scope='softmax0')
+    logits = linear_unsafe(output_, decoder.vocab_size, True, scope='softmax1')
+    return logits, output_
+
+
 def attention_decoder(targets, initial_state, attention_states, encoders, decoder, encoder_input_length,
                       decoder_input_length=None, dropout=None, feed_previous=0.0, feed_argmax=True,
-                      **kwargs):
+                      early_exit=False, **kwargs):
     """
     :param targets: tensor of shape (output_length, batch_size)
     :param initial_state: initial state of the decoder (usually the final state of the encoder),
@@ -279,6 +365,8 @@ def attention_decoder(targets, initial_state, attention_states, encoders, decode
     :param dropout: scalar tensor or None, specifying the keep probability (1 - dropout)
     :param feed_previous: scalar tensor corresponding to the probability to use previous decoder output
       instead of the groundtruth as input for the decoder (1 when decoding, between 0 and 1 when training)
+    :param early_exit: boolean scalar tensor, stop the decoding loop as soon as every sequence of the batch
+      has output an EOS symbol (the outputs are then shorter than `targets`). Only useful for greedy decoding.
     :return:
       outputs of the decoder as a tensor of shape (batch_size, output_length, decoder_cell_size)
       attention weights as a tensor of shape (output_length, encoders, batch_size, input_length)
@@ -288,27 +376,8 @@ def attention_decoder(targets, initial_state, attention_states, encoders, decode
 
     decoder_inputs = targets[:-1,:]  # starts with BOS
 
-    if decoder.get('embedding') is not None:
-        initializer = decoder.embedding
-        embedding_shape = None
-    else:
-        initializer = None
-        embedding_shape = [decoder.vocab_size, decoder.embedding_size]
-
-    with tf.device('/cpu:0'):
-        embedding = get_variable_unsafe('embedding_{}'.format(decoder.name), shape=embedding_shape,
-                                        initializer=initializer)
-
-    if decoder.use_lstm:
-        cell = BasicLSTMCell(decoder.cell_size, state_is_tuple=False)
-    else:
-        cell = GRUCell(decoder.cell_size, initializer=orthogonal_initializer())
-
-    if dropout is not None:
-        cell = DropoutWrapper(cell, input_keep_prob=dropout)
-
-    if decoder.layers > 1:
-        cell = MultiRNNCell([cell] * decoder.layers, residual_connections=decoder.residual_connections)
+    embedding = decoder_embedding(decoder)
+    cell = decoder_cell(decoder, dropout)
 
     with tf.variable_scope('decoder_{}'.format(decoder.name)):
         def embed(input_):
@@ -318,13 +387,13 @@ def attention_decoder(targets, initial_state, attention_states, encoders, decode
                 return input_
 
         hidden_states = [tf.expand_dims(states, 2) for states in attention_states]
+        attention_keys = multi_attention_keys(hidden_states, encoders)
         attention_ = functools.partial(multi_attention, hidden_states=hidden_states, encoders=encoders,
-                                       encoder_input_length=encoder_input_length)
+                                       encoder_input_length=encoder_input_length, attention_keys=attention_keys)
 
         input_shape = tf.shape(decoder_inputs)
         time_steps = input_shape[0]
         batch_size = input_shape[1]
-        output_size = decoder.vocab_size
         state_size = cell.state_size
 
         if initial_state is not None:
@@ -347,17 +416,19 @@ def attention_decoder(targets, initial_state, attention_states, encoders, decode
         time = tf.constant(0, dtype=tf.int32, name='time')
         zero_output = tf.zeros(tf.stack([batch_size, cell.output_size]), tf.float32)
 
-        proj_outputs = tf.TensorArray(dtype=tf.float32, size=time_steps, clear_after_read=False)
-        decoder_outputs = tf.TensorArray(dtype=tf.float32, size=time_steps)
+        # the loop can stop before `time_steps` (see `early_exit`), so the output arrays have a dynamic size
+        proj_outputs = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True, clear_after_read=False)
+        decoder_outputs = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
 
         inputs = tf.TensorArray(dtype=tf.int64, size=time_steps, clear_after_read=False).unstack(
                                 tf.cast(decoder_inputs, tf.int64))
-        samples = tf.TensorArray(dtype=tf.int64, size=time_steps, clear_after_read=False)
-        states = tf.TensorArray(dtype=tf.float32, size=time_steps)
+        samples = tf.TensorArray(dtype=tf.int64, size=0, dynamic_size=True, clear_after_read=False)
+        states = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
 
         attn_lengths = [tf.shape(states)[1] for states in attention_states]
 
-        weights = tf.TensorArray(dtype=tf.float32, size=time_steps)
+        weights = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
+        finished = tf.zeros(tf.stack([batch_size]), dtype=tf.bool)   # sequences which have output EOS
         initial_weights = [tf.zeros(tf.stack([batch_size, length])) for length in attn_lengths]
 
         output = tf.zeros(tf.stack([batch_size, cell.output_size]), dtype=tf.float32)
@@ -365,16 +436,12 @@ def attention_decoder(targets, initial_state, attention_states, encoders, decode
         initial_input = embed(inputs.read(0))   # first symbol is BOS
 
         def _time_step(time, input_, state, output, proj_outputs, decoder_outputs, samples, states, weights,
-                       prev_weights):
+                       prev_weights, finished):
             context_vector, new_weights = attention_(state, prev_weights=prev_weights)
             weights = weights.write(time, new_weights)
 
-            # FIXME use `output` or `state` here?
-            output_ = linear_unsafe([state, input_, context_vector], decoder.cell_size, False, scope='maxout')
-            output_ = tf.reduce_max(tf.reshape(output_, tf.stack([batch_size, decoder.cell_size // 2, 2])), axis=2)
-            output_ = linear_unsafe(output_, decoder.embedding_size, False, scope='softmax0')
-            decoder_outputs = decoder_outputs.write(time, output_)
-            output_ = linear_unsafe(output_, output_size, True, scope='softmax1')
+            output_, decoder_output_ = decoder_projection(state, input_, context_vector, decoder)
+            decoder_outputs = decoder_outputs.write(time, decoder_output_)
             proj_outputs = proj_outputs.write(time, output_)
 
             argmax = lambda: tf.argmax(output_, 1)
@@ -391,6 +458,7 @@ def attention_decoder(targets, initial_state, attention_states, encoders, decode
             sample = tf.stop_gradient(sample)
 
             samples = samples.write(time, sample)
+            finished = tf.logical_or(finished, tf.equal(sample, utils.EOS_ID))
             input_ = embed(sample)
 
             x = tf.concat([input_, context_vector], 1)
@@ -413,13 +481,18 @@ def attention_decoder(targets, initial_state, attention_states, encoders, decode
             states = states.write(time, new_state)
 
             return (time + 1, input_, new_state, new_output, proj_outputs, decoder_outputs, samples, states, weights,
-                    new_weights)
+                    new_weights, finished)
 
-        _, _, new_state, new_output, proj_outputs, decoder_outputs, samples, states, weights, _ = tf.while_loop(
-            cond=lambda time, *_: time < time_steps,
+        def _cond(time, *args):
+            finished = args[-1]
+            return tf.logical_and(time < time_steps,
+                                  tf.logical_not(tf.logical_and(early_exit, tf.reduce_all(finished))))
+
+        _, _, new_state, new_output, proj_outputs, decoder_outputs, samples, states, weights, _, _ = tf.while_loop(
+            cond=_cond,
             body=_time_step,
-            loop_vars=(time, initial_input, state, output, proj_outputs, decoder_outputs, samples, weights, states,
-                       initial_weights),
+            loop_vars=(time, initial_input, state, output, proj_outputs, decoder_outputs, samples, states, weights,
+                       initial_weights, finished),
             parallel_iterations=decoder.parallel_iterations,
             swap_memory=decoder.swap_memory)
 
@@ -432,9 +505,173 @@ def attention_decoder(targets, initial_state, attention_states, encoders, decode
         # weights = tf.Print(weights, [weights[:,0]], summarize=20)
         # tf.control_dependencies()
 
-        beam_tensors = namedtuple('beam_tensors', 'state new_state output new_output')
-        return (proj_outputs, weights, decoder_outputs, beam_tensors(state, new_state, output, new_output),
-                samples, states)
+        # `attention_keys` can be fed with cached values, to avoid projecting the attention states again
+        beam_tensors = namedtuple('beam_tensors', 'state new_state output new_output attention_keys')
+        return (proj_outputs, weights, decoder_outputs,
+                beam_tensors(state, new_state, output, new_output, attention_keys), samples, states)
+
+
+def beam_search_decoder(initial_state, attention_states, encoders, decoder, encoder_input_length, beam_size,
+                        max_output_len, early_stopping=True, len_normalization=1.0, temperature=1.0, dropout=None,
+                        **kwargs):
+    """
+    Beam-search decoder which runs entirely inside the graph: a single `tf.while_loop` does the top-k selection
+    and gathers the decoder states of the selected hypotheses, so a batch is decoded with one `session.run`.
+    This uses the same parameters as `attention_decoder` (which has to be created first).
+
+    Each sentence has its own beam. Like `Seq2SeqModel.beam_search_decoding`, the candidates are ranked by
+    negative log probability, a hypothesis which ends with EOS is moved to the finished hypotheses, and with
+    `early_stopping` each finished hypothesis reduces the beam size of its sentence by one. Final scores are
+    divided by `length ** len_normalization`. The `beam_size` best finished hypotheses of each sentence are kept.
+
+    :param initial_state: tensor of shape (batch_size, initial_state_size)
+    :param attention_states: list of tensors of shape (batch_size, input_length, encoder_cell_size)
+    :param beam_size: number of hypotheses for each sentence
+    :param max_output_len: maximum number of output symbols
+    :param early_stopping: boolean scalar (or scalar tensor)
+    :return: hypotheses as a tensor of shape (batch_size, beam_size, max_output_len), padded with EOS,
+      and their scores as a tensor of shape (batch_size, beam_size), sorted from best to worst
+      (unused hypotheses have an infinite score)
+    """
+    embedding = decoder_embedding(decoder)
+    cell = decoder_cell(decoder, dropout)
+
+    with tf.variable_scope('decoder_{}'.format(decoder.name)):
+        batch_size = tf.shape(initial_state)[0]
+        vocab_size = decoder.vocab_size
+        inf = float('inf')
+
+        def tile(tensor):
+            # (batch_size, ...) -> (batch_size * beam_size, ...), each sentence is repeated `beam_size` times
+            dims = tensor.get_shape()[1:]
+            shape = [-1] + [dim.value if dim.value is not None else tf.shape(tensor)[i + 1]
+                            for i, dim in enumerate(dims)]
+            tensor = tf.tile(tf.expand_dims(tensor, 1), [1, beam_size] + [1] * len(dims))
+            return tf.reshape(tensor, tf.stack(shape))
+
+        def batch_gather(params, indices):
+            # params: (batch_size, n, ...), indices: (batch_size, k) -> (batch_size, k, ...)
+            batch_ids = tf.tile(tf.expand_dims(tf.range(batch_size), 1), tf.stack([1, tf.shape(indices)[1]]))
+            return tf.gather_nd(params, tf.stack([batch_ids, indices], axis=2))
+
+        def normalize(scores, length):
+            if len_normalization > 0:
+                scores /= tf.pow(tf.to_float(length), len_normalization)
+            return scores
+
+        def embed(input_):
+            return tf.nn.embedding_lookup(embedding, input_)
+
+        # attention keys are projected before tiling, to do this projection only once per sentence
+        attention_keys = multi_attention_keys([tf.expand_dims(states, 2) for states in attention_states], encoders)
+        attention_keys = [tile(keys) for keys in attention_keys]
+        hidden_states = [tf.expand_dims(tile(states), 2) for states in attention_states]
+        encoder_input_length = [tile(length) for length in encoder_input_length]
+        attention_ = functools.partial(multi_attention, hidden_states=hidden_states, encoders=encoders,
+                                       encoder_input_length=encoder_input_length, attention_keys=attention_keys)
+
+        if dropout is not None:
+            initial_state = tf.nn.dropout(initial_state, dropout)
+
+        state = tf.nn.tanh(
+            linear_unsafe(initial_state, cell.state_size, True, scope='initial_state_projection')
+        )
+        state = tile(state)
+        input_ = tf.fill(tf.shape(state)[:1], utils.BOS_ID)
+        weights = [tf.zeros(tf.stack([tf.shape(state)[0], tf.shape(states)[1]])) for states in attention_states]
+
+        # at the first step, each beam only contains the empty hypothesis
+        alive_scores = tf.tile(tf.constant([[0.0] + [inf] * (beam_size - 1)]), tf.stack([batch_size, 1]))
+        alive_seq = tf.fill(tf.stack([batch_size, beam_size, max_output_len]), utils.EOS_ID)
+        alive_length = tf.zeros(tf.stack([batch_size]), dtype=tf.int32)
+        beam_sizes = tf.fill(tf.stack([batch_size]), beam_size)
+        finished_scores = tf.fill(tf.stack([batch_size, beam_size]), inf)
+        finished_seq = alive_seq
+
+        def _time_step(time, input_, state, weights, alive_scores, alive_seq, alive_length, beam_sizes,
+                       finished_scores, finished_seq):
+            context_vector, new_weights = attention_(state, prev_weights=weights)
+            logits, _ = decoder_projection(state, embed(input_), context_vector, decoder)
+            argmax_tokens = tf.argmax(logits, 1)
+            log_proba = tf.log(tf.maximum(softmax(logits, temperature=temperature), 1e-10))
+            log_proba = tf.reshape(log_proba, [-1, beam_size, vocab_size])
+
+            scores = tf.reshape(tf.expand_dims(alive_scores, 2) - log_proba, [-1, beam_size * vocab_size])
+            # there are at most `beam_size` finished candidates among the 2 * `beam_size` best ones
+            candidate_scores, candidate_ids = tf.nn.top_k(-scores, k=2 * beam_size)
+            candidate_scores = -candidate_scores
+            candidate_parents = candidate_ids // vocab_size
+            candidate_tokens = candidate_ids % vocab_size
+
+            live = tf.logical_and(tf.expand_dims(beam_sizes > 0, 1), tf.is_finite(candidate_scores))
+            is_eos = tf.equal(candidate_tokens, utils.EOS_ID)
+            # candidates are read in order, until the beam of their sentence is full
+            non_eos_count = tf.cumsum(tf.to_int32(tf.logical_not(is_eos)), axis=1)
+            limit = tf.expand_dims(beam_sizes, 1)
+            to_alive = tf.logical_and(live, tf.logical_and(tf.logical_not(is_eos), non_eos_count <= limit))
+            to_finished = tf.logical_and(live, tf.logical_and(is_eos, non_eos_count < limit))
+
+            # move the selected candidates to the first slots of the beam, in the same order
+            positions = tf.tile(tf.expand_dims(tf.range(2 * beam_size), 0), tf.stack([batch_size, 1]))
+            _, slots = tf.nn.top_k(-tf.where(to_alive, positions, positions + 2 * beam_size), k=beam_size)
+            selected = batch_gather(to_alive, slots)
+            new_scores = tf.where(selected, batch_gather(candidate_scores, slots), tf.fill(tf.shape(selected), inf))
+            parents = batch_gather(candidate_parents, slots)
+            tokens = batch_gather(candidate_tokens, slots)
+
+            # hypotheses that end with EOS (the other positions are already EOS)
+            candidate_scores = tf.where(to_finished, normalize(candidate_scores, time + 1),
+                                        tf.fill(tf.shape(candidate_scores), inf))
+            scores = tf.concat([finished_scores, candidate_scores], axis=1)
+            seq = tf.concat([finished_seq, batch_gather(alive_seq, candidate_parents)], axis=1)
+            finished_scores, best_ids = tf.nn.top_k(-scores, k=beam_size)
+            finished_scores = -finished_scores
+            finished_seq = batch_gather(seq, best_ids)
+
+            new_seq = batch_gather(alive_seq, parents)
+            position = tf.reshape(tf.equal(tf.range(max_output_len), time), [1, 1, max_output_len])
+            new_seq = tf.where(tf.tile(position, tf.stack([batch_size, beam_size, 1])),
+                               tf.tile(tf.expand_dims(tokens, 2), [1, 1, max_output_len]), new_seq)
+
+            # sentences whose beam is empty don't change anymore
+            sentence_live = tf.tile(tf.expand_dims(beam_sizes > 0, 1), [1, beam_size])
+            alive_scores = tf.where(sentence_live, new_scores, alive_scores)
+            alive_seq = tf.where(tf.tile(tf.expand_dims(sentence_live, 2), [1, 1, max_output_len]), new_seq, alive_seq)
+            alive_length += tf.to_int32(beam_sizes > 0)
+
+            finished_count = tf.reduce_sum(tf.to_int32(to_finished), axis=1)
+            beam_sizes -= finished_count * tf.to_int32(early_stopping)
+
+            # New state of each hypothesis. Like in `attention_decoder` (and thus in the Python beam-search),
+            # the cell reads the argmax token of its parent's output distribution, while the output layer
+            # of the next step reads the selected token.
+            rows = tf.reshape(parents + tf.expand_dims(tf.range(batch_size) * beam_size, 1), [-1])
+            tokens = tf.reshape(tokens, [-1])
+            x = tf.concat([embed(tf.gather(argmax_tokens, rows)), tf.gather(context_vector, rows)], 1)
+            _, new_state = unsafe_decorator(cell)(x, tf.gather(state, rows))
+            new_weights = [tf.gather(weights_, rows) for weights_ in new_weights]
+
+            return (time + 1, tokens, new_state, new_weights, alive_scores, alive_seq, alive_length, beam_sizes,
+                    finished_scores, finished_seq)
+
+        def _cond(time, input_, state, weights, alive_scores, alive_seq, alive_length, beam_sizes, *args):
+            return tf.logical_and(time < max_output_len, tf.reduce_any(beam_sizes > 0))
+
+        time = tf.constant(0, dtype=tf.int32, name='time')
+        _, _, _, _, alive_scores, alive_seq, alive_length, _, finished_scores, finished_seq = tf.while_loop(
+            cond=_cond,
+            body=_time_step,
+            loop_vars=(time, input_, state, weights, alive_scores, alive_seq, alive_length, beam_sizes,
+                       finished_scores, finished_seq),
+            parallel_iterations=decoder.parallel_iterations,
+            swap_memory=decoder.swap_memory)
+
+        # n-best lists contain the finished hypotheses and the hypotheses that are still in the beam
+        alive_scores = normalize(alive_scores, tf.expand_dims(tf.maximum(alive_length, 1), 1))
+        scores = tf.concat([alive_scores, finished_scores], axis=1)
+        seq = tf.concat([alive_seq, finished_seq], axis=1)
+        scores, best_ids = tf.nn.top_k(-scores, k=beam_size)
+        return batch_gather(seq, best_ids), -scores
 
 
 def sequence_loss(logits, targets, weights, average_across_timesteps=False, average_across_batch=True,
@@ -1,4 +1,3 @@
-import functools
 import subprocess
 import tempfile
 import math
@@ -8,9 +7,125 @@ import os
 
 from collections import Counter, OrderedDict
 from functools import partial
-from translate import pyter
+from translate import ter
 
 
+def _hash_ngrams(sequences, lengths, n):
+    """
+    Hash the n-grams of a batch of sequences into 64-bit integers. The index of the sequence is part of
+    the hash, so that identical n-grams of different sequences have different hashes.
+
+    :param sequences: int array of shape (batch_size, length)
+    :param lengths: actual length of each sequence
+    :return: hashes of shape (batch_size, length - n + 1) (hash at position j is the hash of the n-gram
+      which starts at j), and boolean mask of the same shape (n-grams which are inside the sequences)
+    """
+    batch_size, length = sequences.shape
+    count = max(length - n + 1, 0)
+
+    # FNV-1a hash of (sequence index, token ids)
+    prime = np.uint64(0x100000001b3)
+    hashes = np.full((batch_size, count), 0xcbf29ce484222325, dtype=np.uint64)
+    hashes = (hashes ^ np.arange(batch_size, dtype=np.uint64)[:, None]) * prime
+    for k in range(n):
+        hashes = (hashes ^ sequences[:, k:k + count].astype(np.uint64)) * prime
+
+    mask = np.arange(count)[None, :] + n <= np.asarray(lengths)[:, None]
+    return hashes, mask
+
+
+def batch_sentence_bleu(hypotheses, references, hyp_lengths=None, ref_lengths=None, partial=False,
+                        smoothing=True, order=4, **kwargs):
+    """
+    Vectorized version of `sentence_bleu`, which computes the BLEU scores of a batch of sequences
+    of token ids at once. N-grams are hashed into integers, and their clipped counts are computed with NumPy.
+
+    With `partial`, the scores of all the prefixes of the hypotheses are computed in the same pass
+    (the n-gram matches are accumulated position by position).
+
+    :param hypotheses: int array of shape (batch_size, hyp_length), padded on the right
+    :param references: int array of shape (batch_size, ref_length), padded on the right
+    :param hyp_lengths: actual length of each hypothesis (default: `hyp_length`)
+    :param ref_lengths: actual length of each reference (default: `ref_length`)
+    :param partial: compute the scores of the prefixes of the hypotheses
+    :return: array of shape (batch_size,), or array of shape (batch_size, hyp_length) if `partial` is True,
+      whose column i contains the scores of the prefixes of length i + 1 (prefixes longer than a hypothesis
+      get the score of this hypothesis)
+    """
+    hypotheses = np.asarray(hypotheses)
+    references = np.asarray(references)
+    batch_size, hyp_length = hypotheses.shape
+
+    hyp_lengths = np.full(batch_size, hyp_length) if hyp_lengths is None else np.asarray(hyp_lengths)
+    ref_lengths = np.full(batch_size, references.shape[1]) if ref_lengths is None else np.asarray(ref_lengths)
+    hyp_lengths = np.minimum(hyp_lengths, hyp_length)
+    ref_lengths = np.minimum(ref_lengths, references.shape[1])
+
+    prefix_lengths = np.minimum(np.arange(1, hyp_length + 1)[None, :], hyp_lengths[:, None])
+    log_score = np.zeros((batch_size, hyp_length))
+
+    for n in range(1, order + 1):
+        hyp_hashes, hyp_mask = _hash_ngrams(hypotheses, hyp_lengths, n)
+        ref_hashes, ref_mask = _hash_ngrams(references, ref_lengths, n)
+        ref_keys, ref_counts = np.unique(ref_hashes[ref_mask], return_counts=True)
+
+        batch_ids, positions = np.nonzero(hyp_mask)
+        keys = hyp_hashes[batch_ids, positions]
+
+        # the k-th occurrence of an n-gram in a hypothesis is a match if the reference contains
+        # this n-gram at least k times (clipped counts)
+        indices = np.lexsort((positions, keys))
+        sorted_keys = keys[indices]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        group_start = np.maximum.accumulate(np.where(first, np.arange(len(keys)), 0))
+        rank = np.empty(len(keys), dtype=np.int64)
+        rank[indices] = np.arange(len(keys)) - group_start
+
+        ref_ids = np.minimum(np.searchsorted(ref_keys, keys), max(len(ref_keys) - 1, 0))
+        found = ref_keys[ref_ids] == keys if len(ref_keys) > 0 else np.zeros(len(keys), dtype=bool)
+        ref_count = np.where(found, ref_counts[ref_ids] if len(ref_keys) > 0 else 0, 0)
+
+        # number of matches in each prefix: the match of an n-gram is counted at the position of its last token
+        matches = np.zeros((batch_size, hyp_length))
+        matches[batch_ids, positions + n - 1] = rank < ref_count
+        numerator = np.cumsum(matches, axis=1)
+        denominator = np.maximum(prefix_lengths - n + 1, 0)
+
+        if smoothing:
+            numerator += 1
+            denominator += 1
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_score += np.log(numerator / denominator) / order
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bp = np.minimum(1, np.exp(1 - ref_lengths[:, None] / prefix_lengths))
+        scores = np.exp(log_score) * bp
+
+    # empty hypotheses have a score of 0 (and so do the prefixes without any n-gram, without smoothing)
+    scores[np.isnan(scores) | (prefix_lengths == 0)] = 0
+
+    if partial:
+        return scores
+    elif hyp_length == 0:
+        return np.zeros(batch_size)
+    else:
+        return scores[:, -1]
+
+
+def reward_function_decorator(batch=None):
+    """
+    :param batch: vectorized version of this reward function (with the same interface as `batch_sentence_bleu`),
+      which `Seq2SeqModel.reinforce_step` uses on arrays of token ids
+    """
+    def decorator(func):
+        func.batch = batch
+        return func
+    return decorator
+
+
+@reward_function_decorator(batch=batch_sentence_bleu)
 def sentence_bleu(hypothesis, reference, smoothing=True, order=4, **kwargs):
     """
     Compute sentence-level BLEU score between a translation hypothesis and a reference.
@@ -110,7 +225,7 @@ def corpus_bleu(hypotheses, references, smoothing=False, order=4, **kwargs):
 
 @score_function_decorator(reversed=True)
 def corpus_ter(hypotheses, references, **kwargs):
-    scores = [pyter.ter(hyp.split(), ref.split()) for hyp, ref in zip(hypotheses, references)]
+    scores = ter.batch_ter([hyp.split() for hyp in hypotheses], [ref.split() for ref in references]).tolist()
     score = 100 * sum(scores) / len(scores)
 
     hyp_length = sum(len(hyp.split()) for hyp in hypotheses)
@@ -140,17 +255,18 @@ def corpus_tercom(hypotheses, references, case_sensitive=True, **kwargs):
 
 @score_function_decorator(reversed=True)
 def corpus_wer(hypotheses, references, **kwargs):
-    scores = [
-        levenhstein(tuple(hyp.split()), tuple(ref.split())) / len(ref.split())
-        for hyp, ref in zip(hypotheses, references)
-    ]
+    hypotheses = [hyp.split() for hyp in hypotheses]
+    references = [ref.split() for ref in references]
 
-    score = 100 * sum(scores) / len(scores)
+    ops = edit_operations(hypotheses, references)
+    ref_lengths = np.array([len(ref) for ref in references])
+    score = 100 * np.mean(ops.sum(axis=1) / ref_lengths)
 
-    hyp_length = sum(len(hyp.split()) for hyp in hypotheses)
-    ref_length = sum(len(ref.split()) for ref in references)
+    hyp_length = sum(len(hyp) for hyp in hypotheses)
+    ref_length = ref_lengths.sum()
+    subs, ins, dels = ops.sum(axis=0)
 
-    return score, 'ratio={:.3f}'.format(hyp_length / ref_length)
+    return float(score), 'ratio={:.3f} sub={} ins={} del={}'.format(hyp_length / ref_length, subs, ins, dels)
 
 
 def corpus_scores(hypotheses, references, main='bleu', **kwargs):
@@ -180,19 +296,114 @@ def corpus_scores_wer(*args, **kwargs):
 corpus_scores_bleu = corpus_scores
 
 
-@functools.lru_cache(maxsize=1024)
+def batch_edit_operations(hypotheses, references, hyp_lengths=None, ref_lengths=None, partial=False):
+    """
+    Word-level Levenshtein alignment of a batch of sequences of token ids, with an iterative dynamic programming
+    which only keeps one row of the matrix (for the whole batch) in memory.
+
+    On ties, matches and substitutions are preferred to insertions, which are preferred to deletions.
+
+    :param hypotheses: int array of shape (batch_size, hyp_length), padded on the right
+    :param references: int array of shape (batch_size, ref_length), padded on the right
+    :param hyp_lengths: actual length of each hypothesis (default: `hyp_length`)
+    :param ref_lengths: actual length of each reference (default: `ref_length`)
+    :param partial: compute the alignments of all the prefixes of the hypotheses
+    :return: int array of shape (batch_size, 3), containing the number of substitutions, insertions
+      and deletions, or of shape (batch_size, hyp_length, 3) if `partial` is True (prefixes longer than
+      a hypothesis get the counts of this hypothesis)
+    """
+    hypotheses = np.asarray(hypotheses)
+    references = np.asarray(references)
+    batch_size, hyp_length = hypotheses.shape
+    ref_length = references.shape[1]
+
+    hyp_lengths = np.full(batch_size, hyp_length) if hyp_lengths is None else np.asarray(hyp_lengths)
+    ref_lengths = np.full(batch_size, ref_length) if ref_lengths is None else np.asarray(ref_lengths)
+    hyp_lengths = np.minimum(hyp_lengths, hyp_length)
+    ref_lengths = np.minimum(ref_lengths, ref_length)
+
+    batch_ids = np.arange(batch_size)
+    positions = np.arange(ref_length + 1)
+
+    # operation counts of the current row: aligning the first i hypothesis tokens with the first j reference tokens
+    subs = np.zeros((batch_size, ref_length + 1), dtype=np.int64)
+    ins = np.zeros((batch_size, ref_length + 1), dtype=np.int64)
+    dels = np.tile(positions, (batch_size, 1))
+
+    # counts of the full hypotheses (or of the prefixes of length i + 1 with `partial`)
+    ops = np.stack([np.zeros_like(ref_lengths), np.zeros_like(ref_lengths), ref_lengths], axis=1)
+    prefix_ops = np.zeros((batch_size, hyp_length, 3), dtype=np.int64)
+
+    for i in range(hyp_length):
+        cost = subs + ins + dels
+        mismatch = hypotheses[:, i, None] != references
+
+        # substitution (or match) or insertion of the i-th hypothesis token
+        diagonal = cost[:, :-1] + mismatch
+        vertical = cost[:, 1:] + 1
+        use_diagonal = diagonal <= vertical
+
+        new_subs = subs.copy()
+        new_ins = ins + 1
+        new_dels = dels.copy()
+        new_subs[:, 1:] = np.where(use_diagonal, subs[:, :-1] + mismatch, subs[:, 1:])
+        new_ins[:, 1:] = np.where(use_diagonal, ins[:, :-1], ins[:, 1:] + 1)
+        new_dels[:, 1:] = np.where(use_diagonal, dels[:, :-1], dels[:, 1:])
+
+        # deletions: the best cell of the row is min_{k <= j} (cost[k] + j - k), ties go to the largest k
+        new_cost = new_subs + new_ins + new_dels
+        keys = (new_cost - positions) * (ref_length + 1) + ref_length - positions
+        origin = ref_length - np.minimum.accumulate(keys, axis=1) % (ref_length + 1)
+
+        subs = new_subs[batch_ids[:, None], origin]
+        ins = new_ins[batch_ids[:, None], origin]
+        dels = new_dels[batch_ids[:, None], origin] + positions - origin
+
+        ops_ = np.stack([subs[batch_ids, ref_lengths], ins[batch_ids, ref_lengths], dels[batch_ids, ref_lengths]],
+                        axis=1)
+        ops = np.where((i < hyp_lengths)[:, None], ops_, ops)
+        prefix_ops[:, i] = ops
+
+    return prefix_ops if partial else ops
+
+
+def _token_ids(sequences, vocab):
+    # pads with -1 (which isn't the id of any token)
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    ids = np.full((len(sequences), max(lengths, default=0)), -1, dtype=np.int64)
+    for i, sequence in enumerate(sequences):
+        ids[i, :len(sequence)] = [vocab.setdefault(token, len(vocab)) for token in sequence]
+    return ids, lengths
+
+
+def edit_operations(hypotheses, references, batch_size=256):
+    """
+    Word-level Levenshtein alignment of lists of tokens (see `batch_edit_operations`). Sentences of similar
+    lengths are aligned together.
+
+    :param hypotheses: list of hypotheses (lists of tokens)
+    :param references: list of references (lists of tokens)
+    :return: int array of shape (len(hypotheses), 3) containing the number of substitutions, insertions
+      and deletions in each hypothesis
+    """
+    ops = np.zeros((len(hypotheses), 3), dtype=np.int64)
+    order = sorted(range(len(hypotheses)), key=lambda i: len(hypotheses[i]))
+    vocab = {}
+
+    for k in range(0, len(order), batch_size):
+        indices = order[k:k + batch_size]
+        hyp_ids, hyp_lengths = _token_ids([hypotheses[i] for i in indices], vocab)
+        ref_ids, ref_lengths = _token_ids([references[i] for i in indices], vocab)
+        ops[indices] = batch_edit_operations(hyp_ids, ref_ids, hyp_lengths, ref_lengths)
+
+    return ops
+
+
 def levenhstein(src, trg):
-    # Dynamic programming by memoization
-    if len(src) == 0:
-        return len(trg)
-    elif len(trg) == 0:
-        return len(src)
-
-    return min(
-        int(src[0] != trg[0]) + levenhstein(src[1:], trg[1:]),
-        1 + levenhstein(src[1:], trg),
-        1 + levenhstein(src, trg[1:])
-    )
+    """
+    Word-level edit distance between two sequences of tokens
+    """
+    return int(edit_operations([src], [trg]).sum())
 
 
 # Reward functions
@@ -232,18 +443,38 @@ def ter_reward(hypothesis, reference, **kwargs):
     This is not exactly TER, but 1 - TER,
     which is necessary for this to be a reward function (the higher the better)
     """
-    return 1 - pyter.ter(hypothesis, reference)
+    return 1 - ter.ter(hypothesis, reference)
 
 
+def batch_wer_reward(hypotheses, references, hyp_lengths=None, ref_lengths=None, partial=False, **kwargs):
+    """
+    Vectorized version of `wer_reward` (same interface as `batch_sentence_bleu`)
+    """
+    references = np.asarray(references)
+    ref_lengths = np.full(len(references), references.shape[1]) if ref_lengths is None else np.asarray(ref_lengths)
+    ops = batch_edit_operations(hypotheses, references, hyp_lengths, ref_lengths, partial=partial)
+    ref_lengths = np.maximum(np.minimum(ref_lengths, references.shape[1]), 1)
+    if partial:
+        ref_lengths = ref_lengths[:, None]
+    return 1 - ops.sum(axis=-1) / ref_lengths
+
+
+@reward_function_decorator(batch=batch_wer_reward)
 def wer_reward(hypothesis, reference, **kwargs):
     """
     1 - WER
+
+    :param hypothesis: list of tokens or token ids (or string)
+    :param reference: list of tokens or token ids (or string)
     """
-    reference = tuple(reference.split())
-    hypothesis = tuple(hypothesis.split())
+    if isinstance(reference, str):
+        reference = reference.split()
+    if isinstance(hypothesis, str):
+        hypothesis = hypothesis.split()
 
-    return 1 - levenhstein(hypothesis, reference) / len(reference)
+    return 1 - levenhstein(hypothesis, reference) / max(len(reference), 1)
 
 
+@reward_function_decorator(batch=batch_sentence_bleu)
 def bleu_reward(hypothesis, reference, **kwargs):
     return sentence_bleu(hypothesis, reference)
@@ -3,6 +3,7 @@ import math
 import numpy as np
 from translate import utils
 from translate.translation_model import TranslationModel, BaseTranslationModel
+from translate.translation_model import save_batch_states, load_batch_states
 
 
 class MultiTaskModel(BaseTranslationModel):
@@ -38,19 +39,33 @@ class MultiTaskModel(BaseTranslationModel):
               reward_function=None, use_edits=False, **kwargs):
         utils.log('reading training and development data')
 
+        global_steps = [model.global_step.eval(sess) for model in self.models]
+        # position of the batch iterators at the last checkpoint
+        states = load_batch_states(self.checkpoint_dir, sum(global_steps))
+        if states is None or len(states) != len(self.models):
+            states = [None] * len(self.models)
+
         self.global_step = 0
-        for model in self.models:
-            model.read_data(**kwargs)
+        for model, global_step, state in zip(self.models, global_steps, states):
+            if state is not None and state['step'] != global_step:
+                state = None
+
+            model.read_data(batch_state=state and state['batches'], **kwargs)
             # those parameters are used to track the progress of each task
-            model.loss, model.time, model.steps = 0, 0, 0
+            model.loss, model.time, model.input_time, model.steps = 0, 0, 0, 0
+            model.examples, model.tokens = 0, 0   # used to weight the losses, and to compute the throughput
             model.baseline_loss = 0
             model.previous_losses = []
-            global_step = model.global_step.eval(sess)
-            model.epoch = model.batch_size * global_step // model.train_size
-            model.last_decay = global_step
+            # number of training examples seen so far (used to count epochs, as batches can have variable sizes)
+            model.seen = model.batch_size * global_step if state is None else state['seen']
+            model.epoch = model.seen // model.train_size
+            model.last_decay = model.seen
 
-            for _ in range(global_step):   # read all the data up to this step
-                next(model.batch_iterator)
+            if state is None and global_step > 0:
+                utils.warn('{}no batch iterator state for step {}, reading all the data up to this step'.format(
+                    '{}: '.format(model.name) if model.name else '', global_step))
+                for _ in range(global_step):
+                    next(model.batch_iterator)
 
             self.global_step += global_step
 
@@ -67,6 +82,8 @@ class MultiTaskModel(BaseTranslationModel):
                         baseline_loss = 0
                         utils.log('{} step {} baseline loss {:.4f}'.format(model.name, step, loss))
 
+                model.flush_train_step(sess)
+
         utils.log('starting training')
         while True:
             i = np.random.choice(len(self.models), 1, p=self.ratios)[0]
@@ -75,25 +92,24 @@ class MultiTaskModel(BaseTranslationModel):
             start_time = time.time()
             res = model.train_step(sess, loss_function=loss_function, reward_function=reward_function,
                                    use_edits=use_edits)
-            model.loss += res.loss
-
-            if loss_function == 'reinforce':
-                model.baseline_loss += res.baseline_loss
+            self.add_losses(model, res)
 
             model.time += time.time() - start_time
+            model.input_time += res.input_time
             model.steps += 1
+            model.tokens += res.tokens
+            model.seen += res.size
             self.global_step += 1
-            model_global_step = model.global_step.eval(sess)
 
-            epoch = model.batch_size * model_global_step / model.train_size
+            epoch = model.seen / model.train_size
             model.epoch = int(epoch) + 1
 
             if decay_after_n_epoch is not None and epoch >= decay_after_n_epoch:
-                if decay_every_n_epoch is not None and (model.batch_size * (model_global_step - model.last_decay)
-                                                            >= decay_every_n_epoch * model.train_size):
+                if decay_every_n_epoch is not None and (model.seen - model.last_decay
+                                                        >= decay_every_n_epoch * model.train_size):
                     sess.run(model.learning_rate_decay_op)
                     utils.debug('  decaying learning rate to: {:.4f}'.format(model.learning_rate.eval()))
-                    model.last_decay = model_global_step
+                    model.last_decay = model.seen
 
             if sgd_after_n_epoch is not None and epoch >= sgd_after_n_epoch:
                 if not model.use_sgd:
@@ -101,29 +117,38 @@ class MultiTaskModel(BaseTranslationModel):
                     model.use_sgd = True
 
             if steps_per_checkpoint and self.global_step % steps_per_checkpoint == 0:
+                self.flush(sess)
+
                 for model_ in self.models:
-                    if model_.steps == 0:
+                    if model_.steps == 0 or model_.examples == 0:
                         continue
 
-                    loss_ = model_.loss / model_.steps
+                    loss_ = model_.loss / model_.examples
                     step_time_ = model_.time / model_.steps
+                    tokens_per_sec_ = model_.tokens / model_.time if model_.time > 0 else 0
 
                     if loss_function == 'reinforce':
-                        baseline_loss_ = ' baseline loss {:.4f}'.format(model_.baseline_loss / model_.steps)
+                        baseline_loss_ = ' baseline loss {:.4f}'.format(model_.baseline_loss / model_.examples)
                         model_.baseline_loss = 0
                     else:
                         baseline_loss_ = ''
 
-                    utils.log('{} step {} epoch {} learning rate {:.4f} step-time {:.4f}{} loss {:.4f}'.format(
-                        model_.name, model_.global_step.eval(sess), model.epoch, model_.learning_rate.eval(),
-                        step_time_, baseline_loss_, loss_))
+                    # fraction of the step time that was spent waiting for the input pipeline
+                    input_wait_ = model_.input_time / model_.time if model_.time > 0 else 0
+
+                    utils.log('{} step {} epoch {} learning rate {:.4f} step-time {:.4f} input-wait {:.1%} '
+                              'tokens/s {:.0f}{} loss {:.4f}'.format(model_.name, model_.global_step.eval(sess),
+                                                                     model.epoch, model_.learning_rate.eval(),
+                                                                     step_time_, input_wait_, tokens_per_sec_,
+                                                                     baseline_loss_, loss_))
                     
                     if decay_if_no_progress and len(model_.previous_losses) >= decay_if_no_progress:
                         if loss_ >= max(model_.previous_losses[:decay_if_no_progress]):
                             sess.run(model_.learning_rate_decay_op)
 
                     model_.previous_losses.append(loss_)
-                    model_.loss, model_.time, model_.steps = 0, 0, 0
+                    model_.loss, model_.time, model_.input_time, model_.steps = 0, 0, 0, 0
+                    model_.examples, model_.tokens = 0, 0
                     model_.eval_step(sess)
 
                 self.save(sess)
@@ -161,9 +186,62 @@ class MultiTaskModel(BaseTranslationModel):
 
             if 0 < max_steps <= self.global_step or 0 < max_epochs <= epoch:
                 utils.log('finished training')
-                # TODO: save models
+                self.save(sess)
                 return
 
+    @staticmethod
+    def add_losses(model, res):
+        # losses are averaged over the examples of each batch: weight them by batch size (this isn't always
+        # the current batch: with `reward_workers`, the first REINFORCE step returns no loss, and the next
+        # steps return the loss of the previous batch)
+        model.loss += res.loss * res.loss_size
+        if 'baseline_loss' in res:
+            model.baseline_loss += res.baseline_loss * res.loss_size
+        model.examples += res.loss_size
+
+    def flush(self, sess):
+        """
+        Do the pending REINFORCE updates (see `reward_workers`), so that the parameters include the updates of
+        all the batches seen so far (which is what the batch iterator states assume).
+        """
+        for model in self.models:
+            res = model.flush_train_step(sess)
+            if res is not None and hasattr(model, 'examples'):
+                self.add_losses(model, res)
+
+    def save(self, sess):
+        self.flush(sess)
+        super(MultiTaskModel, self).save(sess)
+
+        if all(hasattr(model, 'seen') for model in self.models):
+            states = [
+                dict(step=model.global_step.eval(sess), seen=model.seen, batches=model.batch_state)
+                for model in self.models
+            ]
+            save_batch_states(self.checkpoint_dir, self.global_step, states)
+
+    def use_translation_cache(self, translation_cache_size=0, translation_cache_file=None, **kwargs):
+        """
+        Cache the translations of the models (see `utils.TranslationCache`). This is only valid when
+        the parameters don't change (i.e., not during training), because the cache entries are
+        identified by the checkpoints loaded by `initialize`.
+
+        :param translation_cache_size: maximum number of translations kept in memory (0 to disable caching)
+        :param translation_cache_file: SQLite database where the translations are also stored
+        """
+        if translation_cache_size <= 0:
+            return
+
+        checkpoint_id = self.checkpoint_id()
+        if checkpoint_id is None:
+            utils.warn('no checkpoint was loaded, translations won\'t be cached')
+            return
+
+        cache = utils.TranslationCache(translation_cache_size, translation_cache_file)
+        for model in self.models:
+            model.translation_cache = cache
+            model.translation_cache_id = checkpoint_id
+
     def decode(self, *args, **kwargs):
         if self.main_task is not None:
             model = next(model for model in self.models if model.name == self.main_task)
@@ -171,6 +249,20 @@ class MultiTaskModel(BaseTranslationModel):
             model = self.models[0]
         return model.decode(*args, **kwargs)
 
+    def serve(self, *args, **kwargs):
+        if self.main_task is not None:
+            model = next(model for model in self.models if model.name == self.main_task)
+        else:
+            model = self.models[0]
+        return model.serve(*args, **kwargs)
+
+    def export(self, *args, **kwargs):
+        if self.main_task is not None:
+            model = next(model for model in self.models if model.name == self.main_task)
+        else:
+            model = self.models[0]
+        return model.export(*args, **kwargs)
+
     def evaluate(self, *args, **kwargs):
         if self.main_task is not None:
             model = next(model for model in self.models if model.name == self.main_task)
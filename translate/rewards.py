@@ -0,0 +1,82 @@
+"""
+Reward service: evaluates the reward functions of `translate.evaluation` on a persistent pool of worker processes,
+for reward functions which are too slow to be called in the training thread (e.g., `ter_reward`).
+
+Rewards are submitted asynchronously: `RewardService.submit` returns immediately, and the rewards are computed
+by the workers while the training thread runs the model. `Seq2SeqModel.reinforce_step` uses this to sample
+the next batch (and the next Monte-Carlo rollouts) while the rewards of the current batch are computed:
+the REINFORCE update of a batch is applied one step later.
+"""
+
+import multiprocessing
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from translate import evaluation
+
+
+def _compute_rewards(reward_function, hypotheses, references):
+    # runs in a worker process
+    reward_function = getattr(evaluation, reward_function)
+    return [reward_function(hypothesis, reference) for hypothesis, reference in zip(hypotheses, references)]
+
+
+class PendingRewards(object):
+    """
+    Rewards which are being computed by a `RewardService`
+    """
+    def __init__(self, futures):
+        self.futures = futures
+
+    def result(self):
+        """
+        :return: array of rewards (blocks until all the rewards are computed)
+        """
+        rewards = [reward for future in self.futures for reward in future.result()]
+        return np.array(rewards, dtype=np.float32)
+
+
+class RewardService(object):
+    """
+    Pool of worker processes which evaluate a reward function with the standard interface
+    `reward_function(hypothesis, reference)`. The processes are started with `spawn` (it isn't safe to fork
+    a process which runs TensorFlow), once for the whole training.
+    """
+    def __init__(self, reward_function, workers):
+        """
+        :param reward_function: name of a reward function in `translate.evaluation`
+        :param workers: number of processes
+        """
+        getattr(evaluation, reward_function)   # fail early if this function doesn't exist
+
+        self.reward_function = reward_function
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, hypotheses, references):
+        """
+        Start computing the rewards of these hypotheses.
+
+        :param hypotheses: list of hypotheses (e.g., lists or arrays of token ids)
+        :param references: list of references
+        :return: a `PendingRewards` object, whose `result` method returns the rewards in the same order
+        """
+        # the caller may reuse its arrays, so they are copied now (they are sent to the workers later)
+        hypotheses = [hypothesis.tolist() if isinstance(hypothesis, np.ndarray) else hypothesis
+                      for hypothesis in hypotheses]
+        references = [reference.tolist() if isinstance(reference, np.ndarray) else reference
+                      for reference in references]
+
+        chunk_size = -(-len(hypotheses) // self.workers) or 1
+        futures = [
+            self.pool.submit(_compute_rewards, self.reward_function, hypotheses[i:i + chunk_size],
+                             references[i:i + chunk_size])
+            for i in range(0, len(hypotheses), chunk_size)
+        ]
+        return PendingRewards(futures)
+
+    def __call__(self, hypotheses, references):
+        return self.submit(hypotheses, references).result()
+
+    def close(self):
+        self.pool.shutdown()
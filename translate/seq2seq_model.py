@@ -18,8 +18,14 @@
 import numpy as np
 import tensorflow as tf
 import re
+import math
+import json
+import threading
+import itertools
 
-from translate import utils, evaluation
+from concurrent.futures import ThreadPoolExecutor
+
+from translate import utils, evaluation, rewards
 from translate import decoders
 from collections import namedtuple
 
@@ -43,7 +49,8 @@ class Seq2SeqModel(object):
                  freeze_variables=None, lm_weight=None, max_output_len=50, feed_previous=0.0,
                  optimizer='sgd', max_input_len=None, decode_only=False, len_normalization=1.0,
                  reinforce_baseline=True, softmax_temperature=1.0, loss_function='xent', rollouts=None,
-                 partial_rewards=False, **kwargs):
+                 partial_rewards=False, beam_size=1, symbolic_beam_search=False, max_output_ratio=None,
+                 reward_workers=0, **kwargs):
         self.lm_weight = lm_weight
         self.encoders = encoders
         self.decoder = decoder
@@ -57,8 +64,15 @@ class Seq2SeqModel(object):
         self.binary_input = [encoder.name for encoder in encoders if encoder.binary]
 
         self.max_output_len = max_output_len
+        self.max_output_ratio = max_output_ratio
         self.max_input_len = max_input_len
+        # preallocated arrays used by `get_batch` (increase `batch_buffer_count` when batches are prefetched)
+        self.batch_buffers = threading.local()
+        self.session_pool = None   # threads used to run the sessions of an ensemble concurrently
+        self.session_pool_size = 0
+        self.batch_buffer_count = 1
         self.len_normalization = len_normalization
+        self.softmax_temperature = softmax_temperature
 
         if dropout_rate > 0:
             self.dropout = tf.Variable(1 - dropout_rate, trainable=False, name='dropout_keep_prob')
@@ -69,6 +83,8 @@ class Seq2SeqModel(object):
 
         self.feed_previous = tf.constant(feed_previous, dtype=tf.float32)
         self.feed_argmax = tf.constant(True, dtype=tf.bool)  # feed with argmax or sample
+        # stop decoding when all the outputs contain EOS (see `greedy_decoding`)
+        self.early_exit = tf.placeholder_with_default(False, shape=[])
 
         self.encoder_inputs = []
         self.encoder_input_length = []
@@ -107,6 +123,9 @@ class Seq2SeqModel(object):
             self.rollouts = rollouts
 
         self.partial_rewards = partial_rewards
+        self.reward_workers = reward_workers
+        self.reward_service = None   # created at the first REINFORCE step (see `get_reward_service`)
+        self.pending_reinforce_step = None   # batch whose rewards are being computed by the reward service
 
         parameters = dict(encoders=encoders, decoder=decoder, dropout=self.dropout,
                           encoder_input_length=self.encoder_input_length, rollouts=1)
@@ -117,11 +136,24 @@ class Seq2SeqModel(object):
          self.sampled_output, self.states) = decoders.attention_decoder(
             attention_states=self.attention_states, initial_state=self.encoder_state,
             targets=self.targets, feed_previous=self.feed_previous,
-            decoder_input_length=self.target_length, feed_argmax=self.feed_argmax, **parameters
+            decoder_input_length=self.target_length, feed_argmax=self.feed_argmax, early_exit=self.early_exit,
+            **parameters
         )
 
         self.beam_output = decoders.softmax(self.outputs[0, :, :], temperature=softmax_temperature)
 
+        self.beam_size = beam_size
+        if symbolic_beam_search:
+            self.beam_search_early_stopping = tf.placeholder_with_default(True, shape=[])
+            self.beam_search_hypotheses, self.beam_search_scores = decoders.beam_search_decoder(
+                initial_state=self.encoder_state, attention_states=self.attention_states, beam_size=beam_size,
+                max_output_len=max_output_len, early_stopping=self.beam_search_early_stopping,
+                len_normalization=len_normalization, temperature=softmax_temperature, **parameters
+            )
+        else:
+            self.beam_search_early_stopping = None
+            self.beam_search_hypotheses, self.beam_search_scores = None, None
+
         optimizers = self.get_optimizers(optimizer, learning_rate)
 
         self.xent_loss, self.reinforce_loss, self.baseline_loss = None, None, None
@@ -198,11 +230,15 @@ class Seq2SeqModel(object):
             else:
                 self.baseline_update_op = tf.constant(0.0)   # dummy tensor
 
-    def step(self, session, data, update_model=True, align=False, use_sgd=False, **kwargs):
+    def step(self, session, data, update_model=True, align=False, use_sgd=False, batch=None, **kwargs):
+        """
+        :param batch: padded version of `data` (output of `get_batch`), if it was already computed
+        """
         if self.dropout is not None:
             session.run(self.dropout_on)
 
-        batch = self.get_batch(data)
+        if batch is None:
+            batch = self.get_batch(data)
         encoder_inputs, targets, encoder_input_length = batch
 
         input_feed = {self.targets: targets}
@@ -223,7 +259,7 @@ class Seq2SeqModel(object):
 
 
     def reinforce_step(self, session, data, update_model=True, update_baseline=True,
-                       use_sgd=False, reward_function=None, use_edits=False, vocabs=None, **kwargs):
+                       use_sgd=False, reward_function=None, use_edits=False, vocabs=None, batch=None, **kwargs):
         assert vocabs or not use_edits
 
         if vocabs:
@@ -233,7 +269,8 @@ class Seq2SeqModel(object):
         if self.dropout is not None:
             session.run(self.dropout_off)
 
-        batch = self.get_batch(data)
+        if batch is None:
+            batch = self.get_batch(data)
         encoder_inputs, targets, encoder_input_length = batch
 
         time_steps = targets.shape[0]
@@ -258,17 +295,23 @@ class Seq2SeqModel(object):
             input_feed[self.encoder_input_length[i]] = encoder_input_length[i]
             input_feed[self.encoder_inputs[i]] = encoder_inputs[i]
 
-        sampled_output, outputs, states = session.run([self.sampled_output, self.outputs, self.states],
-                                                       input_feed)
+        output_feed = [self.sampled_output, self.outputs, self.states]
+        if self.rollouts is not None and self.rollouts > 1:
+            # attention states are fed to the rollouts, so that the encoder runs only once
+            output_feed += [self.attention_states, self.beam_tensors.attention_keys]
+            sampled_output, outputs, states, attention_states, attention_keys = session.run(output_feed, input_feed)
+        else:
+            sampled_output, outputs, states = session.run(output_feed, input_feed)
 
         time_steps = sampled_output.shape[0]
 
         if reward_function is None:
             reward_function = 'sentence_bleu'
 
+        reward_function_name = reward_function
         reward_function = getattr(evaluation, reward_function)
 
-        def compute_reward(output, target, source, partial=False):
+        def prepare(output, target, source):
             j, = np.where(output == utils.EOS_ID)  # array of indices whose value is EOS_ID
             if len(j) > 0:
                 output = output[:j[0]]
@@ -287,62 +330,174 @@ class Seq2SeqModel(object):
                 output = utils.reverse_edit_ids(source, output, src_vocab, trg_vocab)
                 target = utils.reverse_edit_ids(source, target, src_vocab, trg_vocab)
 
-            if partial:
-                reward = [reward_function(output[:i + 1], target) for i in range(len(output))]
-                reward = [0] + reward
-                reward += [reward[-1]] * (time_steps - len(reward) + 1)
-                reward = np.array(reward)
-                return reward[1:] - reward[:-1]
+            return output, target
+
+        def sequence_lengths(sequences):
+            # length of each sequence of a time-major array, up to the first EOS symbol
+            eos = sequences == utils.EOS_ID
+            return np.where(eos.any(axis=0), eos.argmax(axis=0), sequences.shape[0])
+
+        # vectorized reward function, which works directly on arrays of token ids
+        batch_reward_function = getattr(reward_function, 'batch', None)
+        vectorized = batch_reward_function is not None and not use_edits
+        # otherwise, the rewards can be computed in the background by a pool of processes
+        reward_service = None if vectorized else self.get_reward_service(reward_function_name)
+
+        def submit_rewards(outputs, targets, sources=encoder_inputs[0], partial=False):
+            """
+            Start computing the rewards of a batch of outputs (time-major arrays of token ids).
+
+            :return: function which returns the rewards as an array of shape (batch_size,) (or
+              (batch_size, time_steps) with `partial`), and blocks until they are computed
+            """
+            if vectorized:
+                reward = batch_reward_function(outputs.T, targets.T, hyp_lengths=sequence_lengths(outputs),
+                                               ref_lengths=sequence_lengths(targets), partial=partial)
+                if partial:   # difference between the rewards of consecutive prefixes
+                    reward = np.concatenate([np.zeros((outputs.shape[1], 1)), reward], axis=1)
+                    reward = reward[:, 1:] - reward[:, :-1]
+                return lambda: reward
+
+            pairs = [prepare(output, target, source) for output, target, source in zip(outputs.T, targets.T, sources)]
+
+            if partial:   # reward of each prefix of the outputs
+                hypotheses = [output[:i + 1] for output, _ in pairs for i in range(len(output))]
+                references = [target for output, target in pairs for _ in range(len(output))]
             else:
-                return reward_function(output, target)
+                hypotheses = [output for output, _ in pairs]
+                references = [target for _, target in pairs]
 
-        def compute_rewards(outputs, targets, partial=False):
-            return np.array([compute_reward(output, target, source, partial=partial)
-                             for output, target, source in zip(outputs.T, targets.T, encoder_inputs[0])])
+            if reward_service is not None:
+                get_values = reward_service.submit(hypotheses, references).result
+            else:
+                values = [reward_function(hypothesis, reference)
+                          for hypothesis, reference in zip(hypotheses, references)]
+                get_values = lambda: values
+
+            def result():
+                values = get_values()
+                if not partial:
+                    return np.array(values)
+
+                rewards = []
+                start = 0
+                for output, _ in pairs:
+                    reward = [0] + list(values[start:start + len(output)])
+                    reward += [reward[-1]] * (time_steps - len(reward) + 1)
+                    reward = np.array(reward)
+                    rewards.append(reward[1:] - reward[:-1])
+                    start += len(output)
+                return np.array(rewards)
+
+            return result
+
+        def compute_rewards(outputs, targets, sources=encoder_inputs[0], partial=False):
+            return submit_rewards(outputs, targets, sources=sources, partial=partial)()
 
         targets = targets[1:]
 
         if self.rollouts is not None and self.rollouts > 1:
-            rewards = []
-
-            for i in range(time_steps):
-
-                if i == time_steps - 1:
-                    rewards.append(compute_rewards(sampled_output, targets))
-                    continue
-
-                reward = 0
+            # Monte-Carlo rollouts: at each time step i, `rollouts` continuations of the sampled prefix are
+            # sampled in a single run, as a batch of `rollouts * batch_size` sequences (the decoder states
+            # and the attention states are tiled, sequence k of this batch corresponds to sentence k % batch_size)
+            def tile(array, axis=0):
+                return np.concatenate([array] * self.rollouts, axis=axis)
+
+            rollout_feed = {self.feed_previous: 1.0, self.feed_argmax: False}
+            for j in range(self.encoder_count):
+                rollout_feed[self.encoder_input_length[j]] = tile(encoder_input_length[j])
+                rollout_feed[self.attention_states[j]] = tile(attention_states[j])
+                rollout_feed[self.beam_tensors.attention_keys[j]] = tile(attention_keys[j])
+
+            # the rewards of the sampled output (and of the rollouts) are computed by the reward service (if any)
+            # while the next rollouts are sampled
+            last_rewards = submit_rewards(sampled_output, targets)
+            pending_rewards = []
+            rollout_outputs = []
+
+            for i in range(time_steps - 1):
+                prefix = sampled_output[:i + 1]
+                input_ = np.expand_dims(sampled_output[i], axis=0)
+                targets_ = np.concatenate([input_, targets[i + 1:]], axis=0)
+
+                input_feed_ = dict(rollout_feed)
+                input_feed_[self.targets] = tile(targets_, axis=1)
+                input_feed_[self.target_length] = [time_steps - i - 1] * batch_size * self.rollouts
+                input_feed_[self.beam_tensors.state] = tile(states[i])
+
+                outputs_ = session.run(self.sampled_output, input_feed_)
+                outputs_ = np.concatenate([tile(prefix, axis=1), outputs_], axis=0)
+
+                if vectorized:
+                    rollout_outputs.append(outputs_)
+                else:
+                    pending_rewards.append(submit_rewards(outputs_, tile(targets, axis=1),
+                                                          sources=tile(encoder_inputs[0])))
+
+            if rollout_outputs:
+                # rewards of all the rollouts of all the time steps, in one pass
+                rollout_outputs = np.concatenate(rollout_outputs, axis=1)
+                copies = rollout_outputs.shape[1] // batch_size
+                rewards = compute_rewards(rollout_outputs, np.concatenate([targets] * copies, axis=1),
+                                          sources=np.concatenate([encoder_inputs[0]] * copies, axis=0))
+                # average over the rollouts of each time step: (time_steps - 1, batch_size)
+                rewards = list(rewards.reshape([time_steps - 1, self.rollouts, batch_size]).mean(axis=1))
+                # at the last time step, the reward is the reward of the sampled output
+                rewards = np.array(rewards + [last_rewards()])
+                get_rewards = lambda: rewards
+            else:
+                def get_rewards():
+                    rewards = [result().reshape([self.rollouts, batch_size]).mean(axis=0)
+                               for result in pending_rewards]
+                    return np.array(rewards + [last_rewards()])
+        elif self.partial_rewards:
+            pending_rewards = submit_rewards(sampled_output, targets, partial=True)
+            get_rewards = lambda: pending_rewards().T
+        else:
+            pending_rewards = submit_rewards(sampled_output, targets)
+            get_rewards = lambda: np.stack([pending_rewards()] * time_steps)
 
-                for _ in range(self.rollouts):
-                    prefix = sampled_output[:i + 1]
+        input_feed[self.outputs] = outputs
+        input_feed[self.sampled_output] = sampled_output
+        step = (input_feed, get_rewards, update_model, update_baseline, use_sgd)
 
-                    input_ = np.expand_dims(sampled_output[i], axis=0)
-                    targets_ = targets[i + 1:]
-                    targets_ = np.concatenate([input_, targets_], axis=0)
-                    target_length_ = [time_steps - i - 1] * batch_size
+        if reward_service is not None:
+            # Rewards are computed by the reward service while the next batch is sampled: the update
+            # for this batch is done at the next call (with the parameters of the next step), and this call
+            # does the update of the previous batch. The batch arrays are copied, because `get_batch` reuses them.
+            input_feed = {k: np.copy(v) if isinstance(v, np.ndarray) else v for k, v in input_feed.items()}
+            step, self.pending_reinforce_step = self.pending_reinforce_step, (input_feed,) + step[1:]
 
-                    input_feed_ = dict(input_feed)
-                    input_feed_[self.targets] = targets_
-                    input_feed_[self.target_length] = target_length_
-                    input_feed_[self.beam_tensors.state] = states[i]
+            if step is None:   # first step: nothing to update yet
+                return namedtuple('output', 'loss baseline_loss size')(0.0, 0.0, 0)
 
-                    outputs_ = session.run(self.sampled_output, input_feed_)
-                    outputs_ = np.concatenate([prefix, outputs_], axis=0)
+        return self.reinforce_update(session, *step)
 
-                    reward += compute_rewards(outputs_, targets) / self.rollouts
+    def flush_reinforce_step(self, session):
+        """
+        Do the update of the last batch sampled by `reinforce_step` (when the rewards are computed by
+        the reward service, this update is delayed to the next call). This should be called before saving
+        the model, and at the end of training.
 
-                rewards.append(reward)
+        :return: output of `reinforce_update`, or None if there is no pending update
+        """
+        step, self.pending_reinforce_step = self.pending_reinforce_step, None
+        if step is None:
+            return None
+        return self.reinforce_update(session, *step)
 
-            rewards = np.array(rewards)
-        elif self.partial_rewards:
-            rewards = compute_rewards(sampled_output, targets, partial=True).T
-        else:
-            rewards = compute_rewards(sampled_output, targets)
-            rewards = np.stack([rewards] * time_steps)
+    def reinforce_update(self, session, input_feed, get_rewards, update_model=True, update_baseline=True,
+                         use_sgd=False):
+        """
+        Second half of `reinforce_step`: update the model and the baseline with the rewards of a sampled batch.
 
-        input_feed[self.rewards] = rewards
-        input_feed[self.outputs] = outputs
-        input_feed[self.sampled_output] = sampled_output
+        :param input_feed: feed dict of the sampling run (inputs, targets, outputs and sampled outputs)
+        :param get_rewards: function which returns the rewards of this batch (blocks until they are computed)
+        :return: losses of this batch, and its size (with the reward service, this batch isn't the batch given
+          to `reinforce_step`, but the previous one)
+        """
+        input_feed = dict(input_feed)
+        input_feed[self.rewards] = get_rewards()
 
         output_feed = {'loss': self.reinforce_loss, 'baseline_loss': self.baseline_loss}
 
@@ -354,9 +509,17 @@ class Seq2SeqModel(object):
 
         res = session.run(output_feed, input_feed)
 
-        return namedtuple('output', 'loss baseline_loss')(res['loss'], res['baseline_loss'])
+        size = len(input_feed[self.encoder_input_length[0]])
+        return namedtuple('output', 'loss baseline_loss size')(res['loss'], res['baseline_loss'], size)
 
     def greedy_decoding(self, session, token_ids):
+        """
+        Greedy decoding of a batch of sentences. The decoding loop stops as soon as every sentence has
+        output an EOS symbol. If `max_output_ratio` is set, the output length is also limited to this ratio
+        of the longest input of the batch (first encoder).
+
+        :return: array of shape (batch_size, output_length) containing the output token ids
+        """
         if self.dropout is not None:
             session.run(self.dropout_off)
 
@@ -365,7 +528,12 @@ class Seq2SeqModel(object):
         batch = self.get_batch(token_ids, decoding=True)
         encoder_inputs, targets, encoder_input_length = batch
 
-        input_feed = {self.targets: targets, self.feed_previous: 1.0}
+        if self.max_output_ratio:
+            max_output_len = max(1, int(math.ceil(self.max_output_ratio * encoder_input_length[0].max())))
+            if max_output_len < self.max_output_len:
+                targets = np.concatenate([targets[:max_output_len], targets[-1:]])   # BOS... EOS
+
+        input_feed = {self.targets: targets, self.feed_previous: 1.0, self.early_exit: True}
 
         for i in range(self.encoder_count):
             input_feed[self.encoder_input_length[i]] = encoder_input_length[i]
@@ -375,7 +543,68 @@ class Seq2SeqModel(object):
 
         return np.argmax(outputs, axis=2).T
 
+    def run_sessions(self, sessions, fetches, feed_dicts):
+        """
+        Run `fetches` in each session of an ensemble. The sessions are run concurrently by a pool of threads
+        (`session.run` releases the GIL), so that decoding time doesn't grow with the number of models.
+
+        :param sessions: list of sessions (one for each model)
+        :param feed_dicts: list of feed dicts (one for each session), or a single feed dict for all the sessions
+        :return: list of results (one for each session)
+        """
+        if isinstance(feed_dicts, dict):
+            feed_dicts = [feed_dicts] * len(sessions)
+
+        if len(sessions) == 1:
+            return [sessions[0].run(fetches, feed_dicts[0])]
+
+        if self.session_pool is None or self.session_pool_size < len(sessions):
+            if self.session_pool is not None:
+                self.session_pool.shutdown()
+            self.session_pool = ThreadPoolExecutor(max_workers=len(sessions))
+            self.session_pool_size = len(sessions)
+
+        futures = [self.session_pool.submit(session.run, fetches, feed_dict)
+                   for session, feed_dict in zip(sessions, feed_dicts)]
+        return [future.result() for future in futures]
+
+    def get_reward_service(self, reward_function):
+        """
+        :param reward_function: name of a reward function in `evaluation`
+        :return: pool of processes which compute this reward function (see `rewards.RewardService`),
+          or None if `reward_workers` is 0
+        """
+        if not self.reward_workers:
+            return None
+
+        if self.reward_service is None or self.reward_service.reward_function != reward_function:
+            if self.reward_service is not None:
+                self.reward_service.close()
+            self.reward_service = rewards.RewardService(reward_function, workers=self.reward_workers)
+
+        return self.reward_service
+
     def beam_search_decoding(self, session, token_ids, beam_size, ngrams=None, early_stopping=True):
+        """
+        Beam search decoding of a single sentence (see `batch_beam_search_decoding`)
+
+        :return: pair (hypotheses, scores) sorted by score (best hypothesis first)
+        """
+        return self.batch_beam_search_decoding(session, [token_ids], beam_size, ngrams=ngrams,
+                                               early_stopping=early_stopping)[0]
+
+    def batch_beam_search_decoding(self, session, token_ids, beam_size, ngrams=None, early_stopping=True):
+        """
+        Beam search decoding of a batch of sentences. The hypotheses of all the sentences are expanded
+        together, as one (batch x beam) matrix of hypotheses, with a single `session.run` per output step.
+        However each sentence keeps its own beam, finished hypotheses and early stopping, so the n-best list
+        of a sentence is the same as when it is decoded alone.
+
+        :param session: a session, or a list of sessions (ensemble of models)
+        :param token_ids: list of inputs (each input is a list of token ids for each encoder)
+        :param ngrams: language model used to rescore the hypotheses (`utils.NgramScorer`), or None
+        :return: list of pairs (hypotheses, scores) sorted by score (best hypothesis first), one for each input
+        """
         # TODO: implement Post-Editing Penalty (PEP)
         # penalty of -1 for each new word in the output w.r.t. the input
 
@@ -383,10 +612,9 @@ class Seq2SeqModel(object):
             session = [session]
 
         if self.dropout is not None:
-            for session_ in session:
-                session_.run(self.dropout_off)
+            self.run_sessions(session, self.dropout_off, {})
 
-        data = [token_ids + [[]]]
+        data = [token_ids_ + [[]] for token_ids_ in token_ids]
         batch = self.get_batch(data, decoding=True)
         encoder_inputs, targets, encoder_input_length = batch
         input_feed = {}
@@ -395,21 +623,26 @@ class Seq2SeqModel(object):
             input_feed[self.encoder_input_length[i]] = encoder_input_length[i]
             input_feed[self.encoder_inputs[i]] = encoder_inputs[i]
 
-        output_feed = [self.encoder_state] + self.attention_states
-        res = [session_.run(output_feed, input_feed) for session_ in session]
-        state, attn_states = list(zip(*[(res_[0], res_[1:]) for res_ in res]))
+        # the projection of the attention states by the attention model is computed once, and fed at each step
+        output_feed = [self.encoder_state] + self.attention_states + self.beam_tensors.attention_keys
+        res = self.run_sessions(session, output_feed, input_feed)
+        state, attn_states, attn_keys = list(zip(*[
+            (res_[0], res_[1:1 + self.encoder_count], res_[1 + self.encoder_count:]) for res_ in res
+        ]))
 
         targets = targets[0]  # BOS symbol
 
-        finished_hypotheses = []
-        finished_scores = []
-
-        hypotheses = [[]]
-        scores = np.zeros([1], dtype=np.float32)
+        # one beam for each sentence, whose hypotheses are the rows of `sentence_ids`
+        beams = [
+            utils.AttrDict(hypotheses=[[]], scores=np.zeros([1], dtype=np.float32), beam_size=beam_size,
+                           finished_hypotheses=[], finished_scores=[])
+            for _ in token_ids
+        ]
+        sentence_ids = np.arange(len(token_ids))   # sentence of each hypothesis
 
         # for initial state projection
-        state = [session_.run(self.beam_tensors.state, {self.encoder_state: state_})
-                 for session_, state_ in zip(session, state)]
+        state = self.run_sessions(session, self.beam_tensors.state,
+                                  [{self.encoder_state: state_} for state_ in state])
         output = None
 
         for i in range(self.max_output_len):
@@ -426,18 +659,19 @@ class Seq2SeqModel(object):
                 }
                 for state_ in state
             ]
-            
+
             for feed in input_feed:
                 for j in range(self.encoder_count):
-                    feed[self.encoder_input_length[j]] = encoder_input_length[j]
+                    feed[self.encoder_input_length[j]] = encoder_input_length[j][sentence_ids]
 
             if i > 0:
                 for input_feed_, output_ in zip(input_feed, output):
                     input_feed_[self.beam_tensors.output] = output_
 
-            for input_feed_, attn_states_ in zip(input_feed, attn_states):
+            for input_feed_, attn_states_, attn_keys_ in zip(input_feed, attn_states, attn_keys):
                 for j in range(self.encoder_count):
-                    input_feed_[self.attention_states[j]] = attn_states_[j].repeat(batch_size, axis=0)
+                    input_feed_[self.attention_states[j]] = attn_states_[j][sentence_ids]
+                    input_feed_[self.beam_tensors.attention_keys[j]] = attn_keys_[j][sentence_ids]
 
             output_feed = namedtuple('beam_output', 'output state proba')(
                 self.beam_tensors.new_output,
@@ -445,162 +679,407 @@ class Seq2SeqModel(object):
                 self.beam_output
             )
 
-            res = [session_.run(output_feed, input_feed_) for session_, input_feed_ in zip(session, input_feed)]
+            # the models of an ensemble are run concurrently
+            res = self.run_sessions(session, output_feed, input_feed)
 
             res_transpose = list(
                 zip(*[(res_.output, res_.state, res_.proba) for res_ in res])
             )
 
             output, state, proba = res_transpose
-            # hypotheses, list of tokens ids of shape (beam_size, previous_len)
-            # proba, shape=(beam_size, trg_vocab_size)
-            # state, shape=(beam_size, cell.state_size)
-            # attention_weights, shape=(beam_size, max_len)
+            # hypotheses, list of tokens ids of shape (batch_size * beam_size, previous_len)
+            # proba, shape=(batch_size * beam_size, trg_vocab_size)
+            # state, shape=(batch_size * beam_size, cell.state_size)
+            # attention_weights, shape=(batch_size * beam_size, max_len)
+
+            live_beams = [beam for beam in beams if beam.beam_size > 0]
+            hypotheses = [hypothesis for beam in live_beams for hypothesis in beam.hypotheses]
 
             if ngrams is not None:
-                lm_score = []
-                lm_order = len(ngrams)
-
-                for hypothesis in hypotheses:
-                    # not sure about this (should we put <s> at the beginning?)
-                    hypothesis = [utils.BOS_ID] + hypothesis
-                    history = hypothesis[1 - lm_order:]
-                    score_ = []
-
-                    for token_id in range(self.trg_vocab_size):
-                        # if token is not in unigrams, this means that either there is something
-                        # wrong with the ngrams (e.g. trained on wrong file),
-                        # or trg_vocab_size is larger than actual vocabulary
-                        if (token_id,) not in ngrams[0]:
-                            prob = float('-inf')
-                        elif token_id == utils.BOS_ID:
-                            prob = float('-inf')
-                        else:
-                            prob = utils.estimate_lm_score(history + [token_id], ngrams)
-                        score_.append(prob)
-
-                    lm_score.append(score_)
-                lm_score = np.array(lm_score, dtype=np.float32)
+                # not sure about this (should we put <s> at the beginning?)
+                # if a token is not in the unigrams (score of -inf), this means that either there is something
+                # wrong with the ngrams (e.g. trained on wrong file), or trg_vocab_size is larger than
+                # actual vocabulary
+                lm_score = np.array([ngrams([utils.BOS_ID] + hypothesis) for hypothesis in hypotheses],
+                                    dtype=np.float32)
+                lm_score = lm_score.reshape([len(hypotheses), self.trg_vocab_size])
+                lm_score[:, utils.BOS_ID] = float('-inf')
                 lm_weight = self.lm_weight or 0.2
                 weights = [(1 - lm_weight) / len(session)] * len(session) + [lm_weight]
             else:
+                # a row of zeros, which is broadcast to all the hypotheses
                 lm_score = np.zeros((1, self.trg_vocab_size))
                 weights = None
 
             proba = [np.maximum(proba_, 1e-10) for proba_ in proba]
-            scores_ = scores[:, None] - np.average([np.log(proba_) for proba_ in proba] +
-                                                   [lm_score], axis=0, weights=weights)
-            scores_ = scores_.flatten()
-            flat_ids = np.argsort(scores_)
-
-            token_ids_ = flat_ids % self.trg_vocab_size
-            hyp_ids = flat_ids // self.trg_vocab_size
-
-            new_hypotheses = []
-            new_scores = []
-            new_state = [[] for _ in session]
-            new_output = [[] for _ in session]
+            log_proba = [np.log(proba_) for proba_ in proba]
+            lm_score = np.broadcast_to(lm_score, log_proba[0].shape)
+            scores = np.concatenate([beam.scores for beam in live_beams])
+            scores_ = scores[:, None] - np.average(log_proba + [lm_score], axis=0, weights=weights)
+
+            new_hyp_ids = []
             new_input = []
-            new_beam_size = beam_size
+            start = 0
+
+            for beam in live_beams:
+                # hypotheses of this sentence are the rows `start:end` of the hypothesis matrix
+                end = start + len(beam.hypotheses)
+                beam_scores = scores_[start:end].ravel()
+                # at most `len(beam.hypotheses)` candidates are finished (one per hypothesis), so the loop below
+                # never reads more than `beam.beam_size + len(beam.hypotheses)` candidates
+                flat_ids = utils.partial_argsort(beam_scores, beam.beam_size + len(beam.hypotheses))
+
+                token_ids_ = flat_ids % self.trg_vocab_size
+                hyp_ids = flat_ids // self.trg_vocab_size
+
+                new_hypotheses = []
+                new_scores = []
+                new_beam_size = beam.beam_size
+
+                for flat_id, hyp_id, token_id in zip(flat_ids, hyp_ids, token_ids_):
+                    hypothesis = beam.hypotheses[hyp_id] + [token_id]
+                    score = beam_scores[flat_id]
+
+                    if token_id == utils.EOS_ID:
+                        # hypothesis is finished, it is thus unnecessary to keep expanding it
+                        beam.finished_hypotheses.append(hypothesis)
+                        beam.finished_scores.append(score)
+
+                        # early stop: number of possible hypotheses is reduced by one
+                        if early_stopping:
+                            new_beam_size -= 1
+                    else:
+                        new_hypotheses.append(hypothesis)
+                        new_scores.append(score)
+                        new_hyp_ids.append(start + hyp_id)
+                        new_input.append(token_id)
+
+                    if len(new_hypotheses) == beam.beam_size:
+                        break
+
+                beam.beam_size = new_beam_size
+                beam.hypotheses = new_hypotheses
+                beam.scores = np.array(new_scores)
+                start = end
+
+                if beam.beam_size <= 0:
+                    # this sentence is finished: its remaining hypotheses are not expanded anymore
+                    new_hyp_ids = new_hyp_ids[:len(new_hyp_ids) - len(new_hypotheses)]
+                    new_input = new_input[:len(new_input) - len(new_hypotheses)]
+
+            if not new_hyp_ids:
+                break
 
-            for flat_id, hyp_id, token_id in zip(flat_ids, hyp_ids, token_ids_):
-                hypothesis = hypotheses[hyp_id] + [token_id]
-                score = scores_[flat_id]
+            new_hyp_ids = np.array(new_hyp_ids)
+            state = [state_[new_hyp_ids] for state_ in state]
+            output = [output_[new_hyp_ids] for output_ in output]
+            sentence_ids = sentence_ids[new_hyp_ids]
+            targets = np.array(new_input, dtype=np.int32)
 
-                if token_id == utils.EOS_ID:
-                    # hypothesis is finished, it is thus unnecessary to keep expanding it
-                    finished_hypotheses.append(hypothesis)
-                    finished_scores.append(score)
+        n_best = []
+        for beam in beams:
+            hypotheses = beam.hypotheses + beam.finished_hypotheses
+            scores = np.concatenate([beam.scores, beam.finished_scores])
 
-                    # early stop: number of possible hypotheses is reduced by one
-                    if early_stopping:
-                        new_beam_size -= 1
-                else:
-                    new_hypotheses.append(hypothesis)
+            if self.len_normalization > 0:  # normalize score by length (to encourage longer sentences)
+                scores /= [len(hypothesis) ** self.len_normalization for hypothesis in hypotheses]
 
-                    for session_id, state_, in enumerate(state):
-                        new_state[session_id].append(state_[hyp_id])
-                        new_output[session_id].append(output[session_id][hyp_id])
+            # sort best-list by score
+            sorted_idx = np.argsort(scores)
+            hypotheses = [hypotheses[i] for i in sorted_idx]
+            scores = scores[sorted_idx].tolist()
+            n_best.append((hypotheses, scores))
 
-                    new_scores.append(score)
-                    new_input.append(token_id)
+        return n_best
 
-                if len(new_hypotheses) == beam_size:
-                    break
+    def symbolic_beam_search_decoding(self, session, token_ids, early_stopping=True):
+        """
+        Same as `batch_beam_search_decoding`, except that the search runs inside the graph
+        (see `decoders.beam_search_decoder`) with a single `session.run` for the whole batch.
+        The beam size is fixed when the graph is created, and ensembles and language models are not supported.
 
-            beam_size = new_beam_size
-            hypotheses = new_hypotheses
-            state = [np.array(new_state_) for new_state_ in new_state]
-            output = [np.array(new_output_) for new_output_ in new_output]
-            scores = np.array(new_scores)
-            targets = np.array(new_input, dtype=np.int32)
+        :return: list of pairs (hypotheses, scores) sorted by score (best hypothesis first), one for each input
+        """
+        if self.dropout is not None:
+            session.run(self.dropout_off)
 
-            if beam_size <= 0:
-                break
+        data = [token_ids_ + [[]] for token_ids_ in token_ids]
+        encoder_inputs, _, encoder_input_length = self.get_batch(data, decoding=True)
+        input_feed = {self.beam_search_early_stopping: early_stopping}
+
+        for i in range(self.encoder_count):
+            input_feed[self.encoder_input_length[i]] = encoder_input_length[i]
+            input_feed[self.encoder_inputs[i]] = encoder_inputs[i]
+
+        hypotheses, scores = session.run([self.beam_search_hypotheses, self.beam_search_scores], input_feed)
+
+        n_best = []
+        for hypotheses_, scores_ in zip(hypotheses, scores):
+            hypotheses_ = [
+                hypothesis[:list(hypothesis).index(utils.EOS_ID) + 1] if utils.EOS_ID in hypothesis
+                else hypothesis for hypothesis, score in zip(hypotheses_.tolist(), scores_) if np.isfinite(score)
+            ]
+            n_best.append((hypotheses_, scores_[np.isfinite(scores_)].tolist()))
+
+        return n_best
+
+    def get_buffer(self, name, shape, dtype):
+        """
+        Get an array of shape `shape`, which is a view into a preallocated buffer.
+
+        Buffers are local to each thread. For each name, dtype and trailing dimensions (after the batch and
+        time dimensions), a thread cycles through `batch_buffer_count` buffers, which means that the content
+        of an array is only valid until `batch_buffer_count` more arrays of the same kind are requested
+        by this thread. Buffers only grow (when a batch doesn't fit), so memory is bounded by
+        `batch_buffer_count` times the largest batch.
+        """
+        key = (name, np.dtype(dtype).str, tuple(shape[2:]))
 
-        hypotheses += finished_hypotheses
-        scores = np.concatenate([scores, finished_scores])
+        if not hasattr(self.batch_buffers, 'pools'):
+            self.batch_buffers.pools = {}
+        buffers, count = self.batch_buffers.pools.get(key, ([], 0))
 
-        if self.len_normalization > 0:  # normalize score by length (to encourage longer sentences)
-            scores /= [len(hypothesis) ** self.len_normalization for hypothesis in hypotheses]
+        if len(buffers) < self.batch_buffer_count:
+            buffers.append(np.empty([0] * len(shape), dtype=dtype))
+        index = count % len(buffers)
+        buffer = buffers[index]
 
-        # sort best-list by score
-        sorted_idx = np.argsort(scores)
-        hypotheses = np.array(hypotheses)[sorted_idx].tolist()
-        scores = scores[sorted_idx].tolist()
-        return hypotheses, scores
+        if any(dim > size for dim, size in zip(shape[:2], buffer.shape[:2])):
+            # grow the buffer (rounded up to a multiple of 8, to limit the number of reallocations)
+            new_shape = tuple(max(size, -(-dim // 8) * 8) for dim, size in zip(shape[:2], buffer.shape[:2]))
+            buffer = buffers[index] = np.empty(new_shape + tuple(shape[2:]), dtype=dtype)
+
+        self.batch_buffers.pools[key] = (buffers, count + 1)
+
+        return buffer[tuple(slice(dim) for dim in shape)]
 
     def get_batch(self, data, decoding=False):
         """
-        :param data:
+        Pad a list of examples into arrays that can be fed to the model. The sequences
+        are written directly into buffers returned by `get_buffer`, which are reused by the next
+        calls (so the arrays should not be kept after the batch has been fed to the model).
+
+        :param data: list of examples (each example is a list of sequences: one for each encoder,
+          and one for the decoder)
         :param decoding: set this parameter to True to output dummy
           data for the decoder side (using the maximum output size)
-        :return:
+        :return: list of input arrays (one for each encoder) of shape (batch_size, time) (or
+          (batch_size, time, dimension) for binary inputs), target array of shape (time, batch_size),
+          and list of input length arrays (one for each encoder) of shape (batch_size)
         """
-        inputs = [[] for _ in range(self.encoder_count)]
-        input_length = [[] for _ in range(self.encoder_count)]
-        targets = []
-
-        # maximum input length of each encoder in this batch
-        max_input_len = [max(len(data_[i]) for data_ in data) for i in range(self.encoder_count)]
-        if self.max_input_len is not None:
-            max_input_len = [min(len_, self.max_input_len) for len_ in max_input_len]
-
-        # maximum output length in this batch
-        max_output_len = min(max(len(data_[-1]) for data_ in data), self.max_output_len)
-
-        for *src_sentences, trg_sentence in data:
-            for i, (encoder, src_sentence) in enumerate(zip(self.encoders, src_sentences)):
-                if encoder.binary:
-                    # when using binary input, the input sequence is a sequence of vectors,
-                    # instead of a sequence of indices
-                    pad = np.zeros([encoder.embedding_size], dtype=np.float32)
-                else:
-                    pad = utils.EOS_ID
+        batch_size = len(data)
+        inputs = []
+        input_length = []
+
+        for i, encoder in enumerate(self.encoders):
+            lengths = np.array([len(data_[i]) for data_ in data], dtype=np.int32)
+            if self.max_input_len is not None:
+                np.minimum(lengths, self.max_input_len, out=lengths)
+            # maximum input length of this encoder in this batch
+            max_input_len = lengths.max()
+
+            # sequences are padded with at least one symbol
+            if encoder.binary:
+                # when using binary input, the input sequence is a sequence of vectors,
+                # instead of a sequence of indices
+                inputs_ = self.get_buffer('encoder_{}'.format(i), (batch_size, max_input_len + 1,
+                                                                   encoder.embedding_size), np.float32)
+                inputs_.fill(0)
+                for j, (data_, length) in enumerate(zip(data, lengths)):
+                    if length > 0:
+                        inputs_[j, :length] = data_[i][:length]
+            else:
+                inputs_ = self.get_buffer('encoder_{}'.format(i), (batch_size, max_input_len + 1), np.int32)
+                inputs_.fill(utils.EOS_ID)
+                mask = np.arange(max_input_len + 1) < lengths[:, None]
+                inputs_[mask] = concatenate_sequences([data_[i] for data_ in data], lengths)
+
+            inputs.append(inputs_)
+            input_length.append(lengths + 1)
+
+        if decoding:
+            targets = self.get_buffer('targets', (batch_size, self.max_output_len + 1), np.int32)
+            targets.fill(utils.BOS_ID)
+            targets[:, -1] = utils.EOS_ID
+        else:
+            lengths = np.array([len(data_[-1]) for data_ in data], dtype=np.int32)
+            np.minimum(lengths, self.max_output_len, out=lengths)
+            # maximum output length in this batch
+            max_output_len = lengths.max()
+
+            targets = self.get_buffer('targets', (batch_size, max_output_len + 2), np.int32)
+            targets.fill(utils.EOS_ID)
+            targets[:, 0] = utils.BOS_ID
+            mask = np.arange(max_output_len + 1) < lengths[:, None]
+            targets[:, 1:][mask] = concatenate_sequences([data_[-1] for data_ in data], lengths)
+
+        # starts with BOS and ends with EOS, shape is (time, batch_size)
+        targets = targets.T
+
+        return inputs, targets, input_length
+
+    def inference_tensors(self):
+        """
+        Tensors used by the decoding methods, which are kept in the exported graph (see `export`)
+
+        :return: dict mapping names to tensors (or lists of tensors)
+        """
+        tensors = {
+            'encoder_inputs': self.encoder_inputs,
+            'encoder_input_length': self.encoder_input_length,
+            'targets': self.targets,
+            'target_length': self.target_length,
+            'feed_previous': self.feed_previous,
+            'early_exit': self.early_exit,
+            'outputs': self.outputs,
+            'encoder_state': self.encoder_state,
+            'attention_states': self.attention_states,
+            'beam_output': self.beam_output,
+        }
+        for field, value in zip(self.beam_tensors._fields, self.beam_tensors):
+            tensors['beam_tensors.{}'.format(field)] = value
+
+        if self.beam_search_hypotheses is not None:
+            tensors['beam_search_early_stopping'] = self.beam_search_early_stopping
+            tensors['beam_search_hypotheses'] = self.beam_search_hypotheses
+            tensors['beam_search_scores'] = self.beam_search_scores
+
+        return tensors
+
+    def export(self, session, filename):
+        """
+        Export an inference-only version of this model, which can be loaded by `FrozenSeq2SeqModel`.
+        The graph is pruned to the tensors used for decoding (no optimizer, gradients or training losses),
+        and the variables are replaced by constants with their current values.
+
+        The graph is written to `filename` (binary GraphDef), and the tensor names and model settings
+        to `filename.json`.
+        """
+        if self.dropout is not None:
+            session.run(self.dropout_off)
+
+        tensors = self.inference_tensors()
+        flat_tensors = [tensor for value in tensors.values()
+                        for tensor in (value if isinstance(value, list) else [value])]
+        output_names = sorted(set(tensor.op.name for tensor in flat_tensors))
+
+        graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(),
+                                                                 output_names)
+
+        info = {
+            'tensors': {name: [tensor.name for tensor in value] if isinstance(value, list) else value.name
+                        for name, value in tensors.items()},
+            'encoders': [{'name': encoder.name, 'binary': encoder.binary, 'embedding_size': encoder.embedding_size}
+                         for encoder in self.encoders],
+            'decoder': {'name': self.decoder.name, 'vocab_size': self.decoder.vocab_size},
+            'max_output_len': self.max_output_len,
+            'max_input_len': self.max_input_len,
+            'max_output_ratio': self.max_output_ratio,
+            'lm_weight': self.lm_weight,
+            'len_normalization': self.len_normalization,
+            'softmax_temperature': self.softmax_temperature,
+            'beam_size': self.beam_size,
+        }
+
+        with open(filename, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        with open(filename + '.json', 'w') as f:
+            json.dump(info, f, indent=2)
+
+        utils.log('exported graph to {} ({} nodes)'.format(filename, len(graph_def.node)))
 
-                # pad sequences so that all sequences in the same batch have the same length
-                src_sentence = src_sentence[:max_input_len[i]]
-                encoder_pad = [pad] * (1 + max_input_len[i] - len(src_sentence))
 
-                inputs[i].append(src_sentence + encoder_pad)
-                input_length[i].append(len(src_sentence) + 1)
 
-            trg_sentence = trg_sentence[:max_output_len]
-            if decoding:
-                targets.append([utils.BOS_ID] * self.max_output_len + [utils.EOS_ID])
+class FrozenSeq2SeqModel(Seq2SeqModel):
+    """
+    Inference-only model loaded from a graph exported by `Seq2SeqModel.export`. Its parameters
+    are constants, so there is nothing to initialize or restore. This model has the same decoding
+    methods as `Seq2SeqModel` (`greedy_decoding`, `batch_beam_search_decoding` and
+    `symbolic_beam_search_decoding`), but no training method.
+    """
+    def __init__(self, filename, lm_weight=None, len_normalization=None, max_output_ratio=None, scope='frozen',
+                 **kwargs):
+        """
+        :param filename: graph file written by `Seq2SeqModel.export`
+        :param lm_weight: decoding settings which are not part of the graph (by default, the exported values)
+        :param scope: name scope of the imported graph
+        """
+        with open(filename + '.json') as f:
+            info = json.load(f)
+
+        graph_def = tf.GraphDef()
+        with open(filename, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        tf.import_graph_def(graph_def, name=scope)
+        graph = tf.get_default_graph()
+
+        def get_tensor(name):
+            if name is None:
+                return None
+            elif isinstance(name, list):
+                return [get_tensor(name_) for name_ in name]
             else:
-                decoder_pad_size = max_output_len - len(trg_sentence) + 1
-                trg_sentence = [utils.BOS_ID] + trg_sentence + [utils.EOS_ID] * decoder_pad_size
-                targets.append(trg_sentence)
+                return graph.get_tensor_by_name('{}/{}'.format(scope, name))
+
+        tensors = {name: get_tensor(value) for name, value in info['tensors'].items()}
+
+        self.encoders = [utils.AttrDict(encoder) for encoder in info['encoders']]
+        self.decoder = utils.AttrDict(info['decoder'])
+        self.encoder_count = len(self.encoders)
+        self.trg_vocab_size = self.decoder.vocab_size
+        self.binary_input = [encoder.name for encoder in self.encoders if encoder.binary]
+
+        self.max_output_len = info['max_output_len']
+        self.max_input_len = info['max_input_len']
+        self.max_output_ratio = max_output_ratio if max_output_ratio is not None else info['max_output_ratio']
+        self.lm_weight = lm_weight if lm_weight is not None else info['lm_weight']
+        self.len_normalization = (len_normalization if len_normalization is not None
+                                  else info['len_normalization'])
+        self.softmax_temperature = info['softmax_temperature']   # can't be changed after export
+        self.beam_size = info['beam_size']
+
+        self.batch_buffers = threading.local()
+        self.batch_buffer_count = 1
+        self.session_pool = None
+        self.session_pool_size = 0
+        self.dropout = None   # dropout was turned off before export
+
+        self.encoder_inputs = tensors['encoder_inputs']
+        self.encoder_input_length = tensors['encoder_input_length']
+        self.targets = tensors['targets']
+        self.target_length = tensors['target_length']
+        self.feed_previous = tensors['feed_previous']
+        self.early_exit = tensors['early_exit']
+        self.outputs = tensors['outputs']
+        self.encoder_state = tensors['encoder_state']
+        self.attention_states = tensors['attention_states']
+        self.beam_output = tensors['beam_output']
+
+        fields = [name.split('.', 1)[1] for name in sorted(tensors) if name.startswith('beam_tensors.')]
+        self.beam_tensors = namedtuple('beam_tensors', fields)(
+            *[tensors['beam_tensors.{}'.format(field)] for field in fields]
+        )
 
-        # convert lists to numpy arrays
-        input_length = [np.array(input_length_, dtype=np.int32) for input_length_ in input_length]
-        inputs = [
-            np.array(inputs_, dtype=(np.float32 if ext in self.binary_input else np.int32))
-            for ext, inputs_ in zip(self.encoder_names, inputs)
-        ]  # for binary input, the data type is float32
+        self.beam_search_early_stopping = tensors.get('beam_search_early_stopping')
+        self.beam_search_hypotheses = tensors.get('beam_search_hypotheses')
+        self.beam_search_scores = tensors.get('beam_search_scores')
 
-        # starts with BOS and ends with EOS, shape is (time, batch_size)
-        targets = np.array(targets).T
+    def step(self, *args, **kwargs):
+        raise NotImplementedError('frozen models can only be used for decoding')
 
-        return inputs, targets, input_length
+    def reinforce_step(self, *args, **kwargs):
+        raise NotImplementedError('frozen models can only be used for decoding')
+
+
+def concatenate_sequences(sequences, lengths):
+    """
+    Concatenate the first `lengths[i]` token ids of each sequence into a flat int32 array.
+    Sequences can be lists or arrays (e.g. views into a compiled corpus).
+    """
+    if len(sequences) > 0 and isinstance(sequences[0], np.ndarray):
+        return np.concatenate([sequence[:length] for sequence, length in zip(sequences, lengths)])
+    else:
+        return np.fromiter(itertools.chain.from_iterable(sequence[:length] for sequence, length in
+                                                         zip(sequences, lengths)),
+                           dtype=np.int32, count=int(lengths.sum()))
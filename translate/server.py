@@ -0,0 +1,217 @@
+"""
+HTTP server for decoding, which keeps the model loaded in memory (see `TranslationModel.serve`).
+
+Concurrent requests are grouped into micro-batches, which are decoded by a single worker thread
+(the only one that uses the TensorFlow session).
+
+    POST /translate   {"lines": ["source sentence", ...]}   ->   {"translations": ["translation", ...]}
+    GET /stats        latency percentiles (in ms) and batch statistics
+
+With several encoders, each line is a list of sentences (one for each encoder).
+"""
+
+import json
+import time
+import queue
+import threading
+import numpy as np
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from collections import deque
+from translate import utils
+
+
+class Request(object):
+    def __init__(self, lines):
+        self.lines = lines
+        self.start_time = time.time()
+        self.done = threading.Event()
+        self.translations = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    Collects the lines of concurrent requests into batches. A batch is decoded as soon as it contains
+    `batch_size` lines, or when its first request has waited for `max_wait` seconds.
+    """
+    def __init__(self, decode_fn, batch_size, max_wait, stats_size=10000):
+        """
+        :param decode_fn: function which takes a list of lines (tuples of sentences, one for each encoder)
+          and returns or yields their translations
+        :param batch_size: maximum number of lines in a batch (a request which is larger than this
+          is still decoded in one batch)
+        :param max_wait: maximum time (in seconds) that a request waits for other requests
+        :param stats_size: number of recent requests used to compute the latency percentiles
+        """
+        self.decode_fn = decode_fn
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=stats_size)
+        self.batch_sizes = deque(maxlen=stats_size)
+        self.request_count = 0
+        self.line_count = 0
+        self.error_count = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def translate(self, lines):
+        """
+        Decode these lines (blocks until their batch is decoded)
+
+        :param lines: list of tuples of sentences (one sentence for each encoder)
+        :return: list of translations
+        """
+        request = Request(lines)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.translations
+
+    def _next_batch(self):
+        requests = [self.queue.get()]
+        line_count = len(requests[0].lines)
+        deadline = requests[0].start_time + self.max_wait
+
+        while line_count < self.batch_size:
+            timeout = deadline - time.time()
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            requests.append(request)
+            line_count += len(request.lines)
+
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._next_batch()
+            lines = [line for request in requests for line in request.lines]
+
+            try:
+                translations = list(self.decode_fn(lines))
+                error = None
+            except Exception as e:
+                utils.log('decoding error: {}'.format(e))
+                translations = None
+                error = e
+
+            end_time = time.time()
+            start = 0
+            for request in requests:
+                end = start + len(request.lines)
+                if error is None:
+                    request.translations = translations[start:end]
+                else:
+                    request.error = error
+                start = end
+                request.done.set()
+
+            with self.lock:
+                self.latencies.extend(end_time - request.start_time for request in requests)
+                self.batch_sizes.append(len(lines))
+                self.request_count += len(requests)
+                self.line_count += len(lines)
+                self.error_count += len(requests) if error is not None else 0
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            stats = {
+                'requests': self.request_count,
+                'lines': self.line_count,
+                'errors': self.error_count,
+                'queued': self.queue.qsize(),
+            }
+
+        if len(latencies) > 0:
+            for percentile in 50, 90, 95, 99:
+                stats['latency_p{}'.format(percentile)] = float(np.percentile(latencies, percentile))
+            stats['latency_mean'] = float(latencies.mean())
+            stats['batch_size_mean'] = float(batch_sizes.mean())
+        return stats
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # set by `serve`
+    batcher = None
+    encoder_count = 1
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self.send_json(self.batcher.stats())
+        else:
+            self.send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/translate':
+            self.send_json({'error': 'not found'}, status=404)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            lines = data['lines'] if isinstance(data, dict) else data
+            lines = [tuple(line) if isinstance(line, list) else (line,) for line in lines]
+            if any(len(line) != self.encoder_count or not all(isinstance(x, str) for x in line) for line in lines):
+                raise ValueError('each line should contain {} sentence(s)'.format(self.encoder_count))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json({'error': 'bad request: {}'.format(e)}, status=400)
+            return
+
+        try:
+            translations = self.batcher.translate(lines) if lines else []
+        except Exception as e:
+            self.send_json({'error': str(e)}, status=500)
+            return
+
+        self.send_json({'translations': translations})
+
+    def log_message(self, format, *args):
+        utils.debug('{} {}'.format(self.address_string(), format % args))
+
+
+def serve(decode_fn, host='localhost', port=8000, batch_size=32, max_wait=0.01, encoder_count=1):
+    """
+    Start a decoding server, and serve requests until interrupted.
+
+    :param decode_fn: function which takes a list of lines (tuples of sentences, one for each encoder)
+      and returns or yields their translations
+    :param batch_size: maximum number of lines in a micro-batch
+    :param max_wait: maximum time (in seconds) that a request waits for other requests to be batched with
+    :param encoder_count: number of sentences in each line
+    """
+    batcher = MicroBatcher(decode_fn, batch_size=batch_size, max_wait=max_wait)
+    batcher.start()
+
+    handler = type('RequestHandler', (RequestHandler,), {'batcher': batcher, 'encoder_count': encoder_count})
+    server = ThreadingHTTPServer((host, port), handler)
+
+    utils.log('serving on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        utils.log('exiting...')
+    finally:
+        server.server_close()
@@ -0,0 +1,184 @@
+"""
+Fast implementation of the Translation Error Rate, compatible with `pyter.ter`.
+
+Like `pyter`, shifts are searched greedily: at each iteration, the shift which reduces the edit distance
+the most is applied (ties are broken like `pyter`, by taking the largest shifted sequence). But instead of
+computing the edit distance of each candidate shift separately with Python lists, all the candidates
+of an iteration (which have the same length) are scored at once, one row of the Levenshtein matrix
+at a time with NumPy. The rows of the current hypothesis are cached, so that each candidate only
+computes the rows which come after the prefix it shares with the current hypothesis.
+
+`max_shift_size` and `max_shift_distance` limit the candidate shifts like tercom does (tercom uses 10
+and 50). By default, there is no limit, and the scores are the same as `pyter.ter`.
+"""
+
+import numpy as np
+
+
+def _token_ids(hypothesis, reference):
+    # order-preserving ids, so that comparing sequences of ids is the same as comparing sequences of tokens
+    vocab = {token: i for i, token in enumerate(sorted(set(hypothesis) | set(reference)))}
+    return (np.array([vocab[token] for token in hypothesis], dtype=np.int64),
+            np.array([vocab[token] for token in reference], dtype=np.int64))
+
+
+def _next_rows(rows, words, reference, i):
+    """
+    Compute row i + 1 of the Levenshtein matrices of a batch of sequences against the same reference.
+
+    :param rows: array of shape (batch_size, ref_length + 1), row i of each matrix
+    :param words: word at position i of each sequence, array of shape (batch_size,)
+    :return: array of shape (batch_size, ref_length + 1)
+    """
+    positions = np.arange(rows.shape[1])
+    cost = np.empty_like(rows)
+    cost[:, 0] = i + 1
+    cost[:, 1:] = np.minimum(rows[:, 1:] + 1, rows[:, :-1] + (words[:, None] != reference[None, :]))
+    # insertions: new_row[j] = min_{k <= j} (cost[k] + j - k)
+    return np.minimum.accumulate(cost - positions, axis=1) + positions
+
+
+def edit_distance_rows(sequence, reference, rows=None, start=0):
+    """
+    :param sequence: int array of shape (length,)
+    :param reference: int array of shape (ref_length,)
+    :param rows: Levenshtein matrix of a sequence of the same length, which shares its first `start` words
+      with `sequence` (those rows are reused)
+    :return: full Levenshtein matrix, of shape (length + 1, ref_length + 1)
+    """
+    if rows is None:
+        rows = np.empty((len(sequence) + 1, len(reference) + 1), dtype=np.int64)
+        rows[0] = np.arange(len(reference) + 1)
+        start = 0
+    else:
+        rows = rows.copy()
+
+    for i in range(start, len(sequence)):
+        rows[i + 1] = _next_rows(rows[i:i + 1], sequence[i:i + 1], reference, i)[0]
+    return rows
+
+
+def edit_distance(sequences, reference, start_rows=None, start_positions=None):
+    """
+    Edit distances of a batch of sequences of the same length against the same reference.
+
+    :param sequences: int array of shape (batch_size, length)
+    :param reference: int array of shape (ref_length,)
+    :param start_rows: Levenshtein matrix of a sequence which shares a prefix with each of the `sequences`
+    :param start_positions: length of the prefix that each sequence shares with this sequence
+      (the rows of this prefix aren't computed again)
+    :return: array of shape (batch_size,)
+    """
+    batch_size, length = sequences.shape
+    if start_rows is None:
+        start_rows = np.arange(len(reference) + 1)[None, :]
+        start_positions = np.zeros(batch_size, dtype=np.int64)
+
+    # sort by prefix length: at step i, only the first `count` sequences need to be updated
+    order = np.argsort(start_positions, kind='stable')
+    sequences = sequences[order]
+    start_positions = start_positions[order]
+    rows = start_rows[start_positions]
+
+    for i in range(start_positions[0] if batch_size > 0 else length, length):
+        count = np.searchsorted(start_positions, i, side='right')
+        rows[:count] = _next_rows(rows[:count], sequences[:count, i], reference, i)
+
+    distances = np.empty(batch_size, dtype=np.int64)
+    distances[order] = rows[:, -1]
+    return distances
+
+
+def find_shifts(hypothesis, reference, max_shift_size=None, max_shift_distance=None):
+    """
+    Candidate shifts (same as `pyter._findpairs`): a span of the hypothesis which starts at position i
+    and matches the reference at position j (with i != j), is moved to position j.
+
+    :return: arrays of start positions in the hypothesis, target positions, and lengths of the spans
+    """
+    matches = hypothesis[:, None] == reference[None, :]
+
+    # length of the matching span which starts at each position
+    lengths = np.zeros((len(hypothesis) + 1, len(reference) + 1), dtype=np.int64)
+    for i in reversed(range(len(hypothesis))):
+        lengths[i, :-1] = matches[i] * (lengths[i + 1, 1:] + 1)
+
+    starts, targets = np.nonzero(matches)
+    lengths = lengths[starts, targets]
+
+    keep = starts != targets
+    if max_shift_distance is not None:
+        keep &= np.abs(starts - targets) <= max_shift_distance
+    if max_shift_size is not None:
+        lengths = np.minimum(lengths, max_shift_size)
+
+    return starts[keep], targets[keep], lengths[keep]
+
+
+def apply_shifts(hypothesis, starts, targets, lengths):
+    """
+    :return: array of shape (shift_count, length), each row is the hypothesis where the span
+      `hypothesis[start:start + length]` was moved to position `target` (of the hypothesis without this span)
+    """
+    starts, targets, lengths = starts[:, None], targets[:, None], lengths[:, None]
+    positions = np.arange(len(hypothesis))[None, :]
+
+    # index in the hypothesis without the span, and then in the full hypothesis
+    indices = np.where(positions < targets, positions, positions - lengths)
+    indices = np.where(indices < starts, indices, indices + lengths)
+    indices = np.where((positions >= targets) & (positions < targets + lengths), starts + positions - targets,
+                       indices)
+    return hypothesis[indices]
+
+
+def _best_shift(hypothesis, reference, rows, **kwargs):
+    starts, targets, lengths = find_shifts(hypothesis, reference, **kwargs)
+    if len(starts) == 0:
+        return 0, hypothesis, 0
+
+    # like list insertion, a span which is moved beyond the end of the hypothesis is moved to the end
+    targets = np.minimum(targets, len(hypothesis) - lengths)
+    shifted = apply_shifts(hypothesis, starts, targets, lengths)
+    prefix_lengths = np.minimum(starts, targets)
+    distances = edit_distance(shifted, reference, start_rows=rows, start_positions=prefix_lengths)
+    deltas = rows[-1, -1] - distances
+
+    # like `pyter`, break ties by taking the largest shifted sequence
+    best, = np.nonzero(deltas == deltas.max())
+    best = best[np.lexsort(shifted[best, ::-1].T)[-1]]
+    return deltas[best], shifted[best], prefix_lengths[best]
+
+
+def ter(hypothesis, reference, max_shift_size=None, max_shift_distance=None):
+    """
+    Translation Error Rate (same result as `pyter.ter`)
+
+    :param hypothesis: sequence of tokens (e.g., list of words, or array of token ids)
+    :param reference: sequence of tokens
+    :param max_shift_size: maximum length of the shifted spans (no limit by default)
+    :param max_shift_distance: maximum distance of the shifts (no limit by default)
+    :return: number of edits divided by the length of the reference
+    """
+    hypothesis, reference = _token_ids(hypothesis, reference)
+
+    edits = 0
+    rows = edit_distance_rows(hypothesis, reference)
+    while True:
+        delta, shifted, prefix_length = _best_shift(hypothesis, reference, rows, max_shift_size=max_shift_size,
+                                     max_shift_distance=max_shift_distance)
+        if delta <= 0:
+            break
+        edits += 1
+        hypothesis = shifted
+        rows = edit_distance_rows(hypothesis, reference, rows=rows, start=prefix_length)
+
+    return (edits + int(rows[-1, -1])) / len(reference)
+
+
+def batch_ter(hypotheses, references, **kwargs):
+    """
+    :param hypotheses: list of hypotheses (sequences of tokens)
+    :param references: list of references
+    :return: array of TER scores, one for each hypothesis (see `ter`)
+    """
+    return np.array([ter(hypothesis, reference, **kwargs) for hypothesis, reference in zip(hypotheses, references)])
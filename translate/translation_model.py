@@ -1,13 +1,17 @@
 import tensorflow as tf
 import os
 import pickle
+import copy
+import re
 import time
 import sys
-import math
 import numpy as np
 import shutil
-from translate import utils, evaluation
-from translate.seq2seq_model import Seq2SeqModel
+import hashlib
+from collections import OrderedDict
+from itertools import islice
+from translate import utils, evaluation, server
+from translate.seq2seq_model import Seq2SeqModel, FrozenSeq2SeqModel
 
 
 class BaseTranslationModel(object):
@@ -17,6 +21,7 @@ class BaseTranslationModel(object):
         self.checkpoint_dir = checkpoint_dir
         self.saver = None
         self.global_step = None
+        self.checkpoint_files = []   # checkpoints loaded by `initialize` (identity of the model for caching)
 
         try:
             self.reversed_scores = getattr(evaluation, score_function).reversed  # the lower the better
@@ -94,9 +99,26 @@ class BaseTranslationModel(object):
         
         if checkpoints:  # load partial checkpoints
             for checkpoint in checkpoints:  # checkpoint files to load
-                load_checkpoint(sess, None, checkpoint, blacklist=blacklist)
+                self.checkpoint_files.append(load_checkpoint(sess, None, checkpoint, blacklist=blacklist))
         elif not reset:
-            load_checkpoint(sess, self.checkpoint_dir, blacklist=blacklist)
+            self.checkpoint_files.append(load_checkpoint(sess, self.checkpoint_dir, blacklist=blacklist))
+
+    def checkpoint_id(self):
+        """
+        Identity of the parameters loaded by `initialize` (with an ensemble, `initialize` is called once
+        for each model), as a hash of the checkpoint names and modification times.
+        Returns None if no checkpoint was loaded (e.g., new model).
+        """
+        if not self.checkpoint_files or None in self.checkpoint_files:
+            return None
+
+        sha = hashlib.sha1()
+        for filename in self.checkpoint_files:
+            # TensorFlow checkpoint, or exported graph (see `Seq2SeqModel.export`)
+            path = filename + '.index' if os.path.exists(filename + '.index') else filename
+            mtime = os.path.getmtime(path) if os.path.exists(path) else None
+            sha.update('{} {}\n'.format(os.path.abspath(filename), mtime).encode())
+        return sha.hexdigest()
 
     def save(self, sess):
         save_checkpoint(sess, self.saver, self.checkpoint_dir, self.global_step)
@@ -104,7 +126,7 @@ class BaseTranslationModel(object):
 
 class TranslationModel(BaseTranslationModel):
     def __init__(self, name, encoders, decoder, checkpoint_dir, learning_rate, learning_rate_decay_factor, batch_size,
-                 keep_best=1, load_embeddings=None, max_input_len=None, **kwargs):
+                 keep_best=1, load_embeddings=None, max_input_len=None, frozen_graph=None, **kwargs):
         super(TranslationModel, self).__init__(name, checkpoint_dir, keep_best, **kwargs)
 
         self.batch_size = batch_size
@@ -117,11 +139,15 @@ class TranslationModel(BaseTranslationModel):
         self.binary_input = [encoder_or_decoder.binary for encoder_or_decoder in encoders_and_decoder]
         self.character_level = [encoder_or_decoder.character_level for encoder_or_decoder in encoders_and_decoder]
 
-        self.learning_rate = tf.Variable(learning_rate, trainable=False, name='learning_rate', dtype=tf.float32)
-        self.learning_rate_decay_op = self.learning_rate.assign(self.learning_rate * learning_rate_decay_factor)
+        if frozen_graph is not None:
+            # inference-only model, without any variable
+            self.learning_rate = self.learning_rate_decay_op = self.global_step = None
+        else:
+            self.learning_rate = tf.Variable(learning_rate, trainable=False, name='learning_rate', dtype=tf.float32)
+            self.learning_rate_decay_op = self.learning_rate.assign(self.learning_rate * learning_rate_decay_factor)
 
-        with tf.device('/cpu:0'):
-            self.global_step = tf.Variable(0, trainable=False, name='global_step')
+            with tf.device('/cpu:0'):
+                self.global_step = tf.Variable(0, trainable=False, name='global_step')
 
         self.filenames = utils.get_filenames(extensions=self.extensions, **kwargs)
         # TODO: check that filenames exist
@@ -132,32 +158,87 @@ class TranslationModel(BaseTranslationModel):
             if encoder_or_decoder.vocab_size <= 0 and vocab is not None:
                 encoder_or_decoder.vocab_size = len(vocab.reverse)
 
-        # this adds an `embedding' attribute to each encoder and decoder
-        utils.read_embeddings(self.filenames.embeddings, encoders + [decoder], load_embeddings, self.vocabs)
+        if self.ngrams:
+            # vectorized language model used in beam-search decoding
+            self.ngrams = utils.NgramScorer(self.ngrams, decoder.vocab_size)
 
-        # main model
-        utils.debug('creating model {}'.format(name))
-        self.seq2seq_model = Seq2SeqModel(encoders, decoder, self.learning_rate, self.global_step,
-                                          max_input_len=max_input_len, **kwargs)
+        if frozen_graph is not None:
+            utils.debug('loading model {} from {}'.format(name, frozen_graph))
+            self.seq2seq_model = FrozenSeq2SeqModel(frozen_graph, **kwargs)
+        else:
+            # this adds an `embedding' attribute to each encoder and decoder
+            utils.read_embeddings(self.filenames.embeddings, encoders + [decoder], load_embeddings, self.vocabs)
+
+            # main model
+            utils.debug('creating model {}'.format(name))
+            self.seq2seq_model = Seq2SeqModel(encoders, decoder, self.learning_rate, self.global_step,
+                                              max_input_len=max_input_len, **kwargs)
 
         self.batch_iterator = None
+        self.batch_state = None   # position of `batch_iterator` after the last batch returned by `next_batch`
+        self.batches = None
+        self.prefetch_depth = 0
         self.dev_batches = None
         self.train_size = None
         self.use_sgd = False
+        self.translation_cache = None   # set by `MultiTaskModel.use_translation_cache`
+        self.translation_cache_id = None
 
-    def read_data(self, max_train_size, max_dev_size, read_ahead=10, batch_mode='standard', shuffle=True, **kwargs):
-        utils.debug('reading training data')
-        train_set = utils.read_dataset(self.filenames.train, self.extensions, self.vocabs, max_size=max_train_size,
-                                       binary_input=self.binary_input, character_level=self.character_level,
-                                       max_seq_len=self.max_input_len)
-        self.train_size = len(train_set)
-        self.batch_iterator = utils.read_ahead_batch_iterator(train_set, self.batch_size, read_ahead=read_ahead,
-                                                              mode=batch_mode, shuffle=shuffle)
+    def read_data(self, max_train_size, max_dev_size, read_ahead=10, batch_mode='standard', shuffle=True,
+                  corpus_cache=True, stream_data=False, shard_size=100000, prefetch_depth=0, max_tokens=None,
+                  buckets=8, batch_state=None, **kwargs):
+        """
+        Read the training and development data, and create the training batch iterator.
+
+        :param batch_state: state of the batch iterator saved with the last checkpoint (see `save_batch_states`),
+          to resume training from this position in the data
+        """
+        self.prefetch_depth = prefetch_depth
+        self.batches = None
+        # the seed is set right away, so that the state can be saved before the first batch
+        self.iterator_state = utils.init_iterator_state(copy.deepcopy(batch_state))
+        self.batch_state = copy.deepcopy(self.iterator_state)
+
+        if corpus_cache:
+            # compiled corpora are shared by all the models trained on the same data
+            cache_dir = os.path.join(os.path.dirname(self.filenames.train[0]), 'cache')
+        else:
+            cache_dir = None
+
+        if stream_data:
+            # shards are read one at a time, so batches can't be sampled from (or bucketed over) the whole dataset
+            assert batch_mode in ('standard', 'tokens'), (
+                'batch mode `{}` is not supported with `stream_data`'.format(batch_mode))
+            utils.debug('indexing training data')
+            # the size of the training set is approximate (it includes the lines that will be filtered out)
+            self.train_size, shards = utils.index_shards(self.filenames.train, self.binary_input,
+                                                         shard_size=shard_size, max_size=max_train_size)
+            self.batch_iterator = utils.stream_batch_iterator(self.filenames.train, self.extensions, self.vocabs,
+                                                              self.batch_size, shards,
+                                                              binary_input=self.binary_input,
+                                                              character_level=self.character_level,
+                                                              max_seq_len=self.max_input_len,
+                                                              read_ahead=read_ahead, shuffle=shuffle,
+                                                              max_tokens=max_tokens if batch_mode == 'tokens'
+                                                              else None,
+                                                              state=self.iterator_state)
+        else:
+            utils.debug('reading training data')
+            train_set = utils.read_dataset(self.filenames.train, self.extensions, self.vocabs,
+                                           max_size=max_train_size, binary_input=self.binary_input,
+                                           character_level=self.character_level, max_seq_len=self.max_input_len,
+                                           cache_dir=cache_dir)
+            self.train_size = len(train_set)
+            self.batch_iterator = utils.read_ahead_batch_iterator(train_set, self.batch_size, read_ahead=read_ahead,
+                                                                  mode=batch_mode, shuffle=shuffle,
+                                                                  max_tokens=max_tokens, buckets=buckets,
+                                                                  state=self.iterator_state)
 
         utils.debug('reading development data')
         dev_sets = [
             utils.read_dataset(dev, self.extensions, self.vocabs, max_size=max_dev_size,
-                               binary_input=self.binary_input, character_level=self.character_level)
+                               binary_input=self.binary_input, character_level=self.character_level,
+                               cache_dir=cache_dir)
             for dev in self.filenames.dev
         ]
         # subset of the dev set whose perplexity is periodically evaluated
@@ -176,18 +257,71 @@ class TranslationModel(BaseTranslationModel):
     def train(self, *args, **kwargs):
         raise NotImplementedError('use MultiTaskModel')
 
+    def next_batch(self):
+        """
+        Get the next training batch, both as a list of examples and as padded arrays (see `Seq2SeqModel.get_batch`).
+        If `prefetch_depth` is positive, batches are prepared in advance by a background thread (which is
+        only started at the first call, so that `batch_iterator` can still be fast-forwarded before).
+
+        `batch_state` is updated with a copy of the iterator state right after this batch (the iterator itself
+        may already be ahead because of prefetching).
+        """
+        if self.prefetch_depth <= 0:
+            data = next(self.batch_iterator)
+            self.batch_state = copy.deepcopy(self.iterator_state)
+            return data, self.seq2seq_model.get_batch(data)
+
+        if self.batches is None:
+            # arrays returned by `get_batch` must not be overwritten while they are waiting in the queue
+            self.seq2seq_model.batch_buffer_count = self.prefetch_depth + 2
+            batches = ((data, self.seq2seq_model.get_batch(data), copy.deepcopy(self.iterator_state))
+                       for data in self.batch_iterator)
+            self.batches = utils.prefetch_iterator(batches, depth=self.prefetch_depth)
+
+        data, batch, self.batch_state = next(self.batches)
+        return data, batch
+
     def train_step(self, sess, loss_function='xent', reward_function=None, use_edits=False):
         if loss_function == 'reinforce':
             fun = self.seq2seq_model.reinforce_step
         else:
             fun = self.seq2seq_model.step
 
-        return fun(sess, next(self.batch_iterator), update_model=True, update_baseline=True, use_sgd=self.use_sgd,
-                   reward_function=reward_function, use_edits=use_edits, vocabs=self.vocabs)
+        start_time = time.time()
+        data, batch = self.next_batch()
+        input_time = time.time() - start_time   # time spent waiting for the input pipeline
+
+        res = fun(sess, data, batch=batch, update_model=True, update_baseline=True, use_sgd=self.use_sgd,
+                  reward_function=reward_function, use_edits=use_edits, vocabs=self.vocabs)
+
+        # number of examples and of real (non-padded) source and target positions in this batch
+        size = len(data)
+        tokens = sum(len(lines) for example in data for lines in example)
+
+        # size of the batch whose loss is returned (REINFORCE updates can be delayed by one step)
+        res = res._asdict()
+        loss_size = res.pop('size', size)
+
+        return utils.AttrDict(res, input_time=input_time, size=size, loss_size=loss_size, tokens=tokens)
+
+    def flush_train_step(self, sess):
+        """
+        Do the pending REINFORCE update, if any (see `Seq2SeqModel.flush_reinforce_step`).
+
+        :return: losses of this update and size of its batch (same as `train_step`), or None
+        """
+        res = self.seq2seq_model.flush_reinforce_step(sess)
+        if res is None:
+            return None
+
+        res = res._asdict()
+        return utils.AttrDict(res, loss_size=res.pop('size'))
 
     def baseline_step(self, sess, reward_function=None, use_edits=False):
+        data, batch = self.next_batch()
         return self.seq2seq_model.reinforce_step(sess,
-                                                 next(self.batch_iterator),
+                                                 data,
+                                                 batch=batch,
                                                  update_model=False,
                                                  update_baseline=True,
                                                  reward_function=reward_function,
@@ -205,21 +339,49 @@ class TranslationModel(BaseTranslationModel):
 
             utils.log("  eval: loss {:.2f}".format(eval_loss))
 
+    def translation_cache_settings(self, beam_size, early_stopping, ensemble_size=1, symbolic_beam_search=False):
+        """
+        Description of the model and of the decoding settings, which is a part of the translation cache keys
+
+        :param symbolic_beam_search: whether the in-graph beam search is used (its results can differ
+          from those of the Python beam search)
+        """
+        model = self.seq2seq_model
+        return ' '.join(map(str, [
+            self.name, self.translation_cache_id, ensemble_size, beam_size, early_stopping,
+            model.len_normalization, model.lm_weight, self.filenames.lm_path, model.max_output_len,
+            model.softmax_temperature, model.max_output_ratio, symbolic_beam_search
+        ]))
+
+    def translation_cache_key(self, settings, token_ids):
+        """
+        :param settings: decoding settings, as returned by `translation_cache_settings`
+        :param token_ids: list of token ids for each encoder
+        """
+        source = ' | '.join(' '.join(map(str, token_ids_)) for token_ids_ in token_ids)
+        return hashlib.sha1('{}\n{}'.format(settings, source).encode()).hexdigest()
+
     def _decode_sentence(self, sess, sentence_tuple, beam_size=1, remove_unk=False, early_stopping=True):
         return next(self._decode_batch(sess, [sentence_tuple], beam_size, remove_unk, early_stopping))
 
     def _decode_batch(self, sess, sentence_tuples, batch_size, beam_size=1, remove_unk=False, early_stopping=True,
-                      use_edits=False):
-        beam_search = beam_size > 1 or isinstance(sess, list)
+                      use_edits=False, decoding_window=1):
+        """
+        Decode the given inputs batch by batch, and yield their translations in the same order.
 
-        if beam_search:
-            batch_size = 1
+        The inputs are read by windows of `decoding_window` batches, and sorted by length inside each window,
+        so that the sentences of a batch have similar lengths (which reduces padding). The translations of
+        a window are yielded in the original order once the whole window is decoded.
 
-        if batch_size == 1:
-            batches = ([sentence_tuple] for sentence_tuple in sentence_tuples)   # lazy
-        else:
-            batch_count = int(math.ceil(len(sentence_tuples) / batch_size))
-            batches = [sentence_tuples[i * batch_size:(i + 1) * batch_size] for i in range(batch_count)]
+        :param sentence_tuples: iterable of tuples of sentences (one sentence for each encoder). With
+          `batch_size=1`, this iterable is consumed lazily (e.g., interactive decoding)
+        :param decoding_window: number of batches which are sorted together (1 to keep the original order)
+        """
+        beam_search = beam_size > 1 or isinstance(sess, list)
+        # the in-graph beam search doesn't support ensembles and language models
+        symbolic_beam_search = (beam_search and not isinstance(sess, list) and not self.ngrams and
+                                self.seq2seq_model.beam_search_hypotheses is not None and
+                                beam_size == self.seq2seq_model.beam_size)
 
         def map_to_ids(sentence_tuple):
             token_ids = [
@@ -229,24 +391,78 @@ class TranslationModel(BaseTranslationModel):
             ]
             return token_ids
 
-        for batch in batches:
-            token_ids = list(map(map_to_ids, batch))
-
-            if beam_search:
-                hypotheses, _ = self.seq2seq_model.beam_search_decoding(sess, token_ids[0], beam_size,
-                                                                        ngrams=self.ngrams,
-                                                                        early_stopping=early_stopping)
-                batch_token_ids = [hypotheses[0]]  # first hypothesis is the highest scoring one
+        def decode_token_ids(token_ids):
+            if symbolic_beam_search:
+                n_best = self.seq2seq_model.symbolic_beam_search_decoding(sess, token_ids,
+                                                                          early_stopping=early_stopping)
+                batch_token_ids = [hypotheses[0] for hypotheses, _ in n_best]
+            elif beam_search:
+                n_best = self.seq2seq_model.batch_beam_search_decoding(sess, token_ids, beam_size,
+                                                                       ngrams=self.ngrams,
+                                                                       early_stopping=early_stopping)
+                # first hypothesis is the highest scoring one
+                batch_token_ids = [hypotheses[0] for hypotheses, _ in n_best]
 
             else:
                 batch_token_ids = self.seq2seq_model.greedy_decoding(sess, token_ids)
 
-            for src_tokens, trg_token_ids in zip(batch, batch_token_ids):
+            for trg_token_ids in batch_token_ids:
                 trg_token_ids = list(trg_token_ids)
-
                 if utils.EOS_ID in trg_token_ids:
                     trg_token_ids = trg_token_ids[:trg_token_ids.index(utils.EOS_ID)]
-
+                yield trg_token_ids
+
+        # translations of binary inputs (e.g., audio features) are not cached
+        cache = self.translation_cache if not any(self.binary_input[:-1]) else None
+        if cache is not None:
+            cache_settings = self.translation_cache_settings(beam_size if beam_search else 1, early_stopping,
+                                                             ensemble_size=len(sess) if isinstance(sess, list) else 1,
+                                                             symbolic_beam_search=symbolic_beam_search)
+
+        def decode_batch(token_ids):
+            if cache is None:
+                return list(decode_token_ids(token_ids))
+
+            keys = [self.translation_cache_key(cache_settings, token_ids_) for token_ids_ in token_ids]
+            batch_token_ids = [cache.get(key) for key in keys]
+
+            # decode the inputs which are not in the cache (only once if they appear several times)
+            missing = OrderedDict()
+            for i, (key, trg_token_ids) in enumerate(zip(keys, batch_token_ids)):
+                if trg_token_ids is None:
+                    missing.setdefault(key, []).append(i)
+
+            if missing:
+                indices = list(missing.values())
+                new_token_ids = list(decode_token_ids([token_ids[ids[0]] for ids in indices]))
+                for ids, trg_token_ids in zip(indices, new_token_ids):
+                    for i in ids:
+                        batch_token_ids[i] = trg_token_ids
+                cache.update(zip(missing.keys(), new_token_ids))
+
+            return batch_token_ids
+
+        # in interactive mode, each line is decoded as soon as it is read
+        window_size = batch_size * max(decoding_window, 1) if batch_size > 1 else 1
+        sentence_tuples = iter(sentence_tuples)
+
+        while True:
+            window = list(islice(sentence_tuples, window_size))
+            if not window:
+                break
+
+            token_ids = list(map(map_to_ids, window))
+            order = sorted(range(len(window)), key=lambda i: [len(token_ids_) for token_ids_ in token_ids[i]])
+
+            # reorder buffer: translations of this window, in the original order
+            window_token_ids = [None] * len(window)
+            for start in range(0, len(order), batch_size):
+                batch_ids = order[start:start + batch_size]
+                batch_token_ids = decode_batch([token_ids[i] for i in batch_ids])
+                for i, trg_token_ids in zip(batch_ids, batch_token_ids):
+                    window_token_ids[i] = trg_token_ids
+
+            for src_tokens, trg_token_ids in zip(window, window_token_ids):
                 trg_tokens = [self.trg_vocab.reverse[i] if i < len(self.trg_vocab.reverse) else utils._UNK
                               for i in trg_token_ids]
 
@@ -296,7 +512,8 @@ class TranslationModel(BaseTranslationModel):
             output_file = '{}.{}.svg'.format(output, line_id + 1) if output is not None else None
             utils.heatmap(src_tokens, trg_tokens, weights.T, wav_file=wav_file, output_file=output_file)
 
-    def decode(self, sess, beam_size, output=None, remove_unk=False, early_stopping=True, use_edits=False, **kwargs):
+    def decode(self, sess, beam_size, output=None, remove_unk=False, early_stopping=True, use_edits=False,
+               decoding_window=10, **kwargs):
         utils.log('starting decoding')
 
         # empty `test` means that we read from standard input, which is not possible with multiple encoders
@@ -315,22 +532,64 @@ class TranslationModel(BaseTranslationModel):
             if self.filenames.test is None:   # interactive mode
                 batch_size = 1
             else:
+                # lines are read lazily, `decoding_window` batches at a time
                 batch_size = self.batch_size
-                lines = list(lines)
 
             hypothesis_iter = self._decode_batch(sess, lines, batch_size, beam_size=beam_size,
                                                  early_stopping=early_stopping, remove_unk=remove_unk,
-                                                 use_edits=use_edits)
+                                                 use_edits=use_edits, decoding_window=decoding_window)
 
+            start_time = time.time()
+            line_count = 0
             for hypothesis in hypothesis_iter:
                 output_file.write(hypothesis + '\n')
                 output_file.flush()
+                line_count += 1
+
+            if self.filenames.test is not None:
+                decoding_time = time.time() - start_time
+                utils.log('decoded {} lines in {:.2f}s ({:.1f} lines/s)'.format(
+                    line_count, decoding_time, line_count / decoding_time if decoding_time > 0 else 0))
+
+            if self.translation_cache is not None:
+                utils.log('translation cache: {}'.format(self.translation_cache.summary()))
         finally:
             if output_file is not None:
                 output_file.close()
 
+    def export(self, sess, filename, **kwargs):
+        """
+        Export a frozen inference graph of this model, which can be used for decoding
+        with the `frozen_graph` parameter (see `Seq2SeqModel.export`)
+        """
+        self.seq2seq_model.export(sess, filename)
+
+    def serve(self, sess, beam_size, server_host='localhost', server_port=8000, server_batch_size=32,
+              server_max_wait=0.01, remove_unk=False, early_stopping=True, use_edits=False, decoding_window=10,
+              **kwargs):
+        """
+        Start a HTTP decoding server (see `translate.server`), which keeps this model loaded
+        and decodes concurrent requests in micro-batches.
+
+        :param server_batch_size: maximum number of lines in a batch
+        :param server_max_wait: maximum time (in seconds) that a request waits for other requests
+        """
+        # we can't read binary data from a HTTP request
+        assert not any(self.binary_input[:len(self.src_ext)])
+
+        def decode_fn(lines):
+            return self._decode_batch(sess, lines, server_batch_size, beam_size=beam_size,
+                                      early_stopping=early_stopping, remove_unk=remove_unk, use_edits=use_edits,
+                                      decoding_window=decoding_window)
+
+        server.serve(decode_fn, host=server_host, port=server_port, batch_size=server_batch_size,
+                     max_wait=server_max_wait, encoder_count=len(self.src_ext))
+
+        if self.translation_cache is not None:
+            utils.log('translation cache: {}'.format(self.translation_cache.summary()))
+
     def evaluate(self, sess, beam_size, score_function, on_dev=True, output=None, remove_unk=False, max_dev_size=None,
-                 script_dir='scripts', early_stopping=True, use_edits=False, **kwargs):
+                 script_dir='scripts', early_stopping=True, use_edits=False, decoding_window=10, **kwargs):
         """
         :param score_function: name of the scoring function used to score and rank models
           (typically 'bleu_score')
@@ -339,6 +598,7 @@ class TranslationModel(BaseTranslationModel):
         :param remove_unk: remove the UNK symbols from the output
         :param max_dev_size: maximum number of lines to read from dev files
         :param script_dir: parameter of scoring functions
+        :param decoding_window: sort the inputs by length inside windows of this many batches (see `_decode_batch`)
         :return: scores of each corpus to evaluate
         """
         utils.log('starting decoding')
@@ -373,7 +633,7 @@ class TranslationModel(BaseTranslationModel):
 
                 hypothesis_iter = self._decode_batch(sess, src_sentences, self.batch_size, beam_size=beam_size,
                                                      early_stopping=early_stopping, remove_unk=remove_unk,
-                                                     use_edits=use_edits)
+                                                     use_edits=use_edits, decoding_window=decoding_window)
                 for sources, hypothesis, reference in zip(src_sentences, hypothesis_iter, trg_sentences):
                     if use_edits:
                         reference = utils.reverse_edits(sources[0], reference)
@@ -403,6 +663,9 @@ class TranslationModel(BaseTranslationModel):
             utils.log(' '.join(map(str, score_info)))
             scores.append(score)
 
+        if self.translation_cache is not None:
+            utils.log('translation cache: {}'.format(self.translation_cache.summary()))
+
         return scores
 
 
@@ -410,6 +673,7 @@ def load_checkpoint(sess, checkpoint_dir, filename=None, blacklist=()):
     """ `checkpoint_dir` should be unique to this model
     if `filename` is None, we load last checkpoint, otherwise
       we ignore `checkpoint_dir` and load the given checkpoint file.
+    Returns the name of the checkpoint that was loaded (None if there was no checkpoint).
     """
     if filename is None:
         # load last checkpoint
@@ -439,6 +703,8 @@ def load_checkpoint(sess, checkpoint_dir, filename=None, blacklist=()):
         for var in variables:
             utils.debug('  {} {}'.format(var.name, var.get_shape()))
 
+    return filename
+
 
 def save_checkpoint(sess, saver, checkpoint_dir, step=None, name=None):
     """ `checkpoint_dir` should be unique to this model """
@@ -458,3 +724,37 @@ def save_checkpoint(sess, saver, checkpoint_dir, step=None, name=None):
     saver.save(sess, checkpoint_path, step, write_meta_graph=False)
 
     utils.log('finished saving model')
+
+
+def save_batch_states(checkpoint_dir, step, states, name=None):
+    """
+    Save the state of the batch iterators next to the checkpoint of this step, so that training
+    can resume at the same position in the data without replaying all the previous batches.
+    The states of checkpoints that have been deleted by the saver are removed.
+    """
+    name = name or 'translate'
+    with open(os.path.join(checkpoint_dir, '{}-{}.batches'.format(name, step)), 'wb') as f:
+        pickle.dump(states, f)
+
+    filenames = os.listdir(checkpoint_dir)
+    for filename in filenames:
+        match = re.match(r'{}-(\d+)\.batches$'.format(re.escape(name)), filename)
+        if match is None:
+            continue
+        prefix = '{}-{}.'.format(name, match.group(1))
+        if not any(filename_.startswith(prefix) and filename_ != filename for filename_ in filenames):
+            os.remove(os.path.join(checkpoint_dir, filename))
+
+
+def load_batch_states(checkpoint_dir, step, name=None):
+    """
+    Load the batch iterator states saved by `save_batch_states` with the checkpoint of this step.
+
+    :return: the saved states, or None if there are none for this step
+    """
+    filename = os.path.join(checkpoint_dir, '{}-{}.batches'.format(name or 'translate', step))
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
@@ -7,8 +7,15 @@ import struct
 import random
 import math
 import wave
-
-from collections import namedtuple
+import array
+import hashlib
+import tempfile
+import shutil
+import queue
+import threading
+
+from collections import namedtuple, OrderedDict
+from itertools import islice
 from contextlib import contextmanager
 
 # special vocabulary symbols
@@ -140,7 +147,7 @@ def get_filenames(data_dir, extensions, train_prefix, dev_prefix, vocab_prefix,
     :param dev_prefix: name of the dev corpus (usually 'dev')
     :param vocab_prefix: prefix of the vocab files (usually 'vocab')
     :param embedding_prefix: prefix of the embedding files
-    :param lm_file: full path to a language model file in the ARPA format
+    :param lm_file: full path to a language model file in the ARPA format (or binary format, see `NgramModel`)
     :param kwargs: optional contains an additional 'decode', 'eval' or 'align' parameter
     :return: namedtuple containing the filenames
     """
@@ -195,36 +202,148 @@ def read_embeddings(embedding_filenames, encoders_and_decoder, load_embeddings,
         encoder_or_decoder.embedding = embedding
 
 
-def read_binary_features(filename):
+# magic number at the beginning of feature stores (see `FeatureStore`)
+_FEATURE_STORE_MAGIC = b'FEATSTR1'
+_FEATURE_STORE_HEADER = 'qqq'   # number of entries, dimension, and position of the offset index
+
+
+class FeatureStore(object):
+    """
+    Random-access, memory-mapped collection of vector features (e.g. MFCCs for a speech corpus).
+
+    File layout:
+      - 8 bytes of magic number (`FEATSTR1`)
+      - three int64: number of entries (lines), dimension of the vectors, and position in bytes of the index
+      - all the frames of all the entries, as float32 (frames * dimension for each entry)
+      - index: (lines + 1) int64 frame offsets (entry `i` spans frames `offsets[i]` to `offsets[i + 1]`)
+
+    Entries are zero-copy views of shape (frames, dimension) into the memory-mapped file, which means that
+    they are only read from disk when they are actually used.
+
+    Use `write_feature_store` or `scripts/convert-audio-features.py` to create such a file.
     """
-    Reads a binary file containing vector features. First two (int32) numbers correspond to
-    number of entries (lines), and dimension of the vectors.
+
+    def __init__(self, filename):
+        header_size = len(_FEATURE_STORE_MAGIC) + struct.calcsize(_FEATURE_STORE_HEADER)
+
+        with open(filename, 'rb') as f:
+            magic = f.read(len(_FEATURE_STORE_MAGIC))
+            if magic != _FEATURE_STORE_MAGIC:
+                raise ValueError('{} is not a feature store'.format(filename))
+            lines, dim, index_pos = struct.unpack(_FEATURE_STORE_HEADER, f.read(header_size - len(magic)))
+
+        self.filename = filename
+        self.dim = dim
+        self.offsets = np.memmap(filename, dtype=np.int64, mode='r', offset=index_pos, shape=(lines + 1,))
+
+        frames = int(self.offsets[-1])
+        if frames > 0:
+            self.data = np.memmap(filename, dtype=np.float32, mode='r', offset=header_size, shape=(frames, dim))
+        else:
+            self.data = np.zeros((0, dim), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('feature store index out of range')
+        return self.data[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def write_feature_store(filename, features, dim=None):
+    """
+    Write vector features to a file in the `FeatureStore` format. This works in constant memory,
+    so `features` can be a lazy iterator.
+
+    :param filename: path to the output file
+    :param features: iterable of arrays of shape (frames, dimension)
+    :param dim: dimension of the vectors (only needed if `features` can be empty)
+    :return: number of entries written
+    """
+    header_size = len(_FEATURE_STORE_MAGIC) + struct.calcsize(_FEATURE_STORE_HEADER)
+    offsets = [0]
+
+    with open(filename, 'wb') as f:
+        f.write(b'\0' * header_size)   # header is written at the end, once the index position is known
+
+        for feats in features:
+            feats = np.asarray(feats, dtype=np.float32)
+            if dim is None:
+                dim = feats.shape[1]
+            elif feats.shape[1] != dim:
+                raise ValueError('incompatible dimensions')
+
+            f.write(np.ascontiguousarray(feats).tobytes())
+            offsets.append(offsets[-1] + feats.shape[0])
+
+        index_pos = f.tell()
+        f.write(np.array(offsets, dtype=np.int64).tobytes())
+
+        f.seek(0)
+        f.write(_FEATURE_STORE_MAGIC)
+        f.write(struct.pack(_FEATURE_STORE_HEADER, len(offsets) - 1, dim or 0, index_pos))
+
+    return len(offsets) - 1
+
+
+def is_feature_store(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(_FEATURE_STORE_MAGIC)) == _FEATURE_STORE_MAGIC
+
+
+def iter_binary_features(filename):
+    """
+    Lazily read a binary file in the format of `scripts/extract-audio-features.py`.
+    First two (int32) numbers correspond to number of entries (lines), and dimension of the vectors.
     Each entry starts with a 32 bits integer indicating the number of frames, followed by
     (frames * dimension) 32 bits floats.
 
-    Use `scripts/extract-audio-features.py` to create such a file for audio (MFCCs).
-
     :param filename: path to the binary file containing the features
-    :return: list of arrays of shape (frames, dimension)
+    :return: iterator over arrays of shape (frames, dimension)
     """
-    all_feats = []
-
     with open(filename, 'rb') as f:
         lines, dim = struct.unpack('ii', f.read(8))
         for _ in range(lines):
             frames, = struct.unpack('i', f.read(4))
-            n = frames * dim
-            feats = struct.unpack('f' * n, f.read(4 * n))
-            all_feats.append(list(np.array(feats).reshape(frames, dim)))
+            feats = np.fromfile(f, dtype=np.float32, count=frames * dim)
+            yield feats.reshape(frames, dim)
+
 
-    return all_feats
+def read_binary_features(filename):
+    """
+    Reads a file containing vector features, either in the `FeatureStore` format (which is memory-mapped,
+    and read lazily), or in the format of `scripts/extract-audio-features.py` (see `iter_binary_features`),
+    which is entirely loaded into memory.
 
+    Use `scripts/convert-audio-features.py` to convert the latter into a feature store.
+
+    :param filename: path to the binary file containing the features
+    :return: sequence of arrays of shape (frames, dimension)
+    """
+    if is_feature_store(filename):
+        return FeatureStore(filename)
+    else:
+        return list(iter_binary_features(filename))
 
-def read_dataset(paths, extensions, vocabs, max_size=None, binary_input=None,
-                 character_level=None, sort_by_length=False, max_seq_len=None):
-    data_set = []
 
-    line_reader = read_lines(paths, extensions, binary_input=binary_input)
+def iter_dataset(paths, extensions, vocabs, max_size=None, binary_input=None, character_level=None,
+                 max_seq_len=None, line_reader=None):
+    """
+    Lazily read a parallel corpus, and map its sentences to token ids.
+
+    :param line_reader: read the lines from this iterator instead of `paths`
+    :return: iterator over lists of inputs (one for each extension), empty lines and lines
+      longer than `max_seq_len` are skipped
+    """
+    if line_reader is None:
+        line_reader = read_lines(paths, extensions, binary_input=binary_input)
     character_level = character_level or [False] * len(extensions)
 
     for counter, inputs in enumerate(line_reader, 1):
@@ -240,13 +359,37 @@ def read_dataset(paths, extensions, vocabs, max_size=None, binary_input=None,
             for input_, vocab, ext, char_level in zip(inputs, vocabs, extensions, character_level)
         ]
 
-        if not all(inputs):  # skip empty inputs
+        if any(len(input_) == 0 for input_ in inputs):  # skip empty inputs
             continue
         # skip lines that are too long
         if max_seq_len and any(len(inputs_) > max_seq_len for inputs_ in inputs):
             continue
 
-        data_set.append(inputs)  # TODO: filter too long
+        yield inputs
+
+
+def read_dataset(paths, extensions, vocabs, max_size=None, binary_input=None,
+                 character_level=None, sort_by_length=False, max_seq_len=None, cache_dir=None):
+    """
+    Read a parallel corpus into memory.
+
+    :param cache_dir: if not None, compile the corpus into a memory-mapped cache in this directory
+      (see `read_cached_dataset`), or load it from there if it was already compiled.
+      Corpora with binary inputs are never cached.
+    :return: list of lists of inputs (one for each extension)
+    """
+    data_set = None
+
+    if cache_dir is not None and not any(binary_input or []):
+        try:
+            data_set = read_cached_dataset(paths, extensions, vocabs, cache_dir, max_size=max_size,
+                                           character_level=character_level, max_seq_len=max_seq_len)
+        except OSError as e:
+            warn('unable to use corpus cache: {}'.format(e))
+
+    if data_set is None:
+        data_set = list(iter_dataset(paths, extensions, vocabs, max_size=max_size, binary_input=binary_input,
+                                     character_level=character_level, max_seq_len=max_seq_len))
 
     debug('files: {}'.format(' '.join(paths)))
     debug('size: {}'.format(len(data_set)))
@@ -257,16 +400,120 @@ def read_dataset(paths, extensions, vocabs, max_size=None, binary_input=None,
     return data_set
 
 
-def random_batch_iterator(data, batch_size):
+def corpus_cache_key(paths, vocabs, max_size=None, character_level=None, max_seq_len=None):
+    """
+    Compute a key which identifies a compiled corpus. It changes whenever one of the corpus files
+    is modified (different size or modification time), or one of the vocabularies or parameters changes.
+    """
+    h = hashlib.sha1()
+
+    for path, vocab in zip(paths, vocabs):
+        stat = os.stat(path)
+        h.update('{} {} {}\n'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns).encode())
+        if vocab is not None:
+            h.update('\n'.join(vocab.reverse).encode())
+        h.update(b'\0')
+
+    h.update(repr((max_size or None, character_level, max_seq_len or None)).encode())
+    return h.hexdigest()
+
+
+def read_cached_dataset(paths, extensions, vocabs, cache_dir, max_size=None, character_level=None,
+                        max_seq_len=None):
+    """
+    Pre-tokenized version of `iter_dataset`. The first time a corpus is read, it is compiled into
+    `cache_dir`: for each extension, a flat int32 array containing the token ids of all the lines,
+    and an int64 array of offsets (line `i` spans `tokens[offsets[i]:offsets[i + 1]]`).
+    The following times, those arrays are memory-mapped, and the lines are views into them.
+
+    :return: list of lists of int32 arrays (one for each extension)
+    """
+    key = corpus_cache_key(paths, vocabs, max_size=max_size, character_level=character_level,
+                           max_seq_len=max_seq_len)
+    cache_path = os.path.join(cache_dir, key)
+
+    if not os.path.isdir(cache_path):
+        log('compiling corpus into {}'.format(cache_path))
+        tokens = [array.array('i') for _ in extensions]
+        offsets = [array.array('q', [0]) for _ in extensions]
+
+        for inputs in iter_dataset(paths, extensions, vocabs, max_size=max_size, character_level=character_level,
+                                   max_seq_len=max_seq_len):
+            for tokens_, offsets_, input_ in zip(tokens, offsets, inputs):
+                tokens_.extend(input_)
+                offsets_.append(len(tokens_))
+
+        # write into a temporary directory first, so that an interrupted build is never loaded
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=cache_dir)
+
+        for i, (tokens_, offsets_) in enumerate(zip(tokens, offsets)):
+            np.save(os.path.join(tmp_path, '{}.tokens.npy'.format(i)), np.frombuffer(tokens_, dtype=np.int32))
+            np.save(os.path.join(tmp_path, '{}.offsets.npy'.format(i)), np.frombuffer(offsets_, dtype=np.int64))
+
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:   # another process compiled the same corpus in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    else:
+        debug('loading compiled corpus from {}'.format(cache_path))
+
+    columns = []
+    for i in range(len(extensions)):
+        tokens = np.asarray(np.load(os.path.join(cache_path, '{}.tokens.npy'.format(i)), mmap_mode='r'))
+        offsets = np.load(os.path.join(cache_path, '{}.offsets.npy'.format(i)))
+        columns.append(np.split(tokens, offsets[1:-1]) if len(offsets) > 1 else [])
+
+    return [list(inputs) for inputs in zip(*columns)]
+
+
+def random_batch_iterator(data, batch_size, read_ahead=1, shuffle=True, state=None):
     """
     The most basic form of batch iterator.
 
     :param data: the dataset to segment into batches
     :param batch_size: the size of a batch
+    :param read_ahead: number of random batches to read at once, whose content is sorted by target length
+      (like `read_ahead_batch_iterator`)
+    :param shuffle: shuffle the order of the batches of each read-ahead window
+    :param state: iterator state (see `read_ahead_batch_iterator`)
     :return: an iterator which yields random batches (indefinitely)
     """
+    state = init_iterator_state(state)
+    state.setdefault('batch', 0)
+    read_ahead = max(read_ahead, 1)
+
+    def random_batch(index):
+        # each batch has its own seed, so that resuming from any batch is immediate
+        rng = random.Random(state['seed'] * 2 ** 32 + index)
+        return [data[i] for i in rng.sample(range(len(data)), batch_size)]
+
     while True:
-        yield random.sample(data, batch_size)
+        window, position = divmod(state['batch'], read_ahead)
+        batches = [random_batch(window * read_ahead + i) for i in range(read_ahead)]
+
+        if read_ahead > 1:
+            data_ = sorted(sum(batches, []), key=lambda lines: len(lines[-1]))
+            batches = [data_[i * batch_size:(i + 1) * batch_size] for i in range(read_ahead)]
+            if shuffle:
+                np.random.RandomState([state['seed'], window]).shuffle(batches)
+
+        for batch in batches[position:]:
+            state['batch'] += 1
+            yield batch
+
+
+def init_iterator_state(state=None):
+    """
+    Initialize the state of a batch iterator with a random seed, if it doesn't have one already.
+
+    :param state: dictionary containing the state of an iterator (which is modified in place), or None
+    :return: the state (a new dictionary if `state` is None)
+    """
+    state = {} if state is None else state
+    state.setdefault('seed', random.getrandbits(32))
+    state.setdefault('epoch', 0)
+    return state
 
 
 def cycling_batch_iterator(data, batch_size, shuffle=True, allow_smaller=True):
@@ -292,7 +539,7 @@ def cycling_batch_iterator(data, batch_size, shuffle=True, allow_smaller=True):
 
 
 def read_ahead_batch_iterator(data, batch_size, read_ahead=10, shuffle=True, allow_smaller=True,
-                              mode='standard', **kwargs):
+                              mode='standard', max_tokens=None, buckets=8, state=None, **kwargs):
     """
     Same iterator as `cycling_batch_iterator`, except that it reads a number of batches
     at once, and sorts their content according to their size.
@@ -300,29 +547,119 @@ def read_ahead_batch_iterator(data, batch_size, read_ahead=10, shuffle=True, all
     This is useful for training, where all the sequences in one batch need to be padded
      to the same length as the longest sequence in the batch.
 
+    The position of the iterator is tracked in `state`, a small picklable dictionary which is updated
+    after each batch. All the random choices derive from the seed in this state, so a new iterator created with
+    a copy of `state` resumes right after the last batch, without having to go through the previous batches.
+
     :param data: the dataset to segment into batches
     :param batch_size: the size of a batch
     :param read_ahead: number of batches to read ahead of time and sort (larger numbers
       mean faster training, but less random behavior)
+    :param mode: 'standard', 'random' (batches are sampled independently from each other), 'tokens'
+      (batches contain at most `max_tokens` source and target positions, see `split_by_tokens`),
+      or 'bucket' (examples are grouped into `buckets` length buckets, see `bucket_batch_iterator`)
+    :param state: dictionary where the state of the iterator is stored (modified in place), or None
     :return: an iterator which yields batches (indefinitely)
     """
+    state = init_iterator_state(state)
+
     if mode == 'random':
-        iterator = random_batch_iterator(data, batch_size)
+        yield from random_batch_iterator(data, batch_size, read_ahead=read_ahead, shuffle=shuffle, state=state)
+    elif mode == 'bucket':
+        yield from bucket_batch_iterator(data, batch_size, buckets=buckets, shuffle=shuffle, state=state)
+
+    if mode == 'tokens':
+        assert max_tokens, 'batch mode `tokens` requires a value for `max_tokens`'
     else:
-        iterator = cycling_batch_iterator(data, batch_size, shuffle=shuffle, allow_smaller=allow_smaller)
+        max_tokens = None
 
-    if read_ahead <= 1:
-        while True:
-            yield next(iterator)
+    while True:
+        position = state.setdefault('position', {})
+        for batch in read_ahead_batches(data, batch_size, read_ahead=read_ahead, shuffle=shuffle,
+                                        max_tokens=max_tokens, seed=[state['seed'], state['epoch']],
+                                        state=position):
+            if allow_smaller or max_tokens or len(batch) == batch_size:
+                yield batch
+        state.update(epoch=state['epoch'] + 1, position={})
+
+
+def bucket_batch_iterator(data, batch_size, buckets=8, shuffle=True, state=None):
+    """
+    Indefinitely cycle through a dataset, and yield batches of examples of similar lengths.
+
+    Each sequence of an example (the input of each encoder, and the target) falls in one of `buckets`
+    length buckets, whose boundaries are the length quantiles of this sequence in the dataset. Examples with
+    the same buckets are grouped together. At each new epoch, each group is shuffled and segmented into batches,
+    the remaining examples of all the groups are sorted by length and segmented into batches, and the order of
+    all these batches is shuffled. The fraction of padded positions of each epoch is logged.
+
+    :param data: the dataset to segment into batches
+    :param batch_size: the size of a batch
+    :param buckets: number of length buckets for each sequence
+    :param state: iterator state (see `read_ahead_batch_iterator`)
+    :return: an iterator which yields batches (indefinitely)
+    """
+    state = init_iterator_state(state)
+
+    quantiles = np.linspace(0, 100, buckets + 1)[1:-1]
+    keys = []
+    for i in range(len(data[0])):
+        lengths = np.array([len(example[i]) for example in data])
+        boundaries = np.unique(np.percentile(lengths, quantiles))
+        keys.append(np.searchsorted(boundaries, lengths))
+    keys = list(zip(*keys))
+
+    groups = {}
+    for index, key in enumerate(keys):
+        groups.setdefault(key, []).append(index)
+    groups = [groups[key] for key in sorted(groups)]
 
     while True:
-        batches = [next(iterator) for _ in range(read_ahead)]
-        data_ = sorted(sum(batches, []), key=lambda lines: len(lines[-1]))
-        batches = [data_[i * batch_size:(i + 1) * batch_size] for i in range(read_ahead)]
+        rng = np.random.RandomState([state['seed'], state['epoch']])
+        batches = []
+        remainder = []
+
+        for indices in groups:
+            if shuffle:
+                indices = list(indices)
+                rng.shuffle(indices)
+            batch_count = len(indices) // batch_size
+            batches += [indices[i * batch_size:(i + 1) * batch_size] for i in range(batch_count)]
+            remainder += indices[batch_count * batch_size:]
+
+        remainder.sort(key=lambda index: [len(lines) for lines in reversed(data[index])])
+        batches += [remainder[i:i + batch_size] for i in range(0, len(remainder), batch_size)]
+
         if shuffle:
-            random.shuffle(batches)
-        for batch in batches:
-            yield batch
+            rng.shuffle(batches)
+
+        batches = [[data[index] for index in batch] for batch in batches]
+        log('epoch {}: {} batches, {:.1%} of padded positions'.format(state['epoch'] + 1, len(batches),
+                                                                     padding_ratio(batches)))
+
+        for i in range(state.get('batch', 0), len(batches)):
+            state['batch'] = i + 1
+            yield batches[i]
+
+        state.update(epoch=state['epoch'] + 1, batch=0)
+
+
+def padding_ratio(batches):
+    """
+    Fraction of padded positions in a list of batches, i.e., the number of positions needed to
+    pad all the sequences of a batch to the same length (for each encoder and for the decoder),
+    divided by the total number of positions.
+    """
+    padded = 0
+    total = 0
+
+    for batch in batches:
+        for i in range(len(batch[0])):
+            lengths = [len(example[i]) for example in batch]
+            total += max(lengths) * len(lengths)
+            padded += max(lengths) * len(lengths) - sum(lengths)
+
+    return padded / total if total > 0 else 0
 
 
 def read_ahead_batch_iterator_blocks(data, batch_size, read_ahead=10, shuffle=True):
@@ -346,6 +683,251 @@ def read_ahead_batch_iterator_blocks(data, batch_size, read_ahead=10, shuffle=Tr
                     yield batch
 
 
+def index_shards(paths, binary_input=None, shard_size=100000, max_size=None):
+    """
+    Segment a parallel corpus into shards of `shard_size` lines, which can be read independently
+    with `read_shard`. This reads the entire corpus once, but never holds more than one line in memory.
+
+    Binary inputs need to be in the `FeatureStore` format (which supports random access).
+
+    :param paths: corpus files (one for each extension)
+    :param binary_input: list of booleans, whether each file contains binary features
+    :param shard_size: number of lines in each shard
+    :param max_size: only use that many lines from the corpus
+    :return: total number of lines, and list of shards. Each shard is a pair (number of lines, positions),
+      where positions are the byte offsets (or feature indices for binary files) of the shard's first line
+      in each file.
+    """
+    binary_input = binary_input or [False] * len(paths)
+    line_counts = []
+    positions = []
+
+    for path, binary in zip(paths, binary_input):
+        if binary:
+            if not is_feature_store(path):
+                raise ValueError('{} needs to be converted to a feature store to be streamed'.format(path))
+            line_count = len(FeatureStore(path))
+            positions_ = list(range(0, line_count, shard_size))
+        else:
+            line_count = 0
+            position = 0
+            positions_ = []
+            with open(path, 'rb') as f:
+                for line in f:
+                    if line_count % shard_size == 0:
+                        positions_.append(position)
+                    position += len(line)
+                    line_count += 1
+
+        line_counts.append(line_count)
+        positions.append(positions_)
+
+    line_count = min(line_counts)
+    if max_size:
+        line_count = min(line_count, max_size)
+
+    shard_count = int(math.ceil(line_count / shard_size))
+    shards = [
+        (min(shard_size, line_count - i * shard_size), [positions_[i] for positions_ in positions])
+        for i in range(shard_count)
+    ]
+
+    return line_count, shards
+
+
+def read_shard(paths, binary_input, shard):
+    """
+    Read the lines of a shard created by `index_shards`.
+
+    :return: iterator over tuples of lines (one line for each file)
+    """
+    binary_input = binary_input or [False] * len(paths)
+    size, positions = shard
+    columns = []
+
+    for path, binary, position in zip(paths, binary_input, positions):
+        if binary:
+            store = FeatureStore(path)
+            columns.append([store[i] for i in range(position, position + size)])
+        else:
+            with open(path, 'rb') as f:
+                f.seek(position)
+                columns.append([line.decode() for line in islice(f, size)])
+
+    return zip(*columns)
+
+
+def read_ahead_batches(data, batch_size, read_ahead=10, shuffle=True, max_tokens=None, seed=None, state=None):
+    """
+    Segment a list of examples into batches, in the same way as `read_ahead_batch_iterator`:
+    examples are read by windows of `read_ahead` batches, which are sorted by length.
+
+    :param max_tokens: if not None, batches have a variable number of examples, such that their padded
+      size is at most `max_tokens` (see `split_by_tokens`), and `batch_size` is only used for
+      the size of the windows
+    :param seed: seed of the random generator used to shuffle the examples and the batches (an integer, or
+      a list of integers)
+    :param state: dictionary which is updated with the position (window and batch) of the last batch. With the
+      same seed, passing this state again resumes from this position, by only reading the current window.
+    :return: iterator over batches (the last batch may be smaller)
+    """
+    state = {} if state is None else state
+    if seed is None:
+        seed = random.getrandbits(32)
+    seed = list(seed) if isinstance(seed, (list, tuple)) else [seed]
+
+    order = np.arange(len(data))
+    if shuffle:
+        np.random.RandomState(seed).shuffle(order)
+
+    window_size = batch_size * max(read_ahead, 1)
+    window_count = int(math.ceil(len(data) / window_size))
+    first_window = state.get('window', 0)
+
+    for i in range(first_window, window_count):
+        window = [data[j] for j in order[i * window_size:(i + 1) * window_size]]
+        if max_tokens:
+            # sort by target length, then by source lengths, to limit padding
+            window.sort(key=lambda lines: [len(lines[-1])] + [len(lines_) for lines_ in lines[:-1]])
+            batches = split_by_tokens(window, max_tokens)
+        else:
+            if read_ahead > 1:
+                window.sort(key=lambda lines: len(lines[-1]))
+            batches = [window[j:j + batch_size] for j in range(0, len(window), batch_size)]
+
+        if shuffle:
+            np.random.RandomState(seed + [i]).shuffle(batches)
+
+        first_batch = state.get('batch', 0) if i == first_window else 0
+        for j in range(first_batch, len(batches)):
+            state.update(window=i, batch=j + 1)
+            yield batches[j]
+
+
+def split_by_tokens(data, max_tokens):
+    """
+    Segment a list of examples into consecutive batches, whose padded size is at most `max_tokens`.
+    The padded size of a batch is its number of examples, multiplied by the sum of the maximum length
+    of each sequence (source and target). An example which is larger than `max_tokens` gets its own batch.
+
+    :param data: list of examples, which should be sorted by length to limit padding
+    :param max_tokens: maximum number of source and target positions in a batch (including padding)
+    :return: list of batches
+    """
+    batches = []
+    batch = []
+    max_lengths = None
+
+    for example in data:
+        lengths = [len(lines) for lines in example]
+        if batch:
+            lengths = [max(len_, max_len) for len_, max_len in zip(lengths, max_lengths)]
+            if (len(batch) + 1) * sum(lengths) > max_tokens:
+                batches.append(batch)
+                batch = []
+                lengths = [len(lines) for lines in example]
+
+        batch.append(example)
+        max_lengths = lengths
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def stream_batch_iterator(paths, extensions, vocabs, batch_size, shards, binary_input=None, character_level=None,
+                          max_seq_len=None, read_ahead=10, shuffle=True, max_tokens=None, state=None):
+    """
+    Batch iterator which reads the training data as a stream, for corpora that do not fit in memory.
+    Only one shard is in memory at any time: at each new epoch, the order of the shards is shuffled,
+    and the content of each shard is shuffled and segmented into batches like `read_ahead_batch_iterator` does.
+
+    :param shards: list of shards, as returned by `index_shards`
+    :param max_tokens: if not None, use batches of a variable size (see `split_by_tokens`)
+    :param state: iterator state (see `read_ahead_batch_iterator`). Resuming only reads the current shard.
+    :return: an iterator which yields batches (indefinitely)
+    """
+    state = init_iterator_state(state)
+
+    while True:
+        order = np.arange(len(shards))
+        if shuffle:
+            np.random.RandomState([state['seed'], state['epoch']]).shuffle(order)
+
+        first_shard = state.get('shard', 0)
+        for i in range(first_shard, len(shards)):
+            if i != first_shard:
+                state['position'] = {}
+            state['shard'] = i
+
+            line_reader = read_shard(paths, binary_input, shards[order[i]])
+            data = list(iter_dataset(paths, extensions, vocabs, binary_input=binary_input,
+                                     character_level=character_level, max_seq_len=max_seq_len,
+                                     line_reader=line_reader))
+
+            for batch in read_ahead_batches(data, batch_size, read_ahead=read_ahead, shuffle=shuffle,
+                                            max_tokens=max_tokens, seed=[state['seed'], state['epoch'], i],
+                                            state=state.setdefault('position', {})):
+                yield batch
+
+        state.update(epoch=state['epoch'] + 1, shard=0, position={})
+
+
+def prefetch_iterator(iterator, depth=1):
+    """
+    Consume `iterator` in a background thread, which stays at most `depth` items ahead.
+    This is useful to prepare the next training batches while the model is busy with the current one.
+
+    :param iterator: any iterator (it should not be used by anyone else after this call)
+    :param depth: maximum number of items waiting in the queue
+    :return: an iterator which yields the same items as `iterator`
+    """
+    queue_ = queue.Queue(maxsize=max(depth, 1))
+    end = object()
+
+    def worker():
+        try:
+            for item in iterator:
+                queue_.put((item, None))
+            queue_.put((end, None))
+        except Exception as e:   # propagate errors to the consumer
+            queue_.put((None, e))
+
+    thread = threading.Thread(target=worker, name='prefetch', daemon=True)
+    thread.start()
+
+    while True:
+        item, error = queue_.get()
+        if error is not None:
+            raise error
+        elif item is end:
+            return
+        yield item
+
+
+def partial_argsort(array, k):
+    """
+    Indices of the `k` smallest values of a 1-D array, sorted by increasing value. Ties are broken by index,
+    so this gives the same result as `np.argsort(array, kind='stable')[:k]`, but it only sorts `k` values
+    (the selection of these values takes linear time).
+
+    :param array: 1-D array of values (without NaNs)
+    :param k: number of indices to return
+    :return: array of at most `k` indices
+    """
+    if k >= len(array):
+        return np.argsort(array, kind='stable')
+    elif k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    kth_value = np.partition(array, k - 1)[k - 1]
+    smaller = np.flatnonzero(array < kth_value)
+    ties = np.flatnonzero(array == kth_value)[:k - len(smaller)]
+    indices = np.concatenate([smaller, ties])   # in increasing order of index
+    return indices[np.argsort(array[indices], kind='stable')]
+
+
 def get_batches(data, batch_size, batches=0, allow_smaller=True):
     """
     Segment `data` into a given number of fixed-size batches. The dataset is automatically shuffled.
@@ -389,43 +971,285 @@ def read_lines(paths, extensions, binary_input=None):
     return zip(*iterators)
 
 
+# magic number at the beginning of binary language models (see `NgramModel`)
+_NGRAM_MODEL_MAGIC = b'NGRAMLM1'
+_NGRAM_MODEL_HEADER = 'qq20s4x'   # order, vocabulary size, and SHA-1 digest of the vocabulary (+ padding)
+
+
+class NgramTable(object):
+    """
+    N-grams of one order of a `NgramModel`. This table has the same interface as a dict which maps
+    tuples of token ids to lists [log probability] or [log probability, backoff weight] (`in`, `[]`, `get`,
+    `len` and `items`), as used by `estimate_lm_score`.
+
+    N-grams are stored as sorted int64 keys, with the probabilities and backoff weights in arrays
+    of the same size. The key of a unigram (w) is w, and the key of a n-gram (w_1 ... w_n) is
+    `row * vocab_size + w_n`, where `row` is the position of the prefix (w_1 ... w_n-1) in the table
+    of order n - 1 (this is a trie, where the continuations of a prefix are contiguous).
+    """
+    def __init__(self, model, order, keys, probs, backoffs=None):
+        self.model = model
+        self.order = order
+        self.keys = keys
+        self.probs = probs
+        self.backoffs = backoffs   # None for the highest order
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, keys):
+        """
+        :param keys: array of keys
+        :return: array of rows of these keys in the table (-1 for the keys which are not in the table)
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        rows = np.searchsorted(self.keys, keys)
+        found = rows < len(self.keys)
+        found[found] = self.keys[rows[found]] == keys[found]
+        return np.where(found, rows, -1)
+
+    def row(self, ngram):
+        """
+        :param ngram: tuple of token ids
+        :return: position of this n-gram in the table, or -1 if it is not in the table
+        """
+        if len(ngram) != self.order or not all(0 <= token < self.model.vocab_size for token in ngram):
+            return -1
+
+        row = -1
+        for table, token in zip(self.model.tables[:self.order], ngram):
+            key = token if table.order == 1 else row * self.model.vocab_size + token
+            row = int(table.find([key])[0])
+            if row < 0:
+                return -1
+        return row
+
+    def weights(self, row):
+        weights = [float(self.probs[row])]
+        if self.backoffs is not None and not np.isnan(self.backoffs[row]):
+            weights.append(float(self.backoffs[row]))
+        return weights
+
+    def __contains__(self, ngram):
+        return self.row(tuple(ngram)) >= 0
+
+    def __getitem__(self, ngram):
+        row = self.row(tuple(ngram))
+        if row < 0:
+            raise KeyError(ngram)
+        return self.weights(row)
+
+    def get(self, ngram, default=None):
+        row = self.row(tuple(ngram))
+        return default if row < 0 else self.weights(row)
+
+    def ngram(self, row):
+        tokens = []
+        for table in reversed(self.model.tables[:self.order]):
+            key = int(table.keys[row])
+            if table.order == 1:
+                tokens.append(key)
+            else:
+                row, token = divmod(key, self.model.vocab_size)
+                tokens.append(token)
+        return tuple(reversed(tokens))
+
+    def items(self):
+        for row in range(len(self)):
+            yield self.ngram(row), self.weights(row)
+
+
+class NgramModel(object):
+    """
+    Compact n-gram language model, made of one `NgramTable` for each order. This behaves like the
+    list of dicts that `estimate_lm_score` expects (`len(model)` is the order, and `model[i]`
+    contains the n-grams of order i + 1).
+
+    The arrays can be memory-mapped from a binary file (see `write_ngram_model`), whose layout is:
+      - 8 bytes of magic number (`NGRAMLM1`)
+      - two int64 (order and vocabulary size), 20 bytes of SHA-1 digest of the vocabulary, and 4 bytes of padding
+      - one int64 for each order: number of n-grams of this order
+      - for each order: keys (int64), log probabilities (float64), and backoff weights (float64,
+        NaN when there is no backoff weight) except for the highest order
+    """
+    def __init__(self, vocab_size):
+        self.vocab_size = vocab_size
+        self.tables = []
+
+    def __len__(self):
+        return len(self.tables)
+
+    def __getitem__(self, index):
+        return self.tables[index]
+
+    def __iter__(self):
+        return iter(self.tables)
+
+    def add_order(self, ngrams, probs, backoffs=None):
+        """
+        Add the table of the next order.
+
+        :param ngrams: int array of shape (count, order), containing token ids
+        :param probs: float array of shape (count,)
+        :param backoffs: float array of shape (count,), or None
+        :return: number of n-grams which were discarded because their prefix is not in the model
+        """
+        order = len(self.tables) + 1
+        ngrams = np.asarray(ngrams, dtype=np.int64).reshape([-1, order])
+        probs = np.asarray(probs, dtype=np.float64)
+
+        if order == 1:
+            keys = ngrams[:, 0]
+        else:
+            rows = ngrams[:, 0]
+            for table, tokens in zip(self.tables, ngrams.T[:-1]):
+                keys = rows if table.order == 1 else rows * self.vocab_size + tokens
+                rows = np.where(rows >= 0, table.find(keys), -1)
+            keys = np.where(rows >= 0, rows * self.vocab_size + ngrams[:, -1], -1)
+
+        valid = keys >= 0
+        discarded = len(keys) - int(valid.sum())
+
+        # sort the keys, and keep the last value of duplicate n-grams (like a dict)
+        indices = np.flatnonzero(valid)
+        indices = indices[np.argsort(keys[indices], kind='stable')]
+        keys = keys[indices]
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        indices = indices[last]
+
+        backoffs = None if backoffs is None else np.asarray(backoffs, dtype=np.float64)[indices]
+        self.tables.append(NgramTable(self, order, keys[last], probs[indices], backoffs))
+        return discarded
+
+
+def vocab_digest(vocab):
+    """
+    SHA-1 digest of a vocabulary (dict mapping words to ids), used to check that a binary language model
+    was created with the same vocabulary.
+    """
+    sha = hashlib.sha1()
+    for word, id_ in sorted(vocab.items(), key=lambda item: item[1]):
+        sha.update('{} {}\n'.format(word, id_).encode())
+    return sha.digest()
+
+
+def write_ngram_model(filename, model, vocab):
+    """
+    Write a `NgramModel` to a binary file, which can be loaded instantly (and memory-mapped) by `read_ngrams`.
+
+    :param filename: path to the output file
+    :param model: a `NgramModel`, as returned by `read_ngrams`
+    :param vocab: vocabulary used to create this model (dict mapping words to token ids)
+    """
+    with open(filename, 'wb') as f:
+        f.write(_NGRAM_MODEL_MAGIC)
+        f.write(struct.pack(_NGRAM_MODEL_HEADER, len(model), model.vocab_size, vocab_digest(vocab)))
+        f.write(np.array([len(table) for table in model], dtype=np.int64).tobytes())
+
+        for table in model:
+            f.write(np.asarray(table.keys, dtype=np.int64).tobytes())
+            f.write(np.asarray(table.probs, dtype=np.float64).tobytes())
+            if table.backoffs is not None:
+                f.write(np.asarray(table.backoffs, dtype=np.float64).tobytes())
+
+
+def load_ngram_model(filename, vocab=None):
+    """
+    Load a binary language model created by `write_ngram_model`. The arrays are memory-mapped.
+
+    :param vocab: if not None, check that the model was created with this vocabulary
+    :return: a `NgramModel`
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(_NGRAM_MODEL_MAGIC)) != _NGRAM_MODEL_MAGIC:
+            raise ValueError('{} is not a binary language model'.format(filename))
+        order, vocab_size, digest = struct.unpack(_NGRAM_MODEL_HEADER, f.read(struct.calcsize(_NGRAM_MODEL_HEADER)))
+        counts = np.frombuffer(f.read(8 * order), dtype=np.int64)
+        offset = f.tell()
+
+    if vocab is not None and digest != vocab_digest(vocab):
+        raise ValueError('{} was created with a different vocabulary'.format(filename))
+
+    def memmap(dtype, count):
+        nonlocal offset
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        array_ = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(count,))
+        offset += array_.nbytes
+        return array_
+
+    model = NgramModel(vocab_size)
+    for i, count in enumerate(counts):
+        keys = memmap(np.int64, count)
+        probs = memmap(np.float64, count)
+        backoffs = memmap(np.float64, count) if i < order - 1 else None
+        model.tables.append(NgramTable(model, i + 1, keys, probs, backoffs))
+
+    return model
+
+
+def is_ngram_model(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(_NGRAM_MODEL_MAGIC)) == _NGRAM_MODEL_MAGIC
+
+
 def read_ngrams(lm_path, vocab):
     """
-    Read a language model from a file in the ARPA format,
-    and return it as a list of dicts.
+    Read a language model from a file in the ARPA format (or in the binary format of `write_ngram_model`),
+    and return it as a `NgramModel`, which behaves like a list of dicts (one for each order).
+
+    The ARPA file is read line by line, and the n-grams are stored directly in arrays
+    (n-grams which contain words that are not in the vocabulary are skipped).
 
     :param lm_path: full path to language model file
     :param vocab: vocabulary used to map words from the LM to token ids
     :return: one dict for each ngram order, containing mappings from
       ngram (as a sequence of token ids) to (log probability, backoff weight)
     """
-    ngram_list = []
+    if is_ngram_model(lm_path):
+        ngrams = load_ngram_model(lm_path, vocab)
+        debug('loaded n-grams, order={}'.format(len(ngrams)))
+        return ngrams
+
+    mappings = {'<s>': _BOS, '</s>': _EOS, '<unk>': _UNK}
+    ids = {}   # cache of the word ids (None for unknown words)
+
+    def word_id(word):
+        id_ = ids.get(word, -1)
+        if id_ == -1:
+            id_ = ids[word] = vocab.get(mappings.get(word, word))
+        return id_
+
+    orders = []   # token ids, log probabilities and backoff weights of each order
+
     with open(lm_path) as f:
         for line in f:
             line = line.strip()
             if re.match(r'\\\d-grams:', line):
-                ngram_list.append({})
+                orders.append((array.array('q'), array.array('d'), array.array('d')))
             elif not line or line == '\\end\\':
                 continue
-            elif ngram_list:
+            elif orders:
                 arr = list(map(str.rstrip, line.split('\t')))
-                ngram = arr.pop(1)
-                ngram_list[-1][ngram] = list(map(float, arr))
-
-    debug('loaded n-grams, order={}'.format(len(ngram_list)))
-
-    ngrams = []
-    mappings = {'<s>': _BOS, '</s>': _EOS, '<unk>': _UNK}
-
-    for kgrams in ngram_list:
-        d = {}
-        for seq, probas in kgrams.items():
-            ids = tuple(vocab.get(mappings.get(w, w)) for w in seq.split())
-            if any(id_ is None for id_ in ids):
-                continue
-            d[ids] = probas
-        ngrams.append(d)
-    return ngrams
+                ngram = [word_id(word) for word in arr.pop(1).split()]
+                if any(id_ is None for id_ in ngram):
+                    continue
+                tokens, probs, backoffs = orders[-1]
+                tokens.extend(ngram)
+                probs.append(float(arr[0]))
+                backoffs.append(float(arr[1]) if len(arr) > 1 else float('nan'))
+
+    model = NgramModel(vocab_size=max(vocab.values()) + 1 if vocab else 0)
+    for i, (tokens, probs, backoffs) in enumerate(orders):
+        discarded = model.add_order(np.frombuffer(tokens, dtype=np.int64), np.frombuffer(probs, dtype=np.float64),
+                                    np.frombuffer(backoffs, dtype=np.float64) if i < len(orders) - 1 else None)
+        if discarded:
+            warn('{} {}-grams were discarded, because their prefix is not in the language model'.format(
+                discarded, i + 1))
+
+    debug('loaded n-grams, order={}'.format(len(model)))
+    return model
 
 
 def create_logger(log_file=None):
@@ -464,7 +1288,7 @@ def estimate_lm_score(sequence, ngrams):
     Compute the log score of a sequence according to given language model.
 
     :param sequence: list of token ids
-    :param ngrams: list of dicts, as returned by `read_ngrams`
+    :param ngrams: list of dicts (or `NgramModel`), as returned by `read_ngrams`
     :return: log probability of `sequence`
 
     P(w_3 | w_1, w_2) =
@@ -485,6 +1309,161 @@ def estimate_lm_score(sequence, ngrams):
         return estimate_lm_score(sequence[1:], ngrams) + backoff_weight
 
 
+class NgramScorer(object):
+    """
+    Vectorized version of `estimate_lm_score`, which computes the log probabilities of all the tokens
+    of the vocabulary after a given history, in one call.
+
+    The scores for a history are computed iteratively, from unigrams to the longest context: at each order,
+    the scores of the previous order plus the backoff weight of the context are overwritten by the explicit
+    probabilities of the context's continuations (which are contiguous in the tables of a `NgramModel`).
+    The result is the same as `estimate_lm_score`. Results are memoized by history (in a LRU cache).
+    """
+    def __init__(self, ngrams, vocab_size, cache_size=1024):
+        """
+        :param ngrams: a `NgramModel`, as returned by `read_ngrams`
+        :param vocab_size: size of the score vectors (tokens outside of this range are ignored)
+        :param cache_size: maximum number of histories whose scores are kept in memory
+        """
+        self.ngrams = ngrams
+        self.order = len(ngrams)
+        self.vocab_size = vocab_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        # tokens missing from the unigrams have no score (`estimate_lm_score` is not defined for them)
+        self.unigrams = np.full(vocab_size, -np.inf)
+        unigrams = ngrams[0]
+        keys = np.asarray(unigrams.keys)
+        mask = keys < vocab_size
+        self.unigrams[keys[mask]] = unigrams.probs[mask]
+
+    def __call__(self, history):
+        """
+        :param history: sequence of token ids (only the last `order - 1` tokens are used)
+        :return: array of shape (vocab_size,) containing the log probability of each token
+          after `history` (-inf for the tokens which are not in the language model)
+        """
+        history = tuple(history[-(self.order - 1):]) if self.order > 1 else ()
+
+        scores = self.cache.get(history)
+        if scores is not None:
+            self.cache.move_to_end(history)
+            return scores
+
+        model_vocab_size = self.ngrams.vocab_size
+        scores = self.unigrams.copy()
+        for i in range(1, len(history) + 1):
+            context = history[-i:]
+            table = self.ngrams[i - 1]
+            row = table.row(context)
+            if row < 0:
+                continue
+
+            backoff = table.backoffs[row]
+            if not np.isnan(backoff):
+                scores += backoff
+
+            # continuations of `context` are the keys between row * V and (row + 1) * V
+            next_table = self.ngrams[i]
+            start, end = np.searchsorted(next_table.keys, [row * model_vocab_size, (row + 1) * model_vocab_size])
+            tokens = np.asarray(next_table.keys[start:end]) - row * model_vocab_size
+            mask = tokens < self.vocab_size
+            scores[tokens[mask]] = next_table.probs[start:end][mask]
+
+        scores[np.isinf(self.unigrams)] = -np.inf
+        scores.flags.writeable = False   # shared by all the callers
+
+        self.cache[history] = scores
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return scores
+
+
+class TranslationCache(object):
+    """
+    Bounded LRU cache of translations (sequences of token ids), indexed by string keys
+    (see `TranslationModel.translation_cache_key`).
+
+    If `filename` is not None, the entries are also stored in a SQLite database: entries which are evicted
+    from memory can still be found on disk, and the cache persists between runs.
+    """
+    def __init__(self, max_size=10000, filename=None):
+        """
+        :param max_size: maximum number of entries kept in memory
+        :param filename: path to a SQLite database (created if it doesn't exist), or None
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+
+        if filename is not None:
+            import sqlite3
+            # the cache may be used by another thread than the one which created it (e.g. decoding server)
+            self.db = sqlite3.connect(filename, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.commit()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _add(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        """
+        :return: the token ids stored for this key, or None if this key is not in the cache
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            elif self.db is not None:
+                row = self.db.execute('SELECT value FROM translations WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    value = [int(token) for token in row[0].split()]
+                    self._add(key, value)
+
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def update(self, items):
+        """
+        :param items: list of pairs (key, token ids)
+        """
+        with self.lock:
+            items = [(key, list(map(int, value))) for key, value in items]
+            for key, value in items:
+                self._add(key, value)
+
+            if self.db is not None and items:
+                self.db.executemany('INSERT OR REPLACE INTO translations VALUES (?, ?)',
+                                    [(key, ' '.join(map(str, value))) for key, value in items])
+                self.db.commit()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def summary(self):
+        return '{} hits out of {} lookups ({:.1%}), {} entries in memory'.format(
+            self.hits, self.hits + self.misses, self.hit_rate(), len(self))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
 def heatmap(xlabels=None, ylabels=None, weights=None,
             output_file=None, wav_file=None):
     """